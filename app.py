@@ -3,55 +3,70 @@ from tkinter import ttk, messagebox, filedialog
 import threading
 import queue
 import json
+import time
 import os
 import webbrowser
-import difflib
-try:
-    from PIL import Image, ImageTk
-except ImportError:
-    print("Warning: PIL.ImageTk not available. Icon will not be loaded.")
-    Image = None
-    ImageTk = None
+import bisect
+from collections import deque
 
 import sftp_logic
+import hash_cache
+import sync_journal
+import connection_pool
+import task_metrics
+import diff_engine
+import path_filter
+from queue_dispatcher import QueueDispatcher
+
+TREE_CHUNK_BUDGET = 0.03 # Seconds of Treeview inserts per idle callback while results are shown
+IDENTICAL_SUMMARY = "IDENTICAL FILES" # Status of the row standing in for collapsed identical files
+REFRESH_MAX_PATHS = 5000 # Syncs touching more paths are followed by a full comparison instead of a targeted refresh
+WATCH_INTERVALS = ["1 min", "5 min", "15 min", "60 min"] # Choices for how often the drift watch compares the folders
+
+def copy_results(results):
+    """Copies the lists and dicts of comparison results, so a watch thread and the UI never share them."""
+    return {k: (list(v) if isinstance(v, list) else dict(v) if isinstance(v, dict) else v) for k, v in results.items()}
 
 class App(ctk.CTk):
     """
     Main Application Window Class
     """
-    def __init__(self):
+    def __init__(self, startup_report=None):
         super().__init__()
 
         self.title("MINO: Mirroring Integrity Network Operations")
         self.geometry("900x700")
+        self.startup_report = startup_report # main.StartupReport when started with --startup-report
 
         # --- Icon Setup ---
         # Absolute path to assets directory
-        assets_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "assets")
+        self.assets_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "assets")
         
         # 1. For Windows (.ico)
         try:
-            icon_path_ico = os.path.join(assets_path, "mino.ico")
+            icon_path_ico = os.path.join(self.assets_path, "mino.ico")
             if os.path.exists(icon_path_ico):
                 self.iconbitmap(icon_path_ico)
         except Exception:
             pass # Ignore errors on non-Windows systems or if file issues
-
-        # 2. For Linux/macOS (.png)
-        if Image and ImageTk:
-            try:
-                icon_path_png = os.path.join(assets_path, "mino_icon.png")
-                if os.path.exists(icon_path_png):
-                    icon_img = Image.open(icon_path_png)
-                    self.iconphoto(False, ImageTk.PhotoImage(icon_img))
-            except Exception as e:
-                print(f"Error loading icon: {e}")
-        else:
-             print("Skipping icon load: PIL.ImageTk not available.")
+        # 2. For Linux/macOS (.png): loaded with PIL after the window is shown, see after_first_paint
 
         # --- Data ---
         self.result_queue = queue.Queue()
+        self.result_dispatcher = None
+        self.batch_sync_paths = []
+        self.population = 0 # Incremented to abandon a Treeview population that is still running
+        self.row_ids = {} # {relative_path: (iid, values)} of the rows in the Treeview
+        self.collapsed_rows = None # {relative_path: (values, tags)} of identical files behind the summary row
+        self.identical_summary = None # iid of the collapsed identical files row
         self.comparison_results = None
+        self.watch_queue = queue.Queue()
+        self.watch_stop_event = None # Set to stop the running drift watch
+        self.watch_dispatcher = None
+        self.drift_window = None
+        self.metrics_queue = queue.Queue() # TaskMetrics of finished background tasks, put from their threads
+        self.task_runs = deque(maxlen=task_metrics.MAX_RUNS)
+        self.stats_window = None
         self.server1_vars = {}
         self.server2_vars = {}
 
@@ -64,6 +79,40 @@ class App(ctk.CTk):
             "port": ctk.BooleanVar(value=True)
         }
 
+        # Compare Options (Settings menu)
+        self.compare_options = {
+            "remote_hash": ctk.BooleanVar(value=sftp_logic.DEFAULT_COMPARE_OPTIONS["remote_hash"]),
+            "hash_algo": ctk.StringVar(value=sftp_logic.DEFAULT_COMPARE_OPTIONS["hash_algo"]),
+            "quick": ctk.BooleanVar(value=sftp_logic.DEFAULT_COMPARE_OPTIONS["quick"]),
+            "strict": ctk.BooleanVar(value=sftp_logic.DEFAULT_COMPARE_OPTIONS["strict"]),
+            "use_cache": ctk.BooleanVar(value=sftp_logic.DEFAULT_COMPARE_OPTIONS["use_cache"]),
+            "scan_workers": ctk.StringVar(value=str(sftp_logic.DEFAULT_COMPARE_OPTIONS["scan_workers"])),
+            "hash_chunk_kib": ctk.StringVar(value=str(sftp_logic.DEFAULT_COMPARE_OPTIONS["hash_chunk_kib"])),
+            "dir_digests": ctk.BooleanVar(value=sftp_logic.DEFAULT_COMPARE_OPTIONS["dir_digests"]),
+            "collapse_identical": ctk.BooleanVar(value=True) # Results view only; ignored by the comparison
+        }
+
+        # Sync Options (Sync window)
+        self.sync_options = {
+            "transfer": ctk.StringVar(value=sftp_logic.DEFAULT_SYNC_OPTIONS["transfer"]),
+            "direct_host": ctk.StringVar(value=sftp_logic.DEFAULT_SYNC_OPTIONS["direct_host"]),
+            "forward_agent": ctk.BooleanVar(value=sftp_logic.DEFAULT_SYNC_OPTIONS["forward_agent"]),
+            "delta": ctk.BooleanVar(value=sftp_logic.DEFAULT_SYNC_OPTIONS["delta"]),
+            "sync_workers": ctk.StringVar(value=str(sftp_logic.DEFAULT_SYNC_OPTIONS["sync_workers"]))
+        }
+
+        # Path Filters (Settings menu), applied to comparisons, syncs and backups
+        self.filter_options = {
+            "exclude": ctk.StringVar(value=sftp_logic.DEFAULT_COMPARE_OPTIONS["exclude"]),
+            "include": ctk.StringVar(value=sftp_logic.DEFAULT_COMPARE_OPTIONS["include"])
+        }
+
+        # Drift watch (main window)
+        self.watch_options = {
+            "interval": ctk.StringVar(value=WATCH_INTERVALS[1])
+        }
+        self.watch_var = ctk.BooleanVar(value=False)
+
         # --- Menu Bar (Custom) ---
         self.create_custom_menubar()
 
@@ -102,6 +151,10 @@ class App(ctk.CTk):
         self.diff_button = ctk.CTkButton(button_subframe, text="Compare Selected File", command=self.open_diff_window, state="disabled")
         self.diff_button.pack(side="left")
 
+        self.watch_switch = ctk.CTkSwitch(button_subframe, text="Watch PROD for drift", variable=self.watch_var, command=self.toggle_watch)
+        self.watch_switch.pack(side="left", padx=(20, 5))
+        ctk.CTkOptionMenu(button_subframe, variable=self.watch_options["interval"], values=WATCH_INTERVALS, width=90, command=self.on_watch_interval_change).pack(side="left")
+
         # Clone Checkbox (Moved to Menu)
         self.clone_var = ctk.BooleanVar(value=False)
         
@@ -127,6 +180,52 @@ class App(ctk.CTk):
         self.progress_bar.set(0)
         self.progress_bar.configure(mode="indeterminate")
 
+        task_metrics.add_listener(self.metrics_queue.put)
+        QueueDispatcher(self, self.metrics_queue, self.handle_task_metrics).start()
+
+        self.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.after_idle(self.after_first_paint)
+
+    def after_first_paint(self):
+        """
+        Runs once the window is shown and loads what it did not need to appear: the PNG icon (PIL)
+        and, in a background thread, paramiko for the first connection.
+        """
+        self.update_idletasks()
+        if self.startup_report:
+            self.startup_report.mark("first paint")
+        threading.Thread(target=self.preload_connections, daemon=True).start()
+        self.load_png_icon()
+
+    def load_png_icon(self):
+        start = time.perf_counter()
+        try:
+            from PIL import Image, ImageTk
+        except ImportError:
+            print("Skipping icon load: PIL.ImageTk not available.")
+            return
+        try:
+            icon_path_png = os.path.join(self.assets_path, "mino_icon.png")
+            if os.path.exists(icon_path_png):
+                icon_img = Image.open(icon_path_png)
+                self.iconphoto(False, ImageTk.PhotoImage(icon_img))
+        except Exception as e:
+            print(f"Error loading icon: {e}")
+        if self.startup_report:
+            self.startup_report.add("icon (PIL), after paint", time.perf_counter() - start)
+
+    def preload_connections(self):
+        start = time.perf_counter()
+        connection_pool.preload()
+        if self.startup_report:
+            self.startup_report.add("paramiko, in background", time.perf_counter() - start)
+
+    def on_closing(self):
+        """Stops the drift watch before the window closes."""
+        self.stop_watch()
+        task_metrics.remove_listener(self.metrics_queue.put)
+        self.destroy()
+
     def create_custom_menubar(self):
         """Creates a custom menu bar using CTkFrame and Buttons."""
         menubar_frame = ctk.CTkFrame(self, height=30, corner_radius=0, fg_color=("gray85", "gray17"))
@@ -162,6 +261,10 @@ class App(ctk.CTk):
         from tkinter import Menu
         menu = Menu(self, tearoff=0)
         menu.add_command(label="Clone Options...", command=self.open_clone_settings)
+        menu.add_command(label="Compare Options...", command=self.open_compare_settings)
+        menu.add_command(label="Path Filters...", command=self.open_filter_settings)
+        menu.add_command(label="Clear Hash Cache for Workspace", command=self.clear_workspace_cache)
+        menu.add_command(label="Task Statistics...", command=self.open_stats_window)
         
         # Appearance Mode (Light/Dark)
         theme_menu = Menu(menu, tearoff=0)
@@ -204,7 +307,11 @@ class App(ctk.CTk):
         data = {
             "server1": s1_data,
             "server2": s2_data,
-            "clone_options": {k: v.get() for k, v in self.clone_options.items()}
+            "clone_options": {k: v.get() for k, v in self.clone_options.items()},
+            "compare_options": {k: v.get() for k, v in self.compare_options.items()},
+            "sync_options": {k: v.get() for k, v in self.sync_options.items()},
+            "watch_options": {k: v.get() for k, v in self.watch_options.items()},
+            "filter_options": {k: v.get() for k, v in self.filter_options.items()}
         }
 
         try:
@@ -227,6 +334,7 @@ class App(ctk.CTk):
         try:
             with open(file_path, 'r') as f:
                 data = json.load(f)
+            path_filter.PathFilter.from_options(data.get("filter_options", {})) # Raises ValueError for a bad pattern
 
             s1_data = data.get("server1", {})
             s2_data = data.get("server2", {})
@@ -247,6 +355,22 @@ class App(ctk.CTk):
                  val = data["clone_enabled"]
                  for v in self.clone_options.values(): v.set(val)
 
+            for k, v in data.get("compare_options", {}).items():
+                if k in self.compare_options:
+                    self.compare_options[k].set(v)
+
+            for k, v in data.get("sync_options", {}).items():
+                if k in self.sync_options:
+                    self.sync_options[k].set(v)
+
+            for k, v in data.get("watch_options", {}).items():
+                if k in self.watch_options:
+                    self.watch_options[k].set(v)
+
+            for k, v in data.get("filter_options", {}).items():
+                if k in self.filter_options:
+                    self.filter_options[k].set(v)
+
             self.update_status(f"Workspace loaded from {os.path.basename(file_path)}")
         except Exception as e:
             self.show_error("Load Error", f"Could not load workspace:\n{e}")
@@ -306,6 +430,8 @@ class App(ctk.CTk):
 
         self.tree.bind('<<TreeviewSelect>>', self.on_tree_select)
         self.tree.bind('<Button-3>', self.show_tree_context_menu)
+        self.tree.bind('<Double-1>', lambda event: self.on_tree_activate(self.tree.identify_row(event.y)))
+        self.tree.bind('<Return>', lambda event: self.on_tree_activate(self.tree.focus()))
         
         self.update_treeview_style(ctk.get_appearance_mode())
         self.update_treeview_tag_colors(ctk.get_appearance_mode())
@@ -378,8 +504,9 @@ class App(ctk.CTk):
         s1_config = {k: v.get() for k, v in self.server1_vars.items()}
         s2_config = {k: v.get() for k, v in self.server2_vars.items()}
         
-        threading.Thread(target=sftp_logic.sync_single_file_task, args=(s1_config, s2_config, relative_path, self.result_queue), daemon=True).start()
-        self.after(100, self.check_single_sync_queue)
+        options = self.task_options(self.sync_options)
+        threading.Thread(target=sftp_logic.sync_single_file_task, args=(s1_config, s2_config, relative_path, self.result_queue, options), daemon=True).start()
+        self.dispatch_results(self.handle_single_sync_message)
 
     def sync_selected_files(self, item_ids):
         """Starts the batch sync process for selected files."""
@@ -397,55 +524,48 @@ class App(ctk.CTk):
         s1_config = {k: v.get() for k, v in self.server1_vars.items()}
         s2_config = {k: v.get() for k, v in self.server2_vars.items()}
         
-        threading.Thread(target=sftp_logic.sync_multiple_files_task, args=(s1_config, s2_config, files_to_sync, self.result_queue), daemon=True).start()
-        self.after(100, self.check_batch_sync_queue)
-
-    def check_single_sync_queue(self):
-        """Checks the queue for single file sync results."""
-        try:
-            result = self.result_queue.get_nowait()
-            
-            if isinstance(result, Exception):
-                self.show_error("Sync Error", f"An error occurred:\n{result}")
-                self.stop_loading()
-            elif isinstance(result, str):
-                 self.update_status(result)
-                 self.after(100, self.check_single_sync_queue)
-            elif isinstance(result, dict) and result.get('status') == 'single_sync_complete':
-                self.update_status(f"Synced {result.get('file')} successfully.")
-                self.stop_loading()
-                if messagebox.askyesno("Sync Complete", "File synced. Refresh comparison?", parent=self):
-                    self.start_comparison()
-        except queue.Empty:
-            self.after(100, self.check_single_sync_queue)
-        except Exception as e:
-            self.show_error("GUI Error", f"Error updating UI: {e}")
+        options = self.task_options(self.sync_options)
+        self.batch_sync_paths = files_to_sync
+        threading.Thread(target=sftp_logic.sync_multiple_files_task, args=(s1_config, s2_config, files_to_sync, self.result_queue, options), daemon=True).start()
+        self.dispatch_results(self.handle_batch_sync_message)
+
+    def dispatch_results(self, on_message):
+        """Routes the messages on result_queue to on_message until it returns True; status strings go to the status bar."""
+        if self.result_dispatcher:
+            self.result_dispatcher.stop()
+        self.result_dispatcher = QueueDispatcher(self, self.result_queue, on_message, on_status=self.update_status, on_error=self.on_gui_error).start()
+
+    def on_gui_error(self, error):
+        self.show_error("GUI Error", f"Error updating UI: {error}")
+        self.stop_loading()
+
+    def handle_single_sync_message(self, result):
+        """Handles a message of a single file sync. Returns True once the sync has finished."""
+        if isinstance(result, Exception):
+            self.show_error("Sync Error", f"An error occurred:\n{result}")
             self.stop_loading()
-
-    def check_batch_sync_queue(self):
-        """Checks the queue for batch sync results."""
-        try:
-            result = self.result_queue.get_nowait()
-            
-            if isinstance(result, Exception):
-                self.show_error("Sync Error", f"An error occurred:\n{result}")
-                self.stop_loading()
-            elif isinstance(result, str):
-                 self.update_status(result)
-                 self.after(100, self.check_batch_sync_queue)
-            elif isinstance(result, dict):
-                if result.get('status') == 'single_sync_complete':
-                    self.update_status(f"Synced {result.get('file')} successfully.")
-                    self.after(100, self.check_batch_sync_queue)
-                elif result.get('status') == 'batch_sync_complete':
-                    self.stop_loading()
-                    if messagebox.askyesno("Batch Sync Complete", "All selected files synced. Refresh comparison?", parent=self):
-                        self.start_comparison()
-        except queue.Empty:
-            self.after(100, self.check_batch_sync_queue)
-        except Exception as e:
-            self.show_error("GUI Error", f"Error updating UI: {e}")
+            return True
+        if isinstance(result, dict) and result.get('status') == 'single_sync_complete':
+            self.update_status(f"Synced {result.get('file')} successfully.")
+            self.stop_loading()
+            self.refresh_paths([result.get('file')])
+            return True
+        return False
+
+    def handle_batch_sync_message(self, result):
+        """Handles a message of a batch sync. Returns True once the batch has finished."""
+        if isinstance(result, Exception):
+            self.show_error("Sync Error", f"An error occurred:\n{result}")
             self.stop_loading()
+            return True
+        if isinstance(result, dict):
+            if result.get('status') == 'single_sync_complete':
+                self.update_status(f"Synced {result.get('file')} successfully.")
+            elif result.get('status') == 'batch_sync_complete':
+                self.stop_loading()
+                self.refresh_paths(self.batch_sync_paths)
+                return True
+        return False
 
     def update_treeview_style(self, mode):
         """Updates the ttk.Treeview style to match the CTk theme."""
@@ -521,8 +641,11 @@ class App(ctk.CTk):
             self.show_error("Error", "No file(s) selected.")
             return
 
-        # Extract item_values for all selected items
-        selected_items_data = [self.tree.item(item_id)['values'] for item_id in selected_item_ids]
+        # Extract item_values for all selected items; the identical files summary row is not a file
+        selected_items_data = [self.tree.item(item_id)['values'] for item_id in selected_item_ids if item_id != self.identical_summary]
+        if not selected_items_data:
+            self.show_error("Error", "No file(s) selected.")
+            return
 
         s1_config = {k: v.get() for k, v in self.server1_vars.items()}
         s2_config = {k: v.get() for k, v in self.server2_vars.items()}
@@ -544,9 +667,9 @@ class App(ctk.CTk):
 
         sync_top_level = ctk.CTkToplevel(self)
         sync_top_level.title("Synchronize TEST to PRODUCTION")
-        sync_top_level.geometry("600x550")
+        sync_top_level.geometry("600x840")
         sync_top_level.transient(self)
-        SyncWindow(sync_top_level, s1_config, s2_config, self.comparison_results, self.start_comparison)
+        SyncWindow(sync_top_level, s1_config, s2_config, self.comparison_results, {**self.sync_options, **self.filter_options}, self.refresh_paths)
 
     def open_clone_settings(self):
         """Opens the Clone Settings popup window."""
@@ -556,6 +679,56 @@ class App(ctk.CTk):
         clone_top_level.transient(self)
         CloneSettingsWindow(clone_top_level, self.clone_options, self.on_clone_input)
 
+    def open_compare_settings(self):
+        """Opens the Compare Settings popup window."""
+        compare_top_level = ctk.CTkToplevel(self)
+        compare_top_level.title("Compare Options")
+        compare_top_level.geometry("380x510")
+        compare_top_level.transient(self)
+        CompareSettingsWindow(compare_top_level, self.compare_options)
+
+    def open_filter_settings(self):
+        """Opens the Path Filters popup window."""
+        filter_top_level = ctk.CTkToplevel(self)
+        filter_top_level.title("Path Filters")
+        filter_top_level.geometry("460x560")
+        filter_top_level.transient(self)
+        FilterSettingsWindow(filter_top_level, self.filter_options, self.update_status)
+
+    def open_stats_window(self):
+        """Opens the Task Statistics window, or brings it forward if it is open."""
+        if self.stats_window is not None and self.stats_window.winfo_exists():
+            self.stats_window.parent_toplevel.lift()
+            return
+        stats_top_level = ctk.CTkToplevel(self)
+        stats_top_level.title("Task Statistics")
+        stats_top_level.geometry("640x520")
+        self.stats_window = StatsWindow(stats_top_level, self.task_runs, self.update_status)
+
+    def handle_task_metrics(self, metrics):
+        """Keeps the metrics of a finished background task for the stats window. Never finishes."""
+        self.task_runs.append(metrics)
+        if self.stats_window is not None and self.stats_window.winfo_exists():
+            self.stats_window.refresh()
+        return False
+
+    def task_options(self, option_vars):
+        """Returns the values of option_vars together with the path filters, as passed to the background tasks."""
+        return {k: v.get() for k, v in {**option_vars, **self.filter_options}.items()}
+
+    def clear_workspace_cache(self):
+        """Removes the cached hashes of both servers of the current workspace."""
+        s1 = {k: v.get() for k, v in self.server1_vars.items()}
+        s2 = {k: v.get() for k, v in self.server2_vars.items()}
+        if not messagebox.askyesno("Clear Hash Cache", f"Forget the cached hashes for {s1['host']}:{s1['path']} and {s2['host']}:{s2['path']}?\n\nThe next comparison will hash these files again.", parent=self):
+            return
+        try:
+            cache = hash_cache.get_default_cache()
+            removed = sum(cache.invalidate(cfg['host'], cfg['port'], cfg['path']) for cfg in (s1, s2))
+            self.update_status(f"Removed {removed} cached hashes for this workspace.")
+        except Exception as e:
+            self.show_error("Cache Error", f"Could not clear the hash cache:\n{e}")
+
     def update_status(self, message):
         """Thread-safe method to update the status label."""
         self.status_var.set(message)
@@ -569,35 +742,147 @@ class App(ctk.CTk):
         self.update_status("Starting comparison...")
         
         self.comparison_results = None
-        for i in self.tree.get_children():
-            self.tree.delete(i)
+        self.clear_results()
 
         s1 = {k: v.get() for k, v in self.server1_vars.items()}
         s2 = {k: v.get() for k, v in self.server2_vars.items()}
 
-        threading.Thread(target=sftp_logic.compare_folders_task, args=(s1, s2, self.result_queue), daemon=True).start()
-        self.after(100, self.check_queue)
+        options = self.task_options(self.compare_options)
 
-    def check_queue(self):
-        """Checks the result queue for updates from the thread."""
-        try:
-            result = self.result_queue.get_nowait()
-            
-            if isinstance(result, Exception):
-                self.show_error("Error", f"An error occurred:\n{result}")
-                self.stop_loading()
-            elif isinstance(result, str):
-                 self.update_status(result)
-                 self.after(100, self.check_queue)
-            elif isinstance(result, dict):
-                self.populate_results(result)
-                self.stop_loading()
-                self.update_status("Comparison complete.")
-        except queue.Empty:
-            self.after(100, self.check_queue)
-        except Exception as e:
-            self.show_error("GUI Error", f"Error updating UI: {e}")
+        threading.Thread(target=sftp_logic.compare_folders_task, args=(s1, s2, self.result_queue, options), daemon=True).start()
+        self.dispatch_results(self.handle_compare_message)
+
+    def refresh_paths(self, relative_paths):
+        """
+        Re-compares only the given paths, e.g. after a sync, and updates the results and their rows in place.
+        Runs a full comparison instead if there are no results yet or too many paths.
+        """
+        if not self.comparison_results or len(relative_paths) > REFRESH_MAX_PATHS:
+            self.start_comparison()
+            return
+        self.compare_button.configure(state="disabled")
+        self.progress_bar.start()
+        self.update_status(f"Re-checking {len(relative_paths)} synced paths...")
+
+        s1 = {k: v.get() for k, v in self.server1_vars.items()}
+        s2 = {k: v.get() for k, v in self.server2_vars.items()}
+        options = self.task_options(self.compare_options)
+
+        threading.Thread(target=sftp_logic.refresh_paths_task, args=(s1, s2, list(relative_paths), self.result_queue, options), daemon=True).start()
+        self.dispatch_results(self.handle_refresh_message)
+
+    def handle_refresh_message(self, result):
+        """Handles a message of the refresh task. Returns True once it has finished."""
+        if isinstance(result, Exception):
+            self.show_error("Error", f"An error occurred:\n{result}")
+            self.stop_loading()
+            return True
+        if isinstance(result, dict) and result.get('status') == 'refresh_complete':
+            results = self.comparison_results
+            verdicts = sftp_logic.patch_comparison_results(results, result)
+            for relative_path, verdict in verdicts.items():
+                if verdict:
+                    self.upsert_row(relative_path, *self.verdict_row(relative_path, verdict, results['files_s1'].get(relative_path), results['files_s2'].get(relative_path)))
+                else:
+                    self.remove_row(relative_path)
+            self.update_identical_summary()
+            has_changes = results['different'] or results['only_on_1'] or results['only_on_2']
+            self.sync_button.configure(state="normal" if has_changes else "disabled")
             self.stop_loading()
+            checked = sum(1 for verdict in verdicts.values() if verdict)
+            still_different = sum(1 for verdict in verdicts.values() if verdict not in ('identical', None))
+            if still_different:
+                self.update_status(f"Re-checked {checked} files: {still_different} still differ between TEST and PROD.")
+            else:
+                self.update_status(f"Re-checked {checked} files: TEST and PROD match.")
+            return True
+        return False
+
+    def handle_compare_message(self, result):
+        """Handles a message of the comparison task. Returns True once the comparison has finished."""
+        if isinstance(result, Exception):
+            self.show_error("Error", f"An error occurred:\n{result}")
+            self.stop_loading()
+            return True
+        if isinstance(result, dict) and result.get('status') == 'compare_verdicts':
+            for relative_path, verdict, meta1, meta2 in result['files']:
+                self.upsert_row(relative_path, *self.verdict_row(relative_path, verdict, meta1, meta2))
+            self.update_identical_summary()
+            return False
+        if isinstance(result, dict):
+            self.populate_results(result)
+            self.stop_loading()
+            self.update_status("Comparison complete.")
+            return True
+        return False
+
+    def toggle_watch(self):
+        if self.watch_var.get():
+            self.start_watch()
+        else:
+            self.stop_watch()
+            self.update_status("Drift watch stopped.")
+
+    def on_watch_interval_change(self, value):
+        """Restarts a running watch so the new interval applies right away."""
+        if self.watch_stop_event:
+            self.stop_watch()
+            self.start_watch()
+
+    def start_watch(self):
+        """
+        Compares the folders again in the background every chosen interval, starting from the
+        current results, and shows files that start or stop differing.
+        """
+        if not self.comparison_results:
+            self.watch_var.set(False)
+            self.show_error("Watch Error", "Please run a comparison first.")
+            return
+        s1 = {k: v.get() for k, v in self.server1_vars.items()}
+        s2 = {k: v.get() for k, v in self.server2_vars.items()}
+        options = self.task_options(self.compare_options)
+        interval = int(self.watch_options["interval"].get().split()[0]) * 60
+
+        self.watch_stop_event = threading.Event()
+        self.watch_queue = queue.Queue() # A stopped watch may still put its last messages on the old one
+        threading.Thread(target=sftp_logic.watch_folders_task, args=(s1, s2, self.watch_queue, self.watch_stop_event, interval, options, copy_results(self.comparison_results)), daemon=True).start()
+        self.watch_dispatcher = QueueDispatcher(self, self.watch_queue, self.handle_watch_message, on_status=self.update_status, on_error=self.on_gui_error).start()
+        self.update_status(f"Drift watch started: comparing every {self.watch_options['interval'].get()}.")
+
+    def stop_watch(self):
+        if self.watch_stop_event:
+            self.watch_stop_event.set()
+            self.watch_stop_event = None
+        if self.watch_dispatcher:
+            self.watch_dispatcher.stop()
+            self.watch_dispatcher = None
+
+    def handle_watch_message(self, result):
+        """Handles a message of the drift watch. Returns True once the watch has stopped."""
+        if isinstance(result, dict) and result.get('status') == 'watch_stopped':
+            return True
+        if not (isinstance(result, dict) and result.get('status') == 'watch_cycle'):
+            return False
+        results = result['results']
+        busy = self.result_dispatcher is not None and self.result_dispatcher.running
+        if result['changed'] and not busy: # A running comparison, sync or refresh brings its own results
+            self.populate_results(copy_results(results))
+        drifted = len(results['different']) + len(results['only_on_1']) + len(results['only_on_2'])
+        self.update_status(f"Watch: cycle {result['cycle']} took {result['seconds']:.1f} s, "
+                           f"{drifted} files differ between TEST and PROD. Next check in {self.watch_options['interval'].get()}.")
+        if result['added'] or result['removed']:
+            self.bell()
+            self.show_drift(result['added'], result['removed'])
+        return False
+
+    def show_drift(self, added, removed):
+        """Lists drift in the drift window, opening it if needed. The window is not modal."""
+        if self.drift_window is None or not self.drift_window.winfo_exists():
+            drift_top_level = ctk.CTkToplevel(self)
+            drift_top_level.title("Drift Detected")
+            drift_top_level.geometry("600x400")
+            self.drift_window = DriftWindow(drift_top_level)
+        self.drift_window.add_changes(added, removed)
 
     def stop_loading(self):
         """Stops progress bar and re-enables button."""
@@ -605,68 +890,151 @@ class App(ctk.CTk):
         self.progress_bar.set(0)
         self.compare_button.configure(state="normal")
 
+    def clear_results(self):
+        """Empties the Treeview and stops a population that is still running."""
+        self.population += 1
+        self.tree.delete(*self.tree.get_children())
+        self.row_ids = {}
+        self.collapsed_rows = {} if self.compare_options["collapse_identical"].get() else None
+        self.identical_summary = None
+
+    def verdict_row(self, relative_path, verdict, meta1, meta2):
+        """Returns the Treeview (values, tags) of a compared file; verdict is a key of the comparison results."""
+        if verdict == 'only_on_1':
+            return self.result_row("ONLY ON TEST", relative_path, meta1 or {}), ('solo_test',)
+        if verdict == 'only_on_2':
+            return self.result_row("ONLY ON PROD", relative_path, meta2 or {}), ('solo_prod',)
+        status, tag = ("DIFFERENT", 'different') if verdict == 'different' else ("IDENTICAL", 'identical')
+        return self.result_row(status, relative_path, meta1 or {}, meta2 or {}), (tag,)
+
+    def result_row(self, status, path, meta1, meta2=None):
+        """Returns the Treeview values of a file; with meta2, owner and permissions show TEST -> PROD changes."""
+        owner1, perms1_sym, perms1_oct = f"{meta1.get('owner', '?')}:{meta1.get('group', '?')}", meta1.get('mode', '?'), meta1.get('octal_mode', '?')
+        if meta2 is None:
+            return (status, path, owner1, perms1_sym, perms1_oct)
+        owner2, perms2_sym, perms2_oct = f"{meta2.get('owner', '?')}:{meta2.get('group', '?')}", meta2.get('mode', '?'), meta2.get('octal_mode', '?')
+        owner_str = owner1 if owner1 == owner2 else f"{owner1} -> {owner2}"
+        perms_sym_str = perms1_sym if perms1_sym == perms2_sym else f"{perms1_sym} -> {perms2_sym}"
+        perms_oct_str = perms1_oct if perms1_oct == perms2_oct else f"{perms1_oct} -> {perms2_oct}"
+        return (status, path, owner_str, perms_sym_str, perms_oct_str)
+
+    def upsert_row(self, relative_path, values, tags):
+        """
+        Adds or updates the row of a file. Identical files go behind the summary row while
+        identical files are collapsed; call update_identical_summary afterwards.
+        """
+        if self.collapsed_rows is not None and values[0] == "IDENTICAL":
+            self.remove_row(relative_path)
+            self.collapsed_rows[relative_path] = (values, tags)
+            return
+        if self.collapsed_rows is not None:
+            self.collapsed_rows.pop(relative_path, None)
+        if relative_path in self.row_ids:
+            iid, old_values = self.row_ids[relative_path]
+            if old_values != values:
+                self.tree.item(iid, values=values, tags=tags)
+                self.row_ids[relative_path] = (iid, values)
+        else:
+            self.row_ids[relative_path] = (self.tree.insert("", "end", values=values, tags=tags), values)
+
+    def remove_row(self, relative_path):
+        if relative_path in self.row_ids:
+            self.tree.delete(self.row_ids.pop(relative_path)[0])
+        if self.collapsed_rows is not None:
+            self.collapsed_rows.pop(relative_path, None)
+
+    def update_identical_summary(self):
+        """Shows the number of collapsed identical files in the summary row, kept as the last row."""
+        count = len(self.collapsed_rows or ())
+        if not count:
+            if self.identical_summary:
+                self.tree.delete(self.identical_summary)
+                self.identical_summary = None
+            return
+        values = (IDENTICAL_SUMMARY, f"{count} identical files (double-click to show)", "", "", "")
+        if self.identical_summary:
+            self.tree.item(self.identical_summary, values=values)
+            self.tree.move(self.identical_summary, "", "end")
+        else:
+            self.identical_summary = self.tree.insert("", "end", values=values, tags=('identical',))
+
     def populate_results(self, results):
-        """Fills the Treeview with comparison results."""
-        self.update_status("Populating results...")
+        """
+        Brings the Treeview in line with the final comparison results. Rows already streamed in
+        while comparing are kept (and updated if their verdict changed), so selections survive.
+        Rows are inserted in chunks from idle callbacks, so the window stays responsive with very
+        large folders. While identical files are collapsed, only their summary row is shown.
+        """
+        self.population += 1 # Only this population may still touch the rows
         self.comparison_results = results
-        
-        files_s1_meta = results.get('files_s1', {})
-        files_s2_meta = results.get('files_s2', {})
-        
-        for f in sorted(results['different']):
-            meta1, meta2 = files_s1_meta.get(f, {}), files_s2_meta.get(f, {})
-            owner1_str = f"{meta1.get('owner', '?')}:{meta1.get('group', '?')}"
-            perms1_sym = meta1.get('mode', '?')
-            perms1_oct = meta1.get('octal_mode', '?')
-            owner2_str = f"{meta2.get('owner', '?')}:{meta2.get('group', '?')}"
-            perms2_sym = meta2.get('mode', '?')
-            perms2_oct = meta2.get('octal_mode', '?')
-
-            owner_str = owner1_str if owner1_str == owner2_str else f"{owner1_str} -> {owner2_str}"
-            perms_sym_str = perms1_sym if perms1_sym == perms2_sym else f"{perms1_sym} -> {perms2_sym}"
-            perms_oct_str = perms1_oct if perms1_oct == perms2_oct else f"{perms1_oct} -> {perms2_oct}"
-            
-            self.tree.insert("", "end", values=("DIFFERENT", f, owner_str, perms_sym_str, perms_oct_str), tags=('different',))
-        
-        for f in sorted(results['only_on_1']):
-            meta = files_s1_meta.get(f, {})
-            owner = f"{meta.get('owner', '?')}:{meta.get('group', '?')}"
-            perms_sym = meta.get('mode', '?')
-            perms_oct = meta.get('octal_mode', '?')
-            self.tree.insert("", "end", values=("ONLY ON TEST", f, owner, perms_sym, perms_oct), tags=('solo_test',))
-
-        for f in sorted(results['only_on_2']):
-            meta = files_s2_meta.get(f, {})
-            owner = f"{meta.get('owner', '?')}:{meta.get('group', '?')}"
-            perms_sym = meta.get('mode', '?')
-            perms_oct = meta.get('octal_mode', '?')
-            self.tree.insert("", "end", values=("ONLY ON PROD", f, owner, perms_sym, perms_oct), tags=('solo_prod',))
-        
-        for f in sorted(results['identical']):
-            meta1 = files_s1_meta.get(f, {})
-            owner1_str = f"{meta1.get('owner', '?')}:{meta1.get('group', '?')}"
-            perms1_sym = meta1.get('mode', '?')
-            perms1_oct = meta1.get('octal_mode', '?')
-            
-            meta2 = files_s2_meta.get(f, {})
-            owner2_str = f"{meta2.get('owner', '?')}:{meta2.get('group', '?')}"
-            perms2_sym = meta2.get('mode', '?')
-            perms2_oct = meta2.get('octal_mode', '?')
-            
-            owner_str = owner1_str if owner1_str == owner2_str else f"{owner1_str} -> {owner2_str}"
-            perms_sym_str = perms1_sym if perms1_sym == perms2_sym else f"{perms1_sym} -> {perms2_sym}"
-            perms_oct_str = perms1_oct if perms1_oct == perms2_oct else f"{perms1_oct} -> {perms2_oct}"
-            
-            self.tree.insert("", "end", values=("IDENTICAL", f, owner_str, perms_sym_str, perms_oct_str), tags=('identical',))
+        files_s1_meta, files_s2_meta = results.get('files_s1', {}), results.get('files_s2', {})
+
+        final = {}
+        for verdict in ('different', 'only_on_1', 'only_on_2', 'identical'):
+            for f in sorted(results[verdict]):
+                final[f] = verdict
+        for relative_path in [p for p in self.row_ids if p not in final]:
+            self.remove_row(relative_path)
+        for relative_path in [p for p in (self.collapsed_rows or {}) if p not in final]:
+            self.remove_row(relative_path)
+
+        def rows():
+            for f, verdict in final.items():
+                yield (f,) + self.verdict_row(f, verdict, files_s1_meta.get(f), files_s2_meta.get(f))
+
+        def finished():
+            self.update_identical_summary()
+            has_changes = results['different'] or results['only_on_1'] or results['only_on_2']
+            if has_changes:
+                self.sync_button.configure(state="normal")
+            self.update_status(f"Done. Found {len(results['different'])} different files, "
+                               f"{len(results['only_on_1'])} only on TEST, {len(results['only_on_2'])} only on PROD.")
+
+        self.insert_rows_in_chunks(rows(), len(final), finished)
+
+    def insert_rows_in_chunks(self, rows, total, on_done):
+        """
+        Upserts (relative_path, values, tags) rows for up to TREE_CHUNK_BUDGET seconds per idle
+        callback, showing progress in the status bar, then calls on_done. Stops if another
+        population starts or clear_results is called.
+        """
+        population = self.population
+        done = 0
+
+        def insert_chunk():
+            nonlocal done
+            if population != self.population:
+                return
+            deadline = time.perf_counter() + TREE_CHUNK_BUDGET
+            for relative_path, values, tags in rows:
+                self.upsert_row(relative_path, values, tags)
+                done += 1
+                if time.perf_counter() >= deadline:
+                    self.progress_bar.set(done / max(1, total))
+                    self.update_status(f"Populating results... {done:,}/{total:,}")
+                    self.after_idle(insert_chunk)
+                    return
+            self.progress_bar.set(0)
+            on_done()
 
-        self.diff_button.configure(state="disabled")
-        
-        has_changes = results['different'] or results['only_on_1'] or results['only_on_2']
-        if has_changes:
-            self.sync_button.configure(state="normal")
-        
-        self.update_status(f"Done. Found {len(results['different'])} different files, "
-                           f"{len(results['only_on_1'])} only on TEST, {len(results['only_on_2'])} only on PROD.")
+        self.update_status("Populating results...")
+        insert_chunk()
+
+    def expand_identical_summary(self):
+        """Replaces the identical files summary row with the rows of the identical files."""
+        if not self.identical_summary:
+            return
+        collapsed = sorted(self.collapsed_rows.items())
+        self.collapsed_rows = None # Identical files found from now on get their own rows
+        self.tree.delete(self.identical_summary)
+        self.identical_summary = None
+        status_before = self.status_var.get()
+        self.insert_rows_in_chunks(((p,) + row for p, row in collapsed), len(collapsed), lambda: self.update_status(status_before))
+
+    def on_tree_activate(self, item_id):
+        """Expands the identical files summary row when it is double-clicked or Enter is pressed on it."""
+        if item_id and item_id == self.identical_summary:
+            self.expand_identical_summary()
 
     def show_error(self, title, message):
         """Shows a cross-platform error message."""
@@ -685,6 +1053,10 @@ class DiffWindow(ctk.CTkFrame):
         self.status, self.relative_path, self.owner_group, self.symbolic_perms, self.octal_perms = item_values
         
         self.diff_queue, self.file_contents, self.diff_result = queue.Queue(), {"TEST": None, "PROD": None}, []
+        self.diff_dispatcher = None
+        self.diff_cancel = threading.Event() # Set to abandon a diff that is still being calculated
+        self.inline_rows, self.inline_done = [], set() # Rows of replaced line pairs, and those highlighted so far
+        self.row_count = 0
 
         # Parse metadata for each server
         owner1, owner2 = (self.owner_group, self.owner_group) if " -> " not in self.owner_group else self.owner_group.split(" -> ")
@@ -731,13 +1103,14 @@ class DiffWindow(ctk.CTkFrame):
         self.lines2 = self.configure_line_number_tags(self.lines2)
 
         self.bind("<Configure>", self.update_tags_for_theme, add="+")
+        self.bind("<Destroy>", lambda event: self.diff_cancel.set(), add="+")
         self.update_tags_for_theme()
 
         self.toggle_metadata_visibility() # Set initial state
 
         threading.Thread(target=sftp_logic.download_file_task, args=(self.s1_config, self.relative_path, self.diff_queue, "TEST"), daemon=True).start()
         threading.Thread(target=sftp_logic.download_file_task, args=(self.s2_config, self.relative_path, self.diff_queue, "PROD"), daemon=True).start()
-        self.after(100, self.check_diff_queue)
+        self.dispatch_diff()
 
     def open_editor(self, server_name):
         content = self.file_contents.get(server_name)
@@ -757,6 +1130,9 @@ class DiffWindow(ctk.CTkFrame):
     def refresh_diff(self):
         """Reloads the files and refreshes the diff."""
         self.status_var.set("Reloading files...")
+        self.diff_cancel.set()
+        self.diff_cancel = threading.Event()
+        self.diff_queue = queue.Queue() # A cancelled diff may still put its result on the old one
         self.file_contents = {"TEST": None, "PROD": None}
         self.diff_result = []
         
@@ -766,7 +1142,7 @@ class DiffWindow(ctk.CTkFrame):
         
         threading.Thread(target=sftp_logic.download_file_task, args=(self.s1_config, self.relative_path, self.diff_queue, "TEST"), daemon=True).start()
         threading.Thread(target=sftp_logic.download_file_task, args=(self.s2_config, self.relative_path, self.diff_queue, "PROD"), daemon=True).start()
-        self.after(100, self.check_diff_queue)
+        self.dispatch_diff()
 
     def create_text_pane(self, parent, title, owner_info, perms_info):
         frame = ctk.CTkFrame(parent, border_width=1)
@@ -833,35 +1209,44 @@ class DiffWindow(ctk.CTkFrame):
 
     def on_text_scroll_1(self, first, last):
         self.main_scrollbar.set(first, last); self.text2.yview_moveto(first); self.lines1.yview_moveto(first); self.lines2.yview_moveto(first)
+        self.highlight_visible(first, last)
 
     def on_text_scroll_2(self, first, last):
         self.main_scrollbar.set(first, last); self.text1.yview_moveto(first); self.lines1.yview_moveto(first); self.lines2.yview_moveto(first)
-
-    def check_diff_queue(self):
-        try:
-            result = self.diff_queue.get_nowait()
-            if isinstance(result, Exception):
-                messagebox.showerror("Download Error", f"Failed to download file:\n{result}", parent=self)
-                self.status_var.set("Download error.")
-            elif isinstance(result, str):
-                 self.status_var.set(result)
-            elif isinstance(result, dict):
-                self.file_contents[result['server']] = result['content']
-                self.status_var.set(f"Downloaded {result['server']} file.")
-
-            if self.file_contents["TEST"] is not None and self.file_contents["PROD"] is not None:
-                self.status_var.set("Files downloaded. Calculating diff...")
-                s1_lines, s2_lines = self.file_contents["TEST"].splitlines(), self.file_contents["PROD"].splitlines()
-                self.diff_result = list(difflib.ndiff(s1_lines, s2_lines))
-                self.populate_diff()
-                self.status_var.set("Diff complete.")
-                return
-            self.after(100, self.check_diff_queue)
-        except queue.Empty:
-            self.after(100, self.check_diff_queue)
-        except Exception as e:
-            messagebox.showerror("GUI Error", f"Error in diff queue: {e}", parent=self)
-            self.status_var.set("GUI Error.")
+        self.highlight_visible(first, last)
+
+    def dispatch_diff(self):
+        if self.diff_dispatcher:
+            self.diff_dispatcher.stop()
+        self.diff_dispatcher = QueueDispatcher(self, self.diff_queue, self.handle_diff_message, on_status=self.status_var.set, on_error=self.on_diff_error).start()
+
+    def on_diff_error(self, error):
+        messagebox.showerror("GUI Error", f"Error in diff queue: {error}", parent=self)
+        self.status_var.set("GUI Error.")
+
+    def handle_diff_message(self, result):
+        """
+        Handles a message of the downloads and of the diff, which is calculated in the background once
+        both files are in. Returns True once the diff is shown.
+        """
+        if isinstance(result, Exception):
+            messagebox.showerror("Diff Error", f"Failed to load the diff:\n{result}", parent=self)
+            self.status_var.set("Download error." if self.file_contents["TEST"] is None or self.file_contents["PROD"] is None else "Diff error.")
+            return False
+        if not isinstance(result, dict):
+            return False
+        if result.get('status') == 'diff_complete':
+            self.diff_result = result['diff']
+            self.populate_diff()
+            self.status_var.set("Diff complete.")
+            return True
+
+        self.file_contents[result['server']] = result['content']
+        self.status_var.set(f"Downloaded {result['server']} file.")
+        if self.file_contents["TEST"] is not None and self.file_contents["PROD"] is not None:
+            self.status_var.set("Files downloaded. Calculating diff...")
+            threading.Thread(target=diff_engine.diff_task, args=(self.file_contents["TEST"], self.file_contents["PROD"], self.diff_queue, self.diff_cancel), daemon=True).start()
+        return False
 
     def populate_diff(self):
         if not self.diff_result: return
@@ -874,45 +1259,62 @@ class DiffWindow(ctk.CTkFrame):
             self.lines1.grid_forget()
             self.lines2.grid_forget()
 
-        for widget in [self.text1, self.text2, self.lines1, self.lines2]:
-            widget.configure(state="normal")
-            widget.delete('1.0', "end")
+        # Consecutive rows with the same tag are inserted as one run, which keeps large diffs fast
+        runs = {widget: [] for widget in (self.text1, self.text2, self.lines1, self.lines2)}
+        def add(widget, text, tag):
+            widget_runs = runs[widget]
+            if widget_runs and widget_runs[-1][1] == tag: widget_runs[-1][0].append(text)
+            else: widget_runs.append(([text], tag))
 
-        i, line_num_1, line_num_2 = 0, 1, 1
+        self.inline_rows, self.inline_done = [], set()
+        i, line_num_1, line_num_2, row = 0, 1, 1, 1
         while i < len(self.diff_result):
             line = self.diff_result[i]
             if line.startswith(' '):
-                self.text1.insert("end", line[2:] + '\n'); self.text2.insert("end", line[2:] + '\n')
-                self.lines1.insert("end", f"{line_num_1}\n", 'line'); self.lines2.insert("end", f"{line_num_2}\n", 'line')
+                add(self.text1, line[2:] + '\n', None); add(self.text2, line[2:] + '\n', None)
+                add(self.lines1, f"{line_num_1}\n", 'line'); add(self.lines2, f"{line_num_2}\n", 'line')
                 line_num_1 += 1; line_num_2 += 1; i += 1
             elif (highlight_on and line.startswith('- ') and (i + 1 < len(self.diff_result)) and self.diff_result[i+1].startswith('+ ')):
-                line1_text, line2_text = line[2:], self.diff_result[i+1][2:]
-                self.text1.insert("end", line1_text + '\n', 'removed'); self.text2.insert("end", line2_text + '\n', 'added')
-                self.lines1.insert("end", f"{line_num_1}\n", 'line'); self.lines2.insert("end", f"{line_num_2}\n", 'line')
-                self.apply_inline_tags(line1_text, line2_text)
+                add(self.text1, line[2:] + '\n', 'removed'); add(self.text2, self.diff_result[i+1][2:] + '\n', 'added')
+                add(self.lines1, f"{line_num_1}\n", 'line'); add(self.lines2, f"{line_num_2}\n", 'line')
+                self.inline_rows.append(row) # Highlighted once scrolled into view, see highlight_visible
                 line_num_1 += 1; line_num_2 += 1; i += 2
             elif line.startswith('- '):
-                self.text1.insert("end", line[2:] + '\n', 'removed'); self.text2.insert("end", '\n', 'blank')
-                self.lines1.insert("end", f"{line_num_1}\n", 'line'); self.lines2.insert("end", '\n', 'blank')
+                add(self.text1, line[2:] + '\n', 'removed'); add(self.text2, '\n', 'blank')
+                add(self.lines1, f"{line_num_1}\n", 'line'); add(self.lines2, '\n', 'blank')
                 line_num_1 += 1; i += 1
             elif line.startswith('+ '):
-                self.text1.insert("end", '\n', 'blank'); self.text2.insert("end", line[2:] + '\n', 'added')
-                self.lines1.insert("end", '\n', 'blank'); self.lines2.insert("end", f"{line_num_2}\n", 'line')
+                add(self.text1, '\n', 'blank'); add(self.text2, line[2:] + '\n', 'added')
+                add(self.lines1, '\n', 'blank'); add(self.lines2, f"{line_num_2}\n", 'line')
                 line_num_2 += 1; i += 1
-            else: i += 1 
-        for widget in [self.text1, self.text2, self.lines1, self.lines2]: widget.configure(state="disabled")
-
-    def apply_inline_tags(self, line1, line2):
-        s = difflib.SequenceMatcher(None, line1, line2, autojunk=False)
-        line1_start, line2_start = self.text1.index(f"end - {len(line1) + 1}c"), self.text2.index(f"end - {len(line2) + 1}c")
-        for tag, i1, i2, j1, j2 in s.get_opcodes():
-            if tag == 'replace':
-                self.text1.tag_add('highlight_inline', f"{line1_start} + {i1}c", f"{line1_start} + {i2}c")
-                self.text2.tag_add('highlight_inline', f"{line2_start} + {j1}c", f"{line2_start} + {j2}c")
-            elif tag == 'delete':
-                self.text1.tag_add('highlight_inline', f"{line1_start} + {i1}c", f"{line1_start} + {i2}c")
-            elif tag == 'insert':
-                self.text2.tag_add('highlight_inline', f"{line2_start} + {j1}c", f"{line2_start} + {j2}c")
+            else: i += 1; continue
+            row += 1
+        self.row_count = row - 1
+
+        for widget, widget_runs in runs.items():
+            widget.configure(state="normal")
+            widget.delete('1.0', "end")
+            for texts, tag in widget_runs: widget.insert("end", ''.join(texts), tag)
+        for widget in runs: widget.configure(state="disabled")
+        self.highlight_visible(*self.text1.yview())
+
+    def highlight_visible(self, first, last):
+        """Highlights the inline differences of the replaced line pairs between the scroll fractions first and last."""
+        if not self.inline_rows or not self.row_count: return
+        top = int(float(first) * self.row_count)
+        bottom = int(float(last) * self.row_count) + 2
+        for index in range(bisect.bisect_left(self.inline_rows, top), bisect.bisect_right(self.inline_rows, bottom)):
+            row = self.inline_rows[index]
+            if row in self.inline_done: continue
+            self.inline_done.add(row)
+            self.apply_inline_tags(row, self.text1.get(f"{row}.0", f"{row}.end"), self.text2.get(f"{row}.0", f"{row}.end"))
+
+    def apply_inline_tags(self, row, line1, line2):
+        for tag, i1, i2, j1, j2 in diff_engine.intraline(line1, line2):
+            if tag in ('replace', 'delete'):
+                self.text1.tag_add('highlight_inline', f"{row}.{i1}", f"{row}.{i2}")
+            if tag in ('replace', 'insert'):
+                self.text2.tag_add('highlight_inline', f"{row}.{j1}", f"{row}.{j2}")
 
 
 class CloneSettingsWindow(ctk.CTkFrame):
@@ -952,6 +1354,187 @@ class CloneSettingsWindow(ctk.CTkFrame):
         ctk.CTkButton(self, text="Close", command=parent_toplevel.destroy).pack(pady=(20, 0))
 
 
+class CompareSettingsWindow(ctk.CTkFrame):
+    """
+    A Toplevel window for managing compare options.
+    """
+    def __init__(self, parent_toplevel, compare_options):
+        super().__init__(parent_toplevel)
+        self.pack(fill="both", expand=True, padx=10, pady=10)
+
+        self.compare_options = compare_options
+
+        ctk.CTkLabel(self, text="How files are compared:", font=ctk.CTkFont(weight="bold")).pack(pady=(0, 10))
+
+        ctk.CTkCheckBox(self, text="Hash files on the server (md5sum/sha256sum)", variable=self.compare_options["remote_hash"]).pack(anchor="w", pady=5, padx=20)
+
+        algo_frame = ctk.CTkFrame(self, fg_color="transparent")
+        algo_frame.pack(anchor="w", pady=5, padx=20)
+        ctk.CTkLabel(algo_frame, text="Hash algorithm:").pack(side="left", padx=(0, 10))
+        ctk.CTkOptionMenu(algo_frame, variable=self.compare_options["hash_algo"], values=list(sftp_logic.REMOTE_HASH_TOOLS), width=100).pack(side="left")
+
+        ctk.CTkCheckBox(self, text="Quick compare (size and modification time first)", variable=self.compare_options["quick"]).pack(anchor="w", pady=5, padx=20)
+        ctk.CTkCheckBox(self, text="Strict: hash files even if size and time match", variable=self.compare_options["strict"]).pack(anchor="w", pady=5, padx=20)
+        ctk.CTkCheckBox(self, text="Reuse cached hashes of unchanged files", variable=self.compare_options["use_cache"]).pack(anchor="w", pady=5, padx=20)
+        ctk.CTkCheckBox(self, text="Skip unchanged folders (list with python3 on the server)", variable=self.compare_options["dir_digests"]).pack(anchor="w", pady=5, padx=20)
+
+        workers_frame = ctk.CTkFrame(self, fg_color="transparent")
+        workers_frame.pack(anchor="w", pady=5, padx=20)
+        ctk.CTkLabel(workers_frame, text="Parallel channels per server:").pack(side="left", padx=(0, 10))
+        ctk.CTkOptionMenu(workers_frame, variable=self.compare_options["scan_workers"], values=[str(n) for n in range(1, sftp_logic.MAX_SCAN_WORKERS + 1)], width=70).pack(side="left")
+
+        chunk_frame = ctk.CTkFrame(self, fg_color="transparent")
+        chunk_frame.pack(anchor="w", pady=5, padx=20)
+        ctk.CTkLabel(chunk_frame, text="Local hashing chunk (KiB):").pack(side="left", padx=(0, 10))
+        ctk.CTkOptionMenu(chunk_frame, variable=self.compare_options["hash_chunk_kib"], values=["256", "1024", "4096", "16384"], width=90).pack(side="left")
+
+        ctk.CTkLabel(self, text="Results:", font=ctk.CTkFont(weight="bold")).pack(pady=(10, 5))
+        ctk.CTkCheckBox(self, text="Collapse identical files into one row", variable=self.compare_options["collapse_identical"]).pack(anchor="w", pady=5, padx=20)
+
+        ctk.CTkButton(self, text="Close", command=parent_toplevel.destroy).pack(pady=(20, 0))
+
+
+class DriftWindow(ctk.CTkFrame):
+    """
+    A Toplevel window listing the files the drift watch saw start or stop differing between TEST and PROD.
+    """
+    def __init__(self, parent_toplevel):
+        super().__init__(parent_toplevel)
+        self.pack(fill="both", expand=True, padx=10, pady=10)
+        self.parent_toplevel = parent_toplevel
+
+        ctk.CTkLabel(self, text="Changes found by the drift watch:", font=ctk.CTkFont(weight="bold")).pack(anchor="w", pady=(0, 10))
+        self.textbox = ctk.CTkTextbox(self, wrap="none")
+        self.textbox.pack(fill="both", expand=True)
+        self.textbox.configure(state="disabled")
+
+        ctk.CTkButton(self, text="Close", command=parent_toplevel.destroy).pack(pady=(10, 0))
+
+    def add_changes(self, added, removed):
+        """Appends one timestamped block of changes and brings the window forward."""
+        lines = [f"--- {time.strftime('%H:%M:%S')} ---"]
+        lines += [f"Now differs:       {f}" for f in added]
+        lines += [f"No longer differs: {f}" for f in removed]
+        self.textbox.configure(state="normal")
+        self.textbox.insert("end", "\n".join(lines) + "\n\n")
+        self.textbox.see("end")
+        self.textbox.configure(state="disabled")
+        self.parent_toplevel.lift()
+
+
+class StatsWindow(ctk.CTkFrame):
+    """
+    A Toplevel window showing where the recent background tasks spent their time: phases per server,
+    counters and SFTP round trips. The runs can be exported as JSON or as a Chrome trace.
+    """
+    def __init__(self, parent_toplevel, runs, status_callback):
+        super().__init__(parent_toplevel)
+        self.pack(fill="both", expand=True, padx=10, pady=10)
+        self.parent_toplevel = parent_toplevel
+        self.runs = runs # The App's deque of TaskMetrics, newest last
+        self.status_callback = status_callback
+
+        top_frame = ctk.CTkFrame(self, fg_color="transparent")
+        top_frame.pack(fill="x", pady=(0, 10))
+        ctk.CTkLabel(top_frame, text="Task run:", font=ctk.CTkFont(weight="bold")).pack(side="left")
+        self.run_var = ctk.StringVar()
+        self.run_menu = ctk.CTkOptionMenu(top_frame, variable=self.run_var, values=[""], width=360, command=lambda _: self.show_run())
+        self.run_menu.pack(side="left", padx=10)
+
+        self.textbox = ctk.CTkTextbox(self, wrap="none", font=ctk.CTkFont(family="Courier New"))
+        self.textbox.pack(fill="both", expand=True)
+
+        button_frame = ctk.CTkFrame(self, fg_color="transparent")
+        button_frame.pack(pady=(10, 0))
+        ctk.CTkButton(button_frame, text="Export JSON...", command=self.export_json).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Export Chrome Trace...", command=self.export_trace).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Close", command=parent_toplevel.destroy, fg_color="gray").pack(side="left", padx=5)
+        self.refresh()
+
+    def run_labels(self):
+        """Returns one label per run, newest first."""
+        return [f"{len(self.runs) - i}. {metrics.task} ({metrics.seconds or 0:.2f} s)" for i, metrics in enumerate(reversed(self.runs))]
+
+    def refresh(self):
+        """Lists the runs again and shows the newest one."""
+        labels = self.run_labels()
+        self.run_menu.configure(values=labels or ["No tasks finished yet"])
+        self.run_var.set(labels[0] if labels else "No tasks finished yet")
+        self.show_run()
+
+    def show_run(self):
+        labels = self.run_labels()
+        if self.run_var.get() in labels:
+            lines = list(reversed(self.runs))[labels.index(self.run_var.get())].describe()
+        else:
+            lines = ["Compare, sync or back up to see where the time goes."]
+        self.textbox.configure(state="normal")
+        self.textbox.delete("1.0", "end")
+        self.textbox.insert("1.0", "\n".join(lines))
+        self.textbox.configure(state="disabled")
+
+    def export_json(self):
+        self._export("Export Task Statistics", ".json", task_metrics.save_json)
+
+    def export_trace(self):
+        self._export("Export Chrome Trace", ".trace.json", task_metrics.save_chrome_trace)
+
+    def _export(self, title, extension, save):
+        if not self.runs:
+            messagebox.showinfo(title, "No tasks have finished yet.", parent=self)
+            return
+        file_path = filedialog.asksaveasfilename(parent=self, title=title, defaultextension=extension,
+                                                 filetypes=(("JSON Files", "*.json"), ("All Files", "*.*")))
+        if not file_path:
+            return
+        try:
+            save(list(self.runs), file_path)
+            self.status_callback(f"Exported {len(self.runs)} task runs to {os.path.basename(file_path)}")
+        except Exception as e:
+            messagebox.showerror(title, f"Could not export:\n{e}", parent=self)
+
+
+class FilterSettingsWindow(ctk.CTkFrame):
+    """
+    A Toplevel window for editing the path filters of the workspace.
+    """
+    def __init__(self, parent_toplevel, filter_options, status_callback):
+        super().__init__(parent_toplevel)
+        self.pack(fill="both", expand=True, padx=10, pady=10)
+        self.parent_toplevel = parent_toplevel
+        self.filter_options = filter_options
+        self.status_callback = status_callback
+
+        ctk.CTkLabel(self, text="Exclude (one .gitignore pattern per line):", font=ctk.CTkFont(weight="bold")).pack(anchor="w", pady=(0, 5))
+        ctk.CTkLabel(self, text="e.g. .git/   node_modules/   *.log   /cache/**   !keep.log", text_color="gray").pack(anchor="w")
+        self.exclude_box = ctk.CTkTextbox(self, height=180)
+        self.exclude_box.pack(fill="both", expand=True, pady=5)
+        self.exclude_box.insert("1.0", self.filter_options["exclude"].get())
+
+        ctk.CTkLabel(self, text="Include only (leave empty for everything):", font=ctk.CTkFont(weight="bold")).pack(anchor="w", pady=(10, 5))
+        ctk.CTkLabel(self, text="e.g. /src/   /public/**/*.php", text_color="gray").pack(anchor="w")
+        self.include_box = ctk.CTkTextbox(self, height=100)
+        self.include_box.pack(fill="both", expand=True, pady=5)
+        self.include_box.insert("1.0", self.filter_options["include"].get())
+
+        button_frame = ctk.CTkFrame(self, fg_color="transparent")
+        button_frame.pack(pady=(10, 0))
+        ctk.CTkButton(button_frame, text="Save", command=self.save).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Cancel", command=parent_toplevel.destroy, fg_color="gray").pack(side="left", padx=5)
+
+    def save(self):
+        exclude, include = self.exclude_box.get("1.0", "end").strip(), self.include_box.get("1.0", "end").strip()
+        try:
+            path_filter.PathFilter(exclude, include)
+        except ValueError as e:
+            messagebox.showerror("Invalid Pattern", str(e), parent=self)
+            return
+        self.filter_options["exclude"].set(exclude)
+        self.filter_options["include"].set(include)
+        self.status_callback("Path filters saved. Compare again to apply them to the results.")
+        self.parent_toplevel.destroy()
+
+
 class AttributesWindow(ctk.CTkFrame):
     """
     A Toplevel window for changing file owner and permissions.
@@ -1070,63 +1653,57 @@ class AttributesWindow(ctk.CTkFrame):
             threading.Thread(target=sftp_logic.get_all_users_task, args=(self.s2_config, self.user_queue, "PROD"), daemon=True).start()
             threading.Thread(target=sftp_logic.get_all_groups_task, args=(self.s2_config, self.group_queue, "PROD"), daemon=True).start()
 
-        if self.user_fetch_tasks > 0: self.after(100, self.check_user_queue)
+        if self.user_fetch_tasks > 0: QueueDispatcher(self, self.user_queue, self.handle_user_message, on_error=self.on_user_list_error).start()
         else: self.owner_menu.configure(state="normal", values=[self.owner_var.get()])
         
-        if self.group_fetch_tasks > 0: self.after(100, self.check_group_queue)
+        if self.group_fetch_tasks > 0: QueueDispatcher(self, self.group_queue, self.handle_group_message, on_error=self.on_group_list_error).start()
         else: self.group_menu.configure(state="normal", values=[self.group_var.get()])
 
-    def check_user_queue(self):
-        """Checks the queue for user lists from the threads."""
-        try:
-            result = self.user_queue.get_nowait()
-            if isinstance(result, Exception):
-                self.show_error("Fetch Users Error", f"Failed to get user list:\n{result}")
-                self.user_fetch_tasks -= 1
-            elif isinstance(result, dict) and 'users' in result:
-                self.all_users.update(result['users'])
-                self.user_fetch_tasks -= 1
-
-            if self.user_fetch_tasks <= 0:
-                if self.all_users:
-                    sorted_users = sorted(list(self.all_users))
-                    self.owner_menu.configure(state="normal", values=sorted_users)
-                    current = self.owner_var.get()
-                    self.owner_menu.set(current if current in sorted_users else sorted_users[0])
-                else: self.owner_menu.configure(state="normal", values=[self.owner_var.get()])
-                return
-            self.after(100, self.check_user_queue)
-        except queue.Empty:
-            self.after(100, self.check_user_queue)
-        except Exception as e:
-            self.show_error("GUI Error", f"Error processing user list: {e}")
-            self.owner_menu.configure(state="normal", values=[self.owner_var.get()])
-
-    def check_group_queue(self):
-        """Checks the queue for group lists from the threads."""
-        try:
-            result = self.group_queue.get_nowait()
-            if isinstance(result, Exception):
-                self.show_error("Fetch Groups Error", f"Failed to get group list:\n{result}")
-                self.group_fetch_tasks -= 1
-            elif isinstance(result, dict) and 'groups' in result:
-                self.all_groups.update(result['groups'])
-                self.group_fetch_tasks -= 1
-
-            if self.group_fetch_tasks <= 0:
-                if self.all_groups:
-                    sorted_groups = sorted(list(self.all_groups))
-                    self.group_menu.configure(state="normal", values=sorted_groups)
-                    current = self.group_var.get()
-                    self.group_menu.set(current if current in sorted_groups else sorted_groups[0])
-                else: self.group_menu.configure(state="normal", values=[self.group_var.get()])
-                return
-            self.after(100, self.check_group_queue)
-        except queue.Empty:
-            self.after(100, self.check_group_queue)
-        except Exception as e:
-            self.show_error("GUI Error", f"Error processing group list: {e}")
-            self.group_menu.configure(state="normal", values=[self.group_var.get()])
+    def handle_user_message(self, result):
+        """Handles a user list from the threads. Returns True once all lists are in."""
+        if isinstance(result, Exception):
+            self.show_error("Fetch Users Error", f"Failed to get user list:\n{result}")
+            self.user_fetch_tasks -= 1
+        elif isinstance(result, dict) and 'users' in result:
+            self.all_users.update(result['users'])
+            self.user_fetch_tasks -= 1
+
+        if self.user_fetch_tasks <= 0:
+            if self.all_users:
+                sorted_users = sorted(list(self.all_users))
+                self.owner_menu.configure(state="normal", values=sorted_users)
+                current = self.owner_var.get()
+                self.owner_menu.set(current if current in sorted_users else sorted_users[0])
+            else: self.owner_menu.configure(state="normal", values=[self.owner_var.get()])
+            return True
+        return False
+
+    def on_user_list_error(self, error):
+        self.show_error("GUI Error", f"Error processing user list: {error}")
+        self.owner_menu.configure(state="normal", values=[self.owner_var.get()])
+
+    def handle_group_message(self, result):
+        """Handles a group list from the threads. Returns True once all lists are in."""
+        if isinstance(result, Exception):
+            self.show_error("Fetch Groups Error", f"Failed to get group list:\n{result}")
+            self.group_fetch_tasks -= 1
+        elif isinstance(result, dict) and 'groups' in result:
+            self.all_groups.update(result['groups'])
+            self.group_fetch_tasks -= 1
+
+        if self.group_fetch_tasks <= 0:
+            if self.all_groups:
+                sorted_groups = sorted(list(self.all_groups))
+                self.group_menu.configure(state="normal", values=sorted_groups)
+                current = self.group_var.get()
+                self.group_menu.set(current if current in sorted_groups else sorted_groups[0])
+            else: self.group_menu.configure(state="normal", values=[self.group_var.get()])
+            return True
+        return False
+
+    def on_group_list_error(self, error):
+        self.show_error("GUI Error", f"Error processing group list: {error}")
+        self.group_menu.configure(state="normal", values=[self.group_var.get()])
 
     def start_change_task(self):
         """Starts the background task to change attributes for all selected files."""
@@ -1148,46 +1725,42 @@ class AttributesWindow(ctk.CTkFrame):
                 self.tasks_running += 1
                 threading.Thread(target=sftp_logic.change_attributes_task, args=(self.s2_config, relative_path, owner, group, perms_str, self.change_queue, f"PROD:{relative_path}"), daemon=True).start()
 
-        if self.tasks_running > 0: self.after(100, self.check_change_queue)
+        if self.tasks_running > 0: QueueDispatcher(self, self.change_queue, self.handle_change_message, on_error=self.on_change_error).start()
         else: self.status_callback("No servers selected or no relevant files on selected servers."); self.stop_loading()
 
-    def check_change_queue(self):
-        """Checks the queue for updates from the attribute change thread."""
-        try:
-            result = self.change_queue.get_nowait()
-            
-            if isinstance(result, str):
-                if result.endswith(":Success"):
-                    self.tasks_running -= 1
-                    self.status_callback(f"Applied: {result.replace(':Success', '')}")
-                elif result.startswith("Error:"):
-                    self.tasks_running -= 1
-                    # Extract server_name and error message
-                    parts = result.split(':', 2) # Split at most twice
-                    server_info = parts[1] if len(parts) > 1 else "Unknown"
-                    error_msg = parts[2] if len(parts) > 2 else result
-                    self.show_error(f"Error on {server_info}", error_msg)
-                else:
-                    # General status update from sftp_logic (e.g., "Connecting...")
-                    self.status_callback(result)
-            elif isinstance(result, Exception):
+    def handle_change_message(self, result):
+        """Handles a message of the attribute change threads. Returns True once all of them have finished."""
+        # Status strings are not coalesced here: ":Success" and "Error:" strings count finished tasks
+        if isinstance(result, str):
+            if result.endswith(":Success"):
                 self.tasks_running -= 1
-                self.show_error("Error", f"An unexpected error occurred:\n{result}")
-            
-            if self.tasks_running <= 0:
-                self.status_callback("All changes processed. Refreshing...")
-                self.stop_loading()
-                if self.refresh_callback:
-                    self.refresh_callback()
-                self.parent_toplevel.after(1000, self.parent_toplevel.destroy) # Close after 1s
+                self.status_callback(f"Applied: {result.replace(':Success', '')}")
+            elif result.startswith("Error:"):
+                self.tasks_running -= 1
+                # Extract server_name and error message
+                parts = result.split(':', 2) # Split at most twice
+                server_info = parts[1] if len(parts) > 1 else "Unknown"
+                error_msg = parts[2] if len(parts) > 2 else result
+                self.show_error(f"Error on {server_info}", error_msg)
             else:
-                self.after(100, self.check_change_queue)
-
-        except queue.Empty:
-            self.after(100, self.check_change_queue)
-        except Exception as e:
-            self.show_error("GUI Error", f"Error updating UI: {e}")
+                # General status update from sftp_logic (e.g., "Connecting...")
+                self.status_callback(result)
+        elif isinstance(result, Exception):
+            self.tasks_running -= 1
+            self.show_error("Error", f"An unexpected error occurred:\n{result}")
+        
+        if self.tasks_running <= 0:
+            self.status_callback("All changes processed. Refreshing...")
             self.stop_loading()
+            if self.refresh_callback:
+                self.refresh_callback()
+            self.parent_toplevel.after(1000, self.parent_toplevel.destroy) # Close after 1s
+            return True
+        return False
+
+    def on_change_error(self, error):
+        self.show_error("GUI Error", f"Error updating UI: {error}")
+        self.stop_loading()
 
     def stop_loading(self):
         self.apply_button.configure(state="normal")
@@ -1199,15 +1772,18 @@ class SyncWindow(ctk.CTkFrame):
     """
     A Toplevel window for managing the synchronization from TEST to PROD.
     """
-    def __init__(self, parent_toplevel, s1_config, s2_config, results, refresh_callback):
+    def __init__(self, parent_toplevel, s1_config, s2_config, results, sync_options, refresh_callback):
         super().__init__(parent_toplevel)
         self.pack(fill="both", expand=True)
 
         self.parent_toplevel = parent_toplevel
         self.s1_config, self.s2_config = s1_config, s2_config
         self.results = results
+        self.sync_options = sync_options
         self.refresh_callback = refresh_callback
         self.sync_queue = queue.Queue()
+        self.sync_dispatcher = None
+        self.touched_paths = [] # Paths the sync may change, re-checked by refresh_callback afterwards
 
         # --- Layout ---
         self.grid_columnconfigure(0, weight=1)
@@ -1251,6 +1827,24 @@ class SyncWindow(ctk.CTkFrame):
         radio3 = ctk.CTkRadioButton(options_frame, text="Local Backup: Download PROD folder to this PC before sync.", variable=self.backup_var, value="local")
         radio3.grid(row=3, column=0, sticky="w", padx=10, pady=(5,10))
 
+        # --- Transfer Frame ---
+        transfer_frame = ctk.CTkFrame(self, border_width=1)
+        transfer_frame.grid(row=2, column=0, sticky="new", padx=10, pady=(10,0))
+        transfer_frame.grid_columnconfigure(1, weight=1)
+
+        ctk.CTkLabel(transfer_frame, text="File Transfer", font=ctk.CTkFont(weight="bold")).grid(row=0, column=0, columnspan=2, padx=10, pady=5, sticky="w")
+        ctk.CTkRadioButton(transfer_frame, text="Relay through this computer.", variable=self.sync_options["transfer"], value="relay").grid(row=1, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+        ctk.CTkRadioButton(transfer_frame, text="Bulk: relay one tar stream (fast for many small files).", variable=self.sync_options["transfer"], value="tar").grid(row=2, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+        ctk.CTkRadioButton(transfer_frame, text="Direct: PROD pulls from TEST (rsync/scp on PROD).", variable=self.sync_options["transfer"], value="pull").grid(row=3, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+        ctk.CTkRadioButton(transfer_frame, text="Direct: TEST pushes to PROD (rsync/scp on TEST).", variable=self.sync_options["transfer"], value="push").grid(row=4, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+
+        ctk.CTkLabel(transfer_frame, text="Other server's address (optional):").grid(row=5, column=0, sticky="w", padx=10, pady=5)
+        ctk.CTkEntry(transfer_frame, textvariable=self.sync_options["direct_host"]).grid(row=5, column=1, sticky="ew", padx=10, pady=5)
+        ctk.CTkCheckBox(transfer_frame, text="Forward my SSH agent (servers never receive passwords)", variable=self.sync_options["forward_agent"]).grid(row=6, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+        ctk.CTkCheckBox(transfer_frame, text="Relay only the changed blocks of large files (delta)", variable=self.sync_options["delta"]).grid(row=7, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+        ctk.CTkLabel(transfer_frame, text="Parallel file transfers:").grid(row=8, column=0, sticky="w", padx=10, pady=(5,10))
+        ctk.CTkOptionMenu(transfer_frame, variable=self.sync_options["sync_workers"], values=[str(n) for n in range(1, sftp_logic.MAX_SYNC_WORKERS + 1)], width=70).grid(row=8, column=1, sticky="w", padx=10, pady=(5,10))
+
         # --- 3. Action Frame ---
         action_frame = ctk.CTkFrame(self, fg_color="transparent")
         action_frame.grid(row=3, column=0, sticky="ew", padx=10, pady=10)
@@ -1262,6 +1856,14 @@ class SyncWindow(ctk.CTkFrame):
         self.cancel_button = ctk.CTkButton(action_frame, text="Cancel", command=self.parent_toplevel.destroy, fg_color="gray")
         self.cancel_button.pack(side="left")
 
+        # An earlier sync between these servers that did not finish can be continued instead
+        self.unfinished_journal = sync_journal.find_unfinished(self.s1_config, self.s2_config)
+        self.resume_button = None
+        if self.unfinished_journal:
+            remaining = self.unfinished_journal.remaining_operations()
+            self.resume_button = ctk.CTkButton(action_frame, text=f"Resume Interrupted Sync ({remaining} left)", command=self.start_resume_process)
+            self.resume_button.pack(side="right")
+
         # --- 4. Status Bar ---
         status_frame = ctk.CTkFrame(self, height=30)
         status_frame.grid(row=4, column=0, sticky="ew", padx=10, pady=(5, 10))
@@ -1278,6 +1880,7 @@ class SyncWindow(ctk.CTkFrame):
         """Initiates the backup and/or sync process based on user selection."""
         self.action_button.configure(state="disabled")
         self.cancel_button.configure(state="disabled")
+        if self.resume_button: self.resume_button.configure(state="disabled")
         self.progress_bar.start()
 
         backup_choice = self.backup_var.get()
@@ -1291,8 +1894,8 @@ class SyncWindow(ctk.CTkFrame):
 
         elif backup_choice == "remote":
             self.update_status("Starting remote backup...")
-            threading.Thread(target=sftp_logic.backup_folder_remote_task, args=(self.s2_config, self.sync_queue, "PROD"), daemon=True).start()
-            self.after(100, lambda: self.check_queue(delete_on_prod))
+            threading.Thread(target=sftp_logic.backup_folder_remote_task, args=(self.s2_config, self.sync_queue, "PROD", {k: v.get() for k, v in self.sync_options.items()}), daemon=True).start()
+            self.dispatch_sync(delete_on_prod)
 
         elif backup_choice == "local":
             local_path = filedialog.askdirectory(title="Select Local Backup Folder", parent=self.parent_toplevel)
@@ -1300,42 +1903,69 @@ class SyncWindow(ctk.CTkFrame):
                 self.stop_loading()
                 return
             self.update_status("Starting local backup...")
-            threading.Thread(target=sftp_logic.backup_folder_local_task, args=(self.s2_config, local_path, self.sync_queue, "PROD"), daemon=True).start()
-            self.after(100, lambda: self.check_queue(delete_on_prod))
+            threading.Thread(target=sftp_logic.backup_folder_local_task, args=(self.s2_config, local_path, self.sync_queue, "PROD", {k: v.get() for k, v in self.sync_options.items()}), daemon=True).start()
+            self.dispatch_sync(delete_on_prod)
 
     def run_sync_task(self, delete_on_prod):
         """Starts the main synchronization task in a thread."""
         self.update_status("Starting synchronization...")
         self.progress_bar.start()
-        threading.Thread(target=sftp_logic.sync_folders_task, args=(self.s1_config, self.s2_config, self.results, delete_on_prod, self.sync_queue), daemon=True).start()
-        self.after(100, lambda: self.check_queue(delete_on_prod))
-
-    def check_queue(self, delete_on_prod):
-        """Checks the queue for updates from the running tasks."""
-        try:
-            result = self.sync_queue.get_nowait()
-
-            if isinstance(result, Exception):
-                self.show_error("Task Error", f"An error occurred:\n{result}")
-                self.stop_loading()
-            elif isinstance(result, str):
-                self.update_status(result)
-                self.after(100, lambda: self.check_queue(delete_on_prod))
-            elif isinstance(result, dict):
-                status = result.get('status')
-                if status == 'backup_complete' and result.get('success'):
-                    self.update_status(f"Backup complete. Path: {result.get('path')}")
-                    self.run_sync_task(delete_on_prod) # Start sync after backup
-                elif status == 'sync_complete' and result.get('success'):
-                    self.update_status("Synchronization finished successfully!")
-                    self.stop_loading(finished=True)
-                else:
-                    self.after(100, lambda: self.check_queue(delete_on_prod))
-        except queue.Empty:
-            self.after(100, lambda: self.check_queue(delete_on_prod))
-        except Exception as e:
-            self.show_error("GUI Error", f"An error occurred in the UI: {e}")
+        options = {k: v.get() for k, v in self.sync_options.items()}
+        self.touched_paths = self.results.get('only_on_1', []) + self.results.get('different', []) + self.results.get('only_on_1_dirs', [])
+        if delete_on_prod:
+            self.touched_paths += self.results.get('only_on_2', []) + self.results.get('only_on_2_dirs', [])
+        threading.Thread(target=sftp_logic.sync_folders_task, args=(self.s1_config, self.s2_config, self.results, delete_on_prod, self.sync_queue, options), daemon=True).start()
+        self.dispatch_sync(delete_on_prod)
+
+    def start_resume_process(self):
+        """Continues the interrupted sync recorded in the journal, without a new backup."""
+        journal = self.unfinished_journal
+        started = time.strftime('%Y-%m-%d %H:%M', time.localtime(journal.header['created']))
+        if not messagebox.askyesno("Confirm Resume", f"Resume the sync started {started}?\n\n{journal.remaining_operations()} of {journal.total_operations()} operations are left. Files are synced as planned then; changes made since are picked up by the next comparison.", parent=self.parent_toplevel):
+            return
+        self.action_button.configure(state="disabled")
+        self.cancel_button.configure(state="disabled")
+        self.resume_button.configure(state="disabled")
+        self.update_status("Resuming synchronization...")
+        self.progress_bar.start()
+        options = {k: v.get() for k, v in self.sync_options.items()}
+        self.touched_paths = journal.plan['deletes'] + journal.plan['rmdirs'] + journal.plan['mkdirs'] + journal.plan['copies']
+        threading.Thread(target=sftp_logic.resume_sync_task, args=(self.s1_config, self.s2_config, journal.path, self.sync_queue, options), daemon=True).start()
+        self.dispatch_sync(False)
+
+    def dispatch_sync(self, delete_on_prod):
+        """Routes the messages of the backup and sync tasks to handle_sync_message."""
+        if self.sync_dispatcher:
+            self.sync_dispatcher.stop()
+        self.sync_dispatcher = QueueDispatcher(self, self.sync_queue, lambda result: self.handle_sync_message(result, delete_on_prod),
+                                               on_status=self.update_status, on_error=self.on_gui_error, coalesce=('file_synced',)).start()
+
+    def on_gui_error(self, error):
+        self.show_error("GUI Error", f"An error occurred in the UI: {error}")
+        self.stop_loading()
+
+    def handle_sync_message(self, result, delete_on_prod):
+        """Handles a message of the running tasks. Returns True once the current task has finished."""
+        if isinstance(result, Exception):
+            self.show_error("Task Error", f"An error occurred:\n{result}")
             self.stop_loading()
+            return True
+        if isinstance(result, dict):
+            status = result.get('status')
+            if status == 'backup_complete' and result.get('success'):
+                self.update_status(f"Backup complete. Path: {result.get('path')}")
+                self.run_sync_task(delete_on_prod) # Start sync after backup
+                return True
+            elif status == 'sync_complete' and result.get('success'):
+                self.update_status("Synchronization finished successfully!")
+                self.stop_loading(finished=True)
+                return True
+            elif status == 'file_synced':
+                self.progress_bar.stop() # Switch from the running animation to real progress
+                self.progress_bar.set(result['done'] / max(1, result['total']))
+                outcome = "Synced" if result.get('success') else "Failed"
+                self.update_status(f"({result['done']}/{result['total']}) {outcome}: {result['file'][:60]}")
+        return False
 
     def stop_loading(self, finished=False):
         """Stops the progress bar and re-enables controls."""
@@ -1345,13 +1975,15 @@ class SyncWindow(ctk.CTkFrame):
         if finished:
             self.action_button.configure(text="Close & Refresh", command=self.close_and_refresh, state="normal")
             self.cancel_button.configure(state="disabled")
+            if self.resume_button: self.resume_button.pack_forget()
         else:
             self.action_button.configure(state="normal")
+            if self.resume_button: self.resume_button.configure(state="normal")
 
     def close_and_refresh(self):
-        """Calls the main app's refresh callback and closes the window."""
+        """Calls the main app's refresh callback with the paths the sync touched and closes the window."""
         if self.refresh_callback:
-            self.refresh_callback()
+            self.refresh_callback(self.touched_paths)
         self.parent_toplevel.destroy()
 
     def update_status(self, message):
@@ -1400,24 +2032,18 @@ class EditorWindow(ctk.CTkFrame):
         self.status_label.configure(text="Uploading...")
         
         threading.Thread(target=sftp_logic.upload_file_task, args=(self.config, self.relative_path, content, self.upload_queue, self.server_name), daemon=True).start()
-        self.after(100, self.check_upload_queue)
-
-    def check_upload_queue(self):
-        """Checks the upload status."""
-        try:
-            result = self.upload_queue.get_nowait()
-            
-            if isinstance(result, Exception):
-                messagebox.showerror("Upload Error", f"Failed to upload file:\n{result}", parent=self)
-                self.status_label.configure(text="Upload failed.")
-                self.save_button.configure(state="normal")
-            elif isinstance(result, str):
-                self.status_label.configure(text=result)
-                self.after(100, self.check_upload_queue)
-            elif isinstance(result, dict) and result.get('status') == 'upload_complete':
-                messagebox.showinfo("Success", "File saved and uploaded successfully.", parent=self)
-                self.on_save_callback() # Refresh the diff
-                self.winfo_toplevel().destroy() # Close editor
-                
-        except queue.Empty:
-            self.after(100, self.check_upload_queue)
\ No newline at end of file
+        QueueDispatcher(self, self.upload_queue, self.handle_upload_message, on_status=lambda text: self.status_label.configure(text=text)).start()
+
+    def handle_upload_message(self, result):
+        """Handles a message of the upload. Returns True once it has finished."""
+        if isinstance(result, Exception):
+            messagebox.showerror("Upload Error", f"Failed to upload file:\n{result}", parent=self)
+            self.status_label.configure(text="Upload failed.")
+            self.save_button.configure(state="normal")
+            return True
+        if isinstance(result, dict) and result.get('status') == 'upload_complete':
+            messagebox.showinfo("Success", "File saved and uploaded successfully.", parent=self)
+            self.on_save_callback() # Refresh the diff
+            self.winfo_toplevel().destroy() # Close editor
+            return True
+        return False
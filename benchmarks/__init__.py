@@ -0,0 +1,4 @@
+"""
+Benchmarks of MINO's comparisons, syncs, backups and diffs against local stand-in SFTP servers.
+Run 'python -m benchmarks.run --help' from the repository root.
+"""
@@ -0,0 +1,316 @@
+"""
+Times MINO's comparison, sync, backup and diff end to end against two stand-in SFTP servers
+(TEST and PROD, see stand_in_server.py) on synthetic trees, with no network needed:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --files 20000 --mean-size 2048 --changed 1 --scenarios compare,compare-cached
+    python -m benchmarks.run --save-baseline
+    python -m benchmarks.run --rtt 80 --jitter 10 --bandwidth 20
+    python -m benchmarks.run --files 200 --rtt-sweep 0,25,50,100,200,300
+
+Each scenario reports seconds, files/s, MB/s and round trips per file (SFTP requests plus exec
+channels on both servers). Results are compared with the baselines saved for the same scenario and
+tree; runs more than --tolerance slower, or with more round trips, are reported as regressions
+and make the exit code 1.
+
+--rtt, --jitter and --bandwidth put an emulated WAN link between MINO and both servers. --rtt-sweep
+runs the scenarios (compare and sync unless --scenarios says otherwise) at each round-trip time and
+reports how their times grow with it; the growth per millisecond is roughly the number of round trips
+the scenario waits for one after another.
+"""
+import argparse
+import json
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import time
+
+# MINO keeps its hash cache and sync journals under ~/.mino. Benchmarks get a home of their own,
+# set before the modules that read it are imported.
+WORK_DIR = tempfile.mkdtemp(prefix="mino-bench-")
+os.environ['HOME'] = WORK_DIR
+
+import connection_pool
+import diff_engine
+import hash_cache
+import sftp_logic
+from benchmarks import trees
+from benchmarks.stand_in_server import StandInServer, DEFAULT_LINK
+
+SCENARIOS = ('compare', 'compare-cached', 'sync', 'backup-remote', 'backup-local', 'diff')
+SWEEP_SCENARIOS = ('compare', 'sync')
+DEFAULT_BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+MIN_SLOWDOWN = 0.05 # Seconds; smaller slowdowns are noise however large in percent
+ROUND_TRIP_TOLERANCE = 0.02 # Share of extra round trips allowed, as parallel readers prefetch a little differently
+
+class Bench:
+    """The stand-in servers and tree a benchmark run works on."""
+    def __init__(self, test_server, prod_server, spec, options):
+        self.test_server = test_server
+        self.prod_server = prod_server
+        self.spec = spec
+        self.options = options # Compare and sync option overrides
+        self.root = os.path.join(WORK_DIR, "trees")
+        self.info = None
+
+    def fresh_trees(self):
+        self.info = trees.make_trees(self.root, self.spec)
+        connection_pool.get_default_pool().close_all()
+        for server in (self.test_server, self.prod_server):
+            hash_cache.get_default_cache().invalidate('127.0.0.1', server.port)
+        return self.info
+
+    def configs(self):
+        return self.test_server.config(self.info['test']), self.prod_server.config(self.info['prod'])
+
+    def round_trips(self, reset=False):
+        """Returns the requests both servers counted, by type."""
+        counts = {}
+        for server in (self.test_server, self.prod_server):
+            for request, n in server.counts(reset).items():
+                counts[request] = counts.get(request, 0) + n
+        return counts
+
+def run_task(task, *args):
+    """Runs a sftp_logic task in this thread and returns its dict messages; raises the error it reported."""
+    q = queue.Queue()
+    task(*args, q)
+    messages = []
+    while not q.empty():
+        message = q.get()
+        if isinstance(message, Exception):
+            raise message
+        if isinstance(message, dict):
+            messages.append(message)
+    return messages
+
+def compare(bench, use_cache=False):
+    s1, s2 = bench.configs()
+    options = {**bench.options, 'use_cache': use_cache}
+    return next(m for m in run_task(lambda q: sftp_logic.compare_folders_task(s1, s2, q, options)) if 'different' in m)
+
+# Each scenario prepares what it needs, then runs measured() around the timed part and returns
+# the number of files and bytes it processed.
+
+def scenario_compare(bench, measured):
+    measured(compare, bench)
+    return bench.info['test_files'] + bench.info['prod_files'], bench.info['test_bytes'] + bench.info['prod_bytes']
+
+def scenario_compare_cached(bench, measured):
+    """A repeat comparison of unchanged folders, served by the hash cache and folder digests."""
+    compare(bench, use_cache=True)
+    measured(compare, bench, True)
+    return bench.info['test_files'] + bench.info['prod_files'], bench.info['test_bytes'] + bench.info['prod_bytes']
+
+def scenario_sync(bench, measured):
+    results = compare(bench)
+    s1, s2 = bench.configs()
+    plan = sftp_logic.plan_sync(results, True)
+    complete = measured(run_task, sftp_logic.sync_folders_task, s1, s2, results, True)
+    if not any(m.get('status') == 'sync_complete' and not m['failed'] for m in complete):
+        raise RuntimeError("The sync did not complete.")
+    copied = sum(os.path.getsize(os.path.join(bench.info['test'], path)) for path in plan['copies'])
+    return len(plan['copies']) + len(plan['deletes']), copied
+
+def scenario_backup_remote(bench, measured):
+    _, s2 = bench.configs()
+    messages = measured(run_task, lambda q: sftp_logic.backup_folder_remote_task(s2, q, "PROD"))
+    shutil.rmtree(next(m['path'] for m in messages if m.get('status') == 'backup_complete'))
+    return bench.info['prod_files'], bench.info['prod_bytes']
+
+def scenario_backup_local(bench, measured):
+    _, s2 = bench.configs()
+    target = os.path.join(WORK_DIR, "local-backup")
+    os.makedirs(target, exist_ok=True)
+    measured(run_task, lambda q: sftp_logic.backup_folder_local_task(s2, target, q, "PROD"))
+    shutil.rmtree(target)
+    return bench.info['prod_files'], bench.info['prod_bytes']
+
+def scenario_diff(bench, measured, max_files=20):
+    """Opens changed files as the Diff window does: downloads both versions and diffs them with diff_engine."""
+    s1, s2 = bench.configs()
+    paths = bench.info['modified'][:max_files]
+
+    def diff_files():
+        total = 0
+        for path in paths:
+            contents = {}
+            for config, name in ((s1, "TEST"), (s2, "PROD")):
+                contents[name] = next(m['content'] for m in run_task(lambda q: sftp_logic.download_file_task(config, path, q, name)))
+            total += len(contents["TEST"]) + len(contents["PROD"])
+            diff_engine.diff_lines(contents["TEST"].splitlines(), contents["PROD"].splitlines())
+        return total
+    return len(paths), measured(diff_files)
+
+SCENARIO_FUNCTIONS = {'compare': scenario_compare, 'compare-cached': scenario_compare_cached, 'sync': scenario_sync,
+                      'backup-remote': scenario_backup_remote, 'backup-local': scenario_backup_local, 'diff': scenario_diff}
+
+def run_scenario(bench, name, repeat=1):
+    """Runs a scenario repeat times on fresh trees and returns its fastest run's metrics."""
+    best = None
+    for _ in range(repeat):
+        bench.fresh_trees()
+        timing = {}
+
+        def measured(function, *args):
+            bench.round_trips(reset=True)
+            start = time.perf_counter()
+            result = function(*args)
+            timing['seconds'] = time.perf_counter() - start
+            timing['requests'] = bench.round_trips(reset=True)
+            return result
+
+        files, size = SCENARIO_FUNCTIONS[name](bench, measured)
+        if best is None or timing['seconds'] < best['seconds']:
+            seconds, requests = timing['seconds'], timing['requests']
+            round_trips = sum(requests.values())
+            best = {'seconds': round(seconds, 4), 'files': files, 'bytes': size,
+                    'files_per_s': round(files / seconds, 1) if seconds else None,
+                    'mb_per_s': round(size / seconds / 1e6, 2) if seconds else None,
+                    'round_trips': round_trips,
+                    'round_trips_per_file': round(round_trips / files, 3) if files else None,
+                    'requests': requests}
+    return best
+
+def check_regression(metrics, baseline, tolerance):
+    """Returns the reasons a run is a regression compared with its baseline, if any."""
+    reasons = []
+    if metrics['seconds'] > baseline['seconds'] * (1 + tolerance) and metrics['seconds'] - baseline['seconds'] > MIN_SLOWDOWN:
+        reasons.append(f"{metrics['seconds'] / baseline['seconds'] - 1:+.0%} time")
+    if metrics['round_trips'] > baseline['round_trips'] * (1 + ROUND_TRIP_TOLERANCE):
+        reasons.append(f"{metrics['round_trips'] - baseline['round_trips']:+d} round trips")
+    return reasons
+
+def print_row(name, metrics, baseline, reasons):
+    versus = ""
+    if baseline:
+        versus = f"  vs baseline {metrics['seconds'] / baseline['seconds'] - 1:+.0%}"
+        if reasons:
+            versus += "  REGRESSION: " + ", ".join(reasons)
+    print(f"{name:<15} {metrics['seconds']:8.3f} s {metrics['files_per_s'] or 0:10.1f} files/s {metrics['mb_per_s'] or 0:8.2f} MB/s "
+          f"{metrics['round_trips_per_file'] or 0:7.2f} round trips/file{versus}", flush=True)
+
+def link_key(link):
+    """Returns the part of a baseline key that names an emulated link, empty for none."""
+    key = ""
+    if link['rtt'] or link['jitter']:
+        key += f" rtt={link['rtt'] * 1000:g}ms"
+    if link['jitter']:
+        key += f" jitter={link['jitter'] * 1000:g}ms seed={link['seed']}"
+    if link['bandwidth']:
+        key += f" bandwidth={link['bandwidth'] * 8 / 1e6:g}Mbit"
+    return key
+
+def print_sweep(sweep):
+    """Prints the seconds of every scenario per round-trip time, and how much each millisecond adds."""
+    rtts = sorted({rtt for times in sweep.values() for rtt in times})
+    print("\nRTT sweep (seconds)")
+    print(f"{'':<15}" + "".join(f"{f'{rtt:g} ms':>10}" for rtt in rtts) + "   serial round trips")
+    for name, times in sweep.items():
+        row = "".join(f"{times[rtt]:10.3f}" if rtt in times else f"{'-':>10}" for rtt in rtts)
+        measured = sorted(times)
+        serial = ""
+        if len(measured) > 1 and measured[-1] > measured[0]:
+            slope = (times[measured[-1]] - times[measured[0]]) / ((measured[-1] - measured[0]) / 1000)
+            serial = f"{slope:10.0f}"
+        print(f"{name:<15}{row}   {serial}")
+
+def parse_option(text):
+    key, _, value = text.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Benchmark MINO against local stand-in SFTP servers.")
+    tree = parser.add_argument_group("tree")
+    tree.add_argument('--files', type=int, default=trees.DEFAULT_TREE['files'])
+    tree.add_argument('--depth', type=int, default=trees.DEFAULT_TREE['depth'])
+    tree.add_argument('--dirs-per-level', type=int, default=trees.DEFAULT_TREE['dirs_per_level'])
+    tree.add_argument('--sizes', choices=('lognormal', 'uniform', 'fixed'), default=trees.DEFAULT_TREE['sizes'])
+    tree.add_argument('--mean-size', type=int, default=trees.DEFAULT_TREE['mean_size'], help="mean file size in bytes")
+    tree.add_argument('--changed', type=float, default=trees.DEFAULT_TREE['changed'], help="percent of files that differ")
+    tree.add_argument('--seed', type=int, default=trees.DEFAULT_TREE['seed'])
+    parser.add_argument('--scenarios', help=f"comma-separated, from {', '.join(SCENARIOS)} (default: all, or {', '.join(SWEEP_SCENARIOS)} for --rtt-sweep)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario; the fastest counts")
+    parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE', type=parse_option,
+                        help="compare/sync option, e.g. remote_hash=false or transfer=tar (repeatable)")
+    parser.add_argument('--no-exec', action='store_true', help="servers refuse exec requests, as SFTP-only hosts do")
+    link = parser.add_argument_group("emulated link")
+    link.add_argument('--rtt', type=float, default=0, metavar='MS', help="round-trip time to each server")
+    link.add_argument('--jitter', type=float, default=0, metavar='MS', help="random extra delay of up to MS per chunk sent")
+    link.add_argument('--bandwidth', type=float, default=0, metavar='MBIT', help="bandwidth in Mbit/s each way (default: unlimited)")
+    link.add_argument('--link-seed', type=int, default=DEFAULT_LINK['seed'], help="seed of the jitter")
+    link.add_argument('--rtt-sweep', metavar='MS,MS,...', help="run at each of these round-trip times, e.g. 0,25,50,100,200,300")
+    parser.add_argument('--baselines', default=DEFAULT_BASELINES, help="baselines JSON file")
+    parser.add_argument('--save-baseline', action='store_true', help="store this run's results as the baselines")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="slowdown over the baseline reported as a regression")
+    parser.add_argument('--json', metavar='FILE', help="also write the results to FILE")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    names = [name.strip() for name in (args.scenarios or ','.join(SWEEP_SCENARIOS if args.rtt_sweep else SCENARIOS)).split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIO_FUNCTIONS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)}")
+    spec = {'files': args.files, 'depth': args.depth, 'dirs_per_level': args.dirs_per_level, 'sizes': args.sizes,
+            'mean_size': args.mean_size, 'changed': args.changed, 'seed': args.seed}
+    options = dict(args.option)
+    suffix = ''.join(f" {k}={json.dumps(v)}" for k, v in sorted(options.items())) + (" no-exec" if args.no_exec else "")
+    key = trees.tree_key(spec) + suffix
+    link = {'rtt': args.rtt / 1000, 'jitter': args.jitter / 1000, 'bandwidth': args.bandwidth * 1e6 / 8, 'seed': args.link_seed}
+    rtts = [float(rtt) for rtt in args.rtt_sweep.split(',')] if args.rtt_sweep else [args.rtt]
+
+    try:
+        with open(args.baselines, 'r', encoding='utf-8') as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    print(f"Tree {key}{'' if args.rtt_sweep else link_key(link)}", flush=True)
+    results, regressions, sweep = {}, 0, {name: {} for name in names}
+    try:
+        with StandInServer(allow_exec=not args.no_exec) as test_server, StandInServer(allow_exec=not args.no_exec) as prod_server:
+            bench = Bench(test_server, prod_server, spec, options)
+            for rtt in rtts:
+                # Servers apply a changed link to new connections, and every run starts with none
+                test_server.link = prod_server.link = {**link, 'rtt': rtt / 1000}
+                run_key = key + link_key(test_server.link)
+                if args.rtt_sweep:
+                    print(f"RTT {rtt:g} ms", flush=True)
+                for name in names:
+                    try:
+                        metrics = run_scenario(bench, name, args.repeat)
+                    except Exception as e:
+                        print(f"{name:<15} failed: {type(e).__name__}: {e}", flush=True)
+                        regressions += 1
+                        continue
+                    baseline = baselines.get(f"{name} {run_key}")
+                    reasons = check_regression(metrics, baseline, args.tolerance) if baseline else []
+                    regressions += bool(reasons)
+                    print_row(name, metrics, baseline, reasons)
+                    results[f"{name} {run_key}"] = metrics
+                    sweep[name][rtt] = metrics['seconds']
+            connection_pool.get_default_pool().close_all()
+    finally:
+        hash_cache.get_default_cache().close()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+    if args.rtt_sweep:
+        print_sweep(sweep)
+
+    if args.save_baseline:
+        baselines.update(results)
+        with open(args.baselines, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} baselines to {args.baselines}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
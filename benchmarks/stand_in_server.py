@@ -0,0 +1,345 @@
+import logging
+import os
+import random
+import socket
+import subprocess
+import threading
+import time
+from collections import Counter, deque
+
+import paramiko
+from paramiko.sftp import CMD_NAMES
+
+LOG_CHANNEL = 'mino.stand_in' # Server-side paramiko logs, e.g. the resets of connections the client dropped
+logging.getLogger(LOG_CHANNEL).addHandler(logging.NullHandler())
+logging.getLogger(LOG_CHANNEL).propagate = False
+
+DEFAULT_LINK = {
+    'rtt': 0.0, # Seconds a request and its reply spend on the wire together, half of it each way
+    'jitter': 0.0, # Up to this many seconds are added at random to the delay of every chunk sent
+    'bandwidth': 0, # Bytes per second in each direction; 0 for no limit
+    'seed': 1 # Seeds the jitter, so runs with the same link see the same delays
+}
+
+class _Handle(paramiko.SFTPHandle):
+    """An open file; reads and writes go to the same file object."""
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            _apply_attributes(self.readfile.fileno(), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+def _apply_attributes(target, attr):
+    """Applies the attributes an SFTP client set to a path or a file descriptor."""
+    if attr._flags & attr.FLAG_SIZE:
+        os.truncate(target, attr.st_size)
+    if attr._flags & attr.FLAG_UIDGID:
+        os.chown(target, attr.st_uid, attr.st_gid)
+    if attr._flags & attr.FLAG_PERMISSIONS:
+        os.chmod(target, attr.st_mode & 0o7777)
+    if attr._flags & attr.FLAG_AMTIME:
+        os.utime(target, (attr.st_atime, attr.st_mtime))
+
+def _sftp_call(method):
+    """Turns the OSError of a filesystem call into the SFTP status code paramiko expects."""
+    def call(*args):
+        try:
+            result = method(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK if result is None else result
+    call.__name__ = method.__name__
+    return call
+
+class _Filesystem(paramiko.SFTPServerInterface):
+    """
+    Serves the local filesystem under the paths the client asks for, so remote commands run
+    through exec channels see the same files.
+    """
+    def __init__(self, server, stand_in):
+        super().__init__(server)
+        self.stand_in = stand_in
+
+    @_sftp_call
+    def list_folder(self, path):
+        entries = []
+        for name in os.listdir(path):
+            attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+            attr.filename = name
+            entries.append(attr)
+        return entries
+
+    @_sftp_call
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    @_sftp_call
+    def lstat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+
+    @_sftp_call
+    def open(self, path, flags, attr):
+        fd = os.open(path, flags, attr.st_mode & 0o7777 if attr and attr._flags & attr.FLAG_PERMISSIONS else 0o644)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    @_sftp_call
+    def remove(self, path):
+        os.remove(path)
+
+    @_sftp_call
+    def rename(self, oldpath, newpath):
+        if os.path.exists(newpath):
+            return paramiko.SFTP_FAILURE # SFTP rename does not overwrite; clients use posix_rename for that
+        os.rename(oldpath, newpath)
+
+    @_sftp_call
+    def posix_rename(self, oldpath, newpath):
+        os.replace(oldpath, newpath)
+
+    @_sftp_call
+    def mkdir(self, path, attr):
+        os.mkdir(path)
+
+    @_sftp_call
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    @_sftp_call
+    def chattr(self, path, attr):
+        _apply_attributes(path, attr)
+
+    @_sftp_call
+    def readlink(self, path):
+        return os.readlink(path)
+
+    @_sftp_call
+    def symlink(self, target_path, path):
+        os.symlink(target_path, path)
+
+class _CountingSFTPServer(paramiko.SFTPServer):
+    """Counts every SFTP request by type before handling it."""
+    def __init__(self, channel, name, server, sftp_si, stand_in):
+        super().__init__(channel, name, server, sftp_si, stand_in)
+        self.stand_in = stand_in
+
+    def _process(self, t, request_number, msg):
+        self.stand_in.count(CMD_NAMES.get(t, str(t)))
+        super()._process(t, request_number, msg)
+
+class _Authenticator(paramiko.ServerInterface):
+    def __init__(self, stand_in):
+        self.stand_in = stand_in
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self.stand_in.user, self.stand_in.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        if not self.stand_in.allow_exec:
+            return False
+        self.stand_in.count('exec')
+        threading.Thread(target=_run_command, args=(channel, command.decode('utf-8')), daemon=True).start()
+        return True
+
+def _run_command(channel, command):
+    """Runs an exec request with bash, wiring the channel to its stdin, stdout and stderr."""
+    process = subprocess.Popen(['bash', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed_stdin():
+        try:
+            for data in iter(lambda: channel.recv(65536), b''):
+                process.stdin.write(data)
+        except (OSError, EOFError):
+            pass
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+    def send_stderr():
+        for data in iter(lambda: process.stderr.read1(65536), b''):
+            channel.sendall_stderr(data)
+
+    threading.Thread(target=feed_stdin, daemon=True).start()
+    stderr_thread = threading.Thread(target=send_stderr, daemon=True)
+    stderr_thread.start()
+    try:
+        for data in iter(lambda: process.stdout.read1(65536), b''):
+            channel.sendall(data)
+        stderr_thread.join()
+        channel.send_exit_status(process.wait())
+    except (OSError, EOFError):
+        process.kill() # The client went away
+    finally:
+        channel.close()
+
+def _carry(source, target, one_way, jitter, bandwidth, rng, on_done):
+    """
+    Copies bytes from source to target as a network link would deliver them: each chunk arrives
+    one_way seconds (plus jitter) after it was sent, no earlier than the chunk before it, and chunks
+    queue behind each other at the given bandwidth. Calls on_done() once source is at its end.
+    """
+    pending = deque()
+    ready = threading.Condition()
+
+    def deliver():
+        while True:
+            with ready:
+                while not pending:
+                    ready.wait()
+                due, data = pending.popleft()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if data is None:
+                    target.shutdown(socket.SHUT_WR)
+                else:
+                    target.sendall(data)
+            except OSError:
+                data = None
+            if data is None:
+                on_done()
+                return
+
+    threading.Thread(target=deliver, daemon=True).start()
+    link_free = last_due = 0.0
+    while True:
+        try:
+            data = source.recv(65536)
+        except OSError:
+            data = b''
+        sent = time.monotonic()
+        if data and bandwidth:
+            link_free = max(link_free, sent) + len(data) / bandwidth
+            sent = link_free
+        last_due = max(last_due, sent + one_way + (rng.uniform(0, jitter) if jitter else 0))
+        with ready:
+            pending.append((last_due, data or None))
+            ready.notify()
+        if not data:
+            return
+
+def _emulate_link(client, link, connection_number):
+    """
+    Returns a socket for the server end of client whose traffic goes through an emulated link
+    (see DEFAULT_LINK) in both directions.
+    """
+    server_end, link_end = socket.socketpair()
+    done, lock = [], threading.Lock()
+
+    def on_done():
+        with lock:
+            done.append(True)
+            if len(done) < 2:
+                return
+        client.close()
+        link_end.close()
+
+    for direction, (source, target) in enumerate(((client, link_end), (link_end, client))):
+        rng = random.Random(f"{link['seed']}:{connection_number}:{direction}")
+        threading.Thread(target=_carry, args=(source, target, link['rtt'] / 2, link['jitter'], link['bandwidth'], rng, on_done), daemon=True).start()
+    return server_end
+
+class StandInServer:
+    """
+    A Paramiko SSH server on 127.0.0.1 that serves SFTP and runs exec requests with the local bash,
+    standing in for TEST or PROD in benchmarks. It runs in background threads of this process:
+
+        with StandInServer() as server:
+            config = server.config("/tmp/tree/test")
+
+    Every SFTP request and exec channel is counted by type (see counts()), as a measure of round trips.
+    With allow_exec=False exec requests are refused, as on SFTP-only hosts. link emulates the latency,
+    jitter and bandwidth of a WAN link (see DEFAULT_LINK); changing it affects new connections.
+    """
+    def __init__(self, user='bench', password='bench', allow_exec=True, link=None):
+        self.user = user
+        self.password = password
+        self.allow_exec = allow_exec
+        self.link = {**DEFAULT_LINK, **(link or {})}
+        self.connections = 0
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.transports = []
+        self.sock = None
+        self.port = None
+
+    def start(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(50)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return # Stopped
+            self.connections += 1
+            if self.link['rtt'] or self.link['jitter'] or self.link['bandwidth']:
+                client = _emulate_link(client, self.link, self.connections)
+            transport = paramiko.Transport(client)
+            transport.set_log_channel(LOG_CHANNEL)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', _CountingSFTPServer, _Filesystem, self)
+            with self.lock:
+                self.transports.append(transport)
+            transport.start_server(server=_Authenticator(self))
+
+    def stop(self):
+        if self.sock:
+            self.sock.close()
+        with self.lock:
+            transports, self.transports = self.transports, []
+        for transport in transports:
+            transport.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def config(self, path):
+        """Returns a MINO server config for a folder on this server."""
+        return {'host': '127.0.0.1', 'port': str(self.port), 'user': self.user, 'pass': self.password, 'path': path}
+
+    def count(self, request):
+        with self.lock:
+            self.requests[request] += 1
+
+    def counts(self, reset=False):
+        """Returns the requests counted so far by type; reset=True starts counting anew."""
+        with self.lock:
+            counts = dict(self.requests)
+            if reset:
+                self.requests.clear()
+        return counts
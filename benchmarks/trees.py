@@ -0,0 +1,107 @@
+import math
+import os
+import random
+import shutil
+
+DEFAULT_TREE = {
+    'files': 1000, # Files on TEST
+    'depth': 3, # Folder levels below the root
+    'dirs_per_level': 4, # Subfolders of every folder
+    'sizes': 'lognormal', # 'lognormal', 'uniform' (0 to twice the mean) or 'fixed'
+    'mean_size': 8192, # Bytes
+    'max_size': 64 * 1024 * 1024,
+    'changed': 10.0, # Percent of the files that differ between TEST and PROD
+    'seed': 1
+}
+# How the changed files differ: edited on PROD, new on TEST (missing on PROD), or deleted on TEST
+CHANGE_KINDS = (('modified', 0.6), ('only_on_test', 0.2), ('only_on_prod', 0.2))
+BASE_MTIME = 1700000000
+WORDS = ("alpha", "beta", "gamma", "delta", "server", "config", "value", "enabled", "timeout", "path",
+         "user", "cache", "retry", "limit", "release", "deploy", "port", "host", "level", "mode")
+
+def tree_key(spec):
+    """Returns a short name for a tree spec, used to key baselines."""
+    spec = {**DEFAULT_TREE, **spec}
+    return f"{spec['files']}f-d{spec['depth']}x{spec['dirs_per_level']}-{spec['sizes']}{spec['mean_size']}-c{spec['changed']:g}-s{spec['seed']}"
+
+def _size(rng, spec):
+    mean = spec['mean_size']
+    if spec['sizes'] == 'fixed':
+        size = mean
+    elif spec['sizes'] == 'uniform':
+        size = rng.randint(0, 2 * mean)
+    elif spec['sizes'] == 'lognormal':
+        sigma = 1.0
+        size = int(rng.lognormvariate(math.log(max(mean, 1)) - sigma * sigma / 2, sigma))
+    else:
+        raise ValueError(f"Unknown size distribution: {spec['sizes']}")
+    return min(size, spec['max_size'])
+
+def _text(rng, size, lines):
+    """Returns about size bytes of text made of lines, so changed files make sensible diffs."""
+    out, total = [], 0
+    while total < size:
+        line = lines[rng.randrange(len(lines))]
+        out.append(line)
+        total += len(line)
+    return ''.join(out)[:size].encode('ascii')
+
+def _edit(rng, content, lines):
+    """Changes some lines of a file; one in three edits keeps the size the same."""
+    text = content.decode('ascii').split('\n')
+    if rng.random() < 1 / 3 and len(text) > 2:
+        i, j = rng.sample(range(len(text) - 1), 2)
+        text[i], text[j] = text[j], text[i]
+        edited = '\n'.join(text).encode('ascii')
+        if edited != content:
+            return edited
+    for _ in range(max(1, len(text) // 20)):
+        text.insert(rng.randrange(len(text) + 1), lines[rng.randrange(len(lines))].rstrip('\n'))
+    return '\n'.join(text).encode('ascii')
+
+def make_trees(root, spec=None):
+    """
+    Writes a TEST and a PROD folder under root (replacing them if they exist) from a tree spec
+    (see DEFAULT_TREE); the same spec always makes the same trees. Unchanged files have the same
+    contents and modification times on both sides.
+    Returns a dict with the paths of the folders ('test', 'prod'), their file counts and byte sizes
+    and the lists of relative paths per kind of change.
+    """
+    spec = {**DEFAULT_TREE, **(spec or {})}
+    rng = random.Random(spec['seed'])
+    lines = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 12))) + f" = {rng.randint(0, 99999)}\n" for _ in range(4096)]
+
+    dirs = ['']
+    for level in range(spec['depth']):
+        dirs += [f"{d}/d{i}".lstrip('/') for d in dirs if d.count('/') + bool(d) == level for i in range(spec['dirs_per_level'])]
+    changed = set(rng.sample(range(spec['files']), round(spec['files'] * spec['changed'] / 100)))
+
+    info = {'test': os.path.join(root, 'test'), 'prod': os.path.join(root, 'prod'),
+            'test_files': 0, 'test_bytes': 0, 'prod_files': 0, 'prod_bytes': 0,
+            'modified': [], 'only_on_test': [], 'only_on_prod': []}
+    for side in ('test', 'prod'):
+        shutil.rmtree(info[side], ignore_errors=True)
+        os.makedirs(info[side])
+
+    def write(side, relative_path, content, mtime):
+        path = os.path.join(info[side], relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+        info[f'{side}_files'] += 1
+        info[f'{side}_bytes'] += len(content)
+
+    for i in range(spec['files']):
+        relative_path = f"{rng.choice(dirs)}/f{i}.txt".lstrip('/')
+        content = _text(rng, _size(rng, spec), lines)
+        kind = rng.choices([k for k, _ in CHANGE_KINDS], [w for _, w in CHANGE_KINDS])[0] if i in changed else None
+        if kind != 'only_on_prod':
+            write('test', relative_path, content, BASE_MTIME + i)
+        if kind == 'modified':
+            write('prod', relative_path, _edit(rng, content, lines), BASE_MTIME + i + 3600)
+        elif kind != 'only_on_test':
+            write('prod', relative_path, content, BASE_MTIME + i)
+        if kind:
+            info[kind].append(relative_path)
+    return info
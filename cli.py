@@ -0,0 +1,220 @@
+"""
+Command-line entry point for running comparisons and syncs without the GUI, e.g. from cron or a
+deploy pipeline. Loads a workspace saved by the app and writes one JSON object per line (NDJSON)
+to stdout: progress, streamed verdicts and the final results.
+
+    python cli.py compare workspaces/site.json
+    python cli.py sync workspaces/site.json --delete --backup remote
+    python cli.py resume workspaces/site.json
+
+Passwords are read from MINO_TEST_PASS and MINO_PROD_PASS, else from the workspace, else asked
+for when running in a terminal (servers may also accept SSH keys without one).
+
+After every task a 'metrics' line tells where its time went (see task_metrics); --metrics and
+--trace also save the runs as JSON or as a Chrome trace.
+
+Exit codes: 0 when TEST and PROD match (or the sync finished), 1 when differences remain (or some
+files could not be synced), 2 on errors.
+"""
+import argparse
+import getpass
+import json
+import queue
+import sys
+import threading
+
+import connection_pool
+import path_filter
+import sftp_logic
+import sync_journal
+import task_metrics
+import workspace
+
+EXIT_OK, EXIT_DIFFERENT, EXIT_ERROR = 0, 1, 2
+RESULT_LISTS = ('different', 'only_on_1', 'only_on_2', 'only_on_1_dirs', 'only_on_2_dirs')
+
+def emit(event, **fields):
+    """Writes one NDJSON line to stdout."""
+    sys.stdout.write(json.dumps({'event': event, **fields}, default=str) + '\n')
+    sys.stdout.flush()
+
+class TaskFailed(Exception):
+    """Raised when a background task reports an error; it has already been emitted."""
+
+def run_task(task, on_event, progress=True):
+    """
+    Runs task(q_out), a call of a sftp_logic task, in a thread and turns the messages it puts on
+    q_out into NDJSON lines. Dict messages are passed to on_event(message), which may emit them and
+    returns a value to keep; the last value kept is returned. Emits the metrics of the task once it
+    has finished. Raises TaskFailed if the task reported an exception.
+    """
+    q = queue.Queue()
+    runs = []
+    task_metrics.add_listener(runs.append)
+    thread = threading.Thread(target=task, args=(q,), daemon=True)
+    thread.start()
+    kept, error = None, None
+    while thread.is_alive() or not q.empty():
+        try:
+            message = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if isinstance(message, Exception):
+            emit('error', type=type(message).__name__, message=str(message))
+            error = message
+        elif isinstance(message, str):
+            if progress:
+                emit('status', message=message)
+        elif isinstance(message, dict):
+            value = on_event(message)
+            if value is not None:
+                kept = value
+    task_metrics.remove_listener(runs.append)
+    for metrics in runs:
+        emit('metrics', **metrics.summary())
+    if error is not None:
+        raise TaskFailed(str(error))
+    return kept
+
+def summary(results):
+    return {k: len(results[k]) for k in RESULT_LISTS + ('identical',)}
+
+def compare(s1, s2, options, args):
+    """Runs a comparison, emitting verdicts as they come, and returns its results."""
+    def on_event(message):
+        if message.get('status') == 'compare_verdicts':
+            if args.verdicts:
+                emit('verdicts', files=[{'path': path, 'verdict': verdict} for path, verdict, _, _ in message['files'] if args.identical or verdict != 'identical'])
+            return None
+        return message if 'different' in message else None
+
+    results = run_task(lambda q: sftp_logic.compare_folders_task(s1, s2, q, options), on_event, args.progress)
+    lists = {k: sorted(results[k]) for k in RESULT_LISTS + (('identical',) if args.identical else ())}
+    emit('compare_complete', summary=summary(results), **lists)
+    return results
+
+def sync_events(message):
+    """Emits the events of backup and sync tasks; returns the sync_complete message."""
+    status = message.get('status')
+    emit(status or 'message', **{k: v for k, v in message.items() if k != 'status'})
+    return message if status == 'sync_complete' else None
+
+def sync_exit_code(complete):
+    if complete is None:
+        return EXIT_ERROR
+    return EXIT_DIFFERENT if complete.get('failed') or complete.get('remaining') else EXIT_OK
+
+def command_compare(s1, s2, ws, args):
+    results = compare(s1, s2, compare_options(ws, args), args)
+    return EXIT_DIFFERENT if results['different'] or results['only_on_1'] or results['only_on_2'] else EXIT_OK
+
+def command_sync(s1, s2, ws, args):
+    results = compare(s1, s2, compare_options(ws, args), args)
+    sync_options = {**ws['sync_options'], **ws['filter_options'], **filter_overrides(args)}
+    if args.transfer:
+        sync_options['transfer'] = args.transfer
+    plan = sftp_logic.plan_sync(results, args.delete, path_filter.PathFilter.from_options(sync_options))
+    emit('plan', copies=plan['copies'], deletes=plan['deletes'], mkdirs=plan['mkdirs'], rmdirs=plan['rmdirs'])
+    pending = plan['copies'] or plan['deletes'] or plan['mkdirs'] or plan['rmdirs']
+    if args.dry_run or not pending:
+        return EXIT_DIFFERENT if pending else EXIT_OK
+    if args.backup == 'remote':
+        run_task(lambda q: sftp_logic.backup_folder_remote_task(s2, q, "PROD", sync_options), sync_events, args.progress)
+    elif args.backup == 'local':
+        run_task(lambda q: sftp_logic.backup_folder_local_task(s2, args.backup_dir, q, "PROD", sync_options), sync_events, args.progress)
+    complete = run_task(lambda q: sftp_logic.sync_folders_task(s1, s2, results, args.delete, q, sync_options), sync_events, args.progress)
+    return sync_exit_code(complete)
+
+def command_resume(s1, s2, ws, args):
+    journal = sync_journal.find_unfinished(s1, s2)
+    if journal is None:
+        emit('nothing_to_resume')
+        return EXIT_OK
+    emit('resume', journal=journal.path, remaining=journal.remaining_operations(), total=journal.total_operations())
+    complete = run_task(lambda q: sftp_logic.resume_sync_task(s1, s2, journal.path, q), sync_events, args.progress)
+    return sync_exit_code(complete)
+
+def filter_overrides(args):
+    """Returns the filter patterns given on the command line, which replace those of the workspace."""
+    overrides = {}
+    if getattr(args, 'exclude', None) is not None:
+        overrides['exclude'] = '\n'.join(args.exclude)
+    if getattr(args, 'include', None) is not None:
+        overrides['include'] = '\n'.join(args.include)
+    return overrides
+
+def compare_options(ws, args):
+    options = {**ws['compare_options'], **ws['filter_options'], **filter_overrides(args)}
+    if args.quick:
+        options['quick'] = True
+    if args.no_cache:
+        options['use_cache'] = False
+    return options
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Compare and sync a MINO workspace without the GUI. Writes NDJSON to stdout.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('compare', "compare TEST and PROD"), ('sync', "compare, then sync TEST to PROD"), ('resume', "resume an interrupted sync")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('workspace', help="workspace JSON file saved by the app")
+        command.add_argument('--no-progress', dest='progress', action='store_false', help="leave out status messages")
+        command.add_argument('--metrics', metavar='FILE', help="save the timings and counters of the tasks as JSON")
+        command.add_argument('--trace', metavar='FILE', help="save the timings of the tasks as a Chrome trace (chrome://tracing, Perfetto)")
+        if name == 'resume':
+            continue
+        command.add_argument('--quick', action='store_true', help="decide by size and modification time first")
+        command.add_argument('--no-cache', action='store_true', help="do not use the local hash cache")
+        command.add_argument('--exclude', action='append', metavar='PATTERN', help="gitignore-style pattern to leave out (repeatable; replaces the workspace filters)")
+        command.add_argument('--include', action='append', metavar='PATTERN', help="only compare paths matching PATTERN (repeatable)")
+        command.add_argument('--no-verdicts', dest='verdicts', action='store_false', help="do not stream verdicts while comparing")
+        command.add_argument('--identical', action='store_true', help="also list identical files")
+        if name == 'sync':
+            command.add_argument('--delete', action='store_true', help="delete files and folders that are only on PROD")
+            command.add_argument('--dry-run', action='store_true', help="only print the plan")
+            command.add_argument('--backup', choices=('none', 'remote', 'local'), default='none', help="back up the PROD folder first")
+            command.add_argument('--backup-dir', default='.', help="local folder for --backup local")
+            command.add_argument('--transfer', choices=('relay', 'tar', 'pull', 'push'), help="how files are copied (default: the workspace setting)")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        ws = workspace.load_workspace(args.workspace)
+        for key, label in workspace.SERVER_LABELS.items():
+            missing = workspace.missing_fields(ws, key)
+            if missing:
+                raise ValueError(f"The {label} server in {args.workspace} has no {', '.join(missing)}.")
+        path_filter.PathFilter.from_options(filter_overrides(args)) # Raises ValueError for a bad --exclude/--include
+        prompt = (lambda label: getpass.getpass(f"{label} password: ")) if sys.stdin.isatty() else None
+        s1, s2 = workspace.resolve_password(ws, 'server1', prompt), workspace.resolve_password(ws, 'server2', prompt)
+    except (OSError, ValueError) as e:
+        emit('error', type=type(e).__name__, message=str(e))
+        emit('exit', code=EXIT_ERROR)
+        return EXIT_ERROR
+
+    command = {'compare': command_compare, 'sync': command_sync, 'resume': command_resume}[args.command]
+    runs = []
+    task_metrics.add_listener(runs.append)
+    try:
+        code = command(s1, s2, ws, args)
+    except TaskFailed:
+        code = EXIT_ERROR
+    except KeyboardInterrupt:
+        emit('error', type='KeyboardInterrupt', message="Interrupted. An unfinished sync can be continued with 'resume'.")
+        code = EXIT_ERROR
+    finally:
+        connection_pool.get_default_pool().close_all()
+        task_metrics.remove_listener(runs.append)
+    try:
+        if args.metrics:
+            task_metrics.save_json(runs, args.metrics)
+        if args.trace:
+            task_metrics.save_chrome_trace(runs, args.trace)
+    except OSError as e:
+        emit('error', type=type(e).__name__, message=f"Could not save the metrics: {e}")
+        code = EXIT_ERROR
+    emit('exit', code=code)
+    return code
+
+if __name__ == "__main__":
+    sys.exit(main())
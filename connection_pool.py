@@ -0,0 +1,264 @@
+import threading
+import time
+import atexit
+import task_metrics
+# paramiko (with its crypto backends the slowest import of the app) is imported where connections
+# are made, so the GUI can paint and headless tools can start before it is loaded; see preload().
+
+KEEPALIVE_INTERVAL = 30 # Seconds between SSH keepalives on pooled connections
+IDLE_TIMEOUT = 300 # Seconds before a connection nobody uses is closed
+HEALTH_CHECK_AFTER = 30 # Connections idle for longer are probed before they are reused
+# OpenSSH allows 10 sessions per connection by default (MaxSessions). Pooled SFTP channels
+# stay below half of that so exec channels (remote hashing, backups) still fit.
+MAX_CHANNELS_PER_CONNECTION = 4
+MAX_CONNECTIONS_PER_SERVER = 4
+BORROW_WAIT = 30 # Seconds to wait for free capacity before opening an extra connection anyway
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def get_default_pool():
+    """Returns the process-wide connection pool."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+            atexit.register(_default_pool.close_all)
+        return _default_pool
+
+def preload():
+    """Imports paramiko ahead of the first connection, e.g. in a background thread once the window is shown."""
+    import paramiko
+
+class _Connection:
+    """
+    One pooled SSH connection and the SFTP channels opened on it.
+    """
+    def __init__(self, ssh, password):
+        self.ssh, self.password = ssh, password
+        self.idle_channels = []
+        self.open_channels = 0 # SFTP channels, idle, borrowed or being opened
+        self.leases = 0
+        self.last_used = time.time()
+        self.retired = False # No new leases; closed once the last lease is released
+
+    def is_active(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def free_channels(self):
+        return len(self.idle_channels) + MAX_CHANNELS_PER_CONNECTION - self.open_channels
+
+    def close(self):
+        self.retired = True
+        for sftp in self.idle_channels:
+            try: sftp.close()
+            except Exception: pass
+        self.idle_channels = []
+        try: self.ssh.close()
+        except Exception: pass
+
+class Lease:
+    """
+    An SSH connection and SFTP channels borrowed from a ConnectionPool.
+    Use it as a context manager, or call release() when done.
+    """
+    def __init__(self, pool, key, connection, channels):
+        self.pool, self.key, self.connection = pool, key, connection
+        self.ssh = connection.ssh
+        self.channels = channels
+        self.sftp = channels[0] if channels else None
+        self.extra_channels = channels[1:]
+        self.released = False
+        task_metrics.bind_channels(channels, task_metrics.current())
+
+    def release(self, healthy=True):
+        """Returns the channels to the pool. Unhealthy channels are closed instead."""
+        if not self.released:
+            self.released = True
+            self.pool._release(self, healthy)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # File errors (IOError/OSError) leave the channels usable; anything else may have broken them
+        self.release(exc_type is None or issubclass(exc_type, OSError))
+        return False
+
+class ConnectionPool:
+    """
+    Process-wide pool of SSH connections keyed by (host, port, user).
+    Connections are kept alive with SSH keepalives, probed before reuse after being idle,
+    closed after IDLE_TIMEOUT without use, and carry several SFTP channels each.
+    """
+    def __init__(self):
+        self.connections = {} # {(host, port, user): [_Connection]}
+        self.connecting = {} # {(host, port, user): number of connections being opened}
+        self.cond = threading.Condition()
+        self.reaper = None
+
+    def lease(self, config, channels=1, timeout=10):
+        """
+        Borrows a connection to config's server with up to the given number of SFTP channels
+        (0 for exec-only use). All channels of a lease share one SSH transport.
+        """
+        with task_metrics.phase('connect', config['host']):
+            return self._lease(config, channels, timeout)
+
+    def _lease(self, config, channels, timeout):
+        import paramiko
+        key = (config['host'], int(config['port']), config['user'])
+        channels = max(0, min(int(channels), MAX_CHANNELS_PER_CONNECTION))
+        for attempt in range(2):
+            connection, reused = self._reserve(key, config['pass'], channels)
+            fresh = connection is None
+            if fresh:
+                connection = self._connect(key, config, channels, timeout)
+            opened = []
+            try:
+                if not fresh and not connection.is_active():
+                    raise paramiko.SSHException("Pooled connection is no longer active.")
+                if reused and time.time() - connection.last_used > HEALTH_CHECK_AFTER:
+                    self._probe(reused[0], timeout)
+                while len(reused) + len(opened) < channels:
+                    try:
+                        opened.append(task_metrics.instrument_sftp(connection.ssh.open_sftp()))
+                    except paramiko.ChannelException:
+                        # The server limits sessions per connection; make do with fewer channels
+                        if not reused and not opened:
+                            raise
+                        with self.cond:
+                            connection.open_channels -= channels - len(reused) - len(opened)
+                        channels = len(reused) + len(opened)
+            except Exception:
+                with self.cond:
+                    connection.open_channels -= channels - len(reused) - len(opened)
+                    connection.retired = True
+                self._release(Lease(self, key, connection, reused + opened), healthy=False)
+                if fresh or attempt:
+                    raise
+                continue
+            return Lease(self, key, connection, reused + opened)
+
+    def _reserve(self, key, password, channels):
+        """
+        Reserves capacity on a pooled connection, waiting for other leases if the server's
+        connections are full. Returns (connection, idle channels taken), or (None, []) when
+        a new connection should be opened.
+        """
+        deadline = time.time() + BORROW_WAIT
+        with self.cond:
+            self._start_reaper()
+            while True:
+                pooled = self.connections.setdefault(key, [])
+                for connection in list(pooled):
+                    if connection.password != password or not connection.is_active():
+                        connection.retired = True
+                    if connection.retired and connection.leases == 0:
+                        connection.close()
+                        pooled.remove(connection)
+                candidates = [c for c in pooled if not c.retired and c.free_channels() >= channels]
+                if candidates:
+                    connection = max(candidates, key=lambda c: len(c.idle_channels))
+                    reused = connection.idle_channels[:channels]
+                    del connection.idle_channels[:channels]
+                    connection.open_channels += channels - len(reused)
+                    connection.leases += 1
+                    return connection, reused
+                if len(pooled) + self.connecting.get(key, 0) < MAX_CONNECTIONS_PER_SERVER or time.time() >= deadline:
+                    self.connecting[key] = self.connecting.get(key, 0) + 1
+                    return None, []
+                self.cond.wait(timeout=max(0.1, deadline - time.time()))
+
+    def _connect(self, key, config, channels, timeout):
+        """Opens a new connection and registers it with the given channels reserved."""
+        import paramiko
+        ssh = paramiko.SSHClient()
+        try:
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect(config['host'], port=int(config['port']), username=config['user'], password=config['pass'], timeout=timeout)
+            ssh.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+        except Exception:
+            ssh.close()
+            with self.cond:
+                self.connecting[key] -= 1
+                self.cond.notify_all()
+            raise
+        task_metrics.add('connections_opened')
+        connection = _Connection(ssh, config['pass'])
+        connection.open_channels, connection.leases = channels, 1
+        with self.cond:
+            self.connecting[key] -= 1
+            self.connections.setdefault(key, []).append(connection)
+        return connection
+
+    def _probe(self, sftp, timeout):
+        """Raises if an SFTP channel no longer answers within timeout seconds."""
+        channel = sftp.get_channel()
+        previous = channel.gettimeout()
+        channel.settimeout(timeout)
+        try:
+            sftp.normalize('.')
+        finally:
+            channel.settimeout(previous)
+
+    def _release(self, lease, healthy):
+        connection = lease.connection
+        task_metrics.bind_channels(lease.channels, None)
+        with self.cond:
+            connection.leases -= 1
+            connection.last_used = time.time()
+            keep = healthy and not connection.retired and connection.is_active()
+            for sftp in lease.channels:
+                if keep and not sftp.get_channel().closed:
+                    connection.idle_channels.append(sftp)
+                else:
+                    try: sftp.close()
+                    except Exception: pass
+                    connection.open_channels -= 1
+            if not connection.is_active():
+                connection.retired = True
+            if connection.retired and connection.leases == 0:
+                connection.close()
+                pooled = self.connections.get(lease.key, [])
+                if connection in pooled:
+                    pooled.remove(connection)
+            self.cond.notify_all()
+
+    def _start_reaper(self):
+        if self.reaper is None:
+            self.reaper = threading.Thread(target=self._reap_idle, daemon=True)
+            self.reaper.start()
+
+    def _reap_idle(self):
+        """Closes connections nobody has used for IDLE_TIMEOUT seconds."""
+        while True:
+            time.sleep(min(IDLE_TIMEOUT, 30))
+            with self.cond:
+                now = time.time()
+                for key, pooled in self.connections.items():
+                    for connection in list(pooled):
+                        if connection.leases == 0 and (connection.retired or now - connection.last_used > IDLE_TIMEOUT):
+                            connection.close()
+                            pooled.remove(connection)
+
+    def close_server(self, config):
+        """Closes the idle connections to config's server, e.g. after its credentials changed."""
+        key = (config['host'], int(config['port']), config['user'])
+        with self.cond:
+            for connection in list(self.connections.get(key, [])):
+                connection.retired = True
+                if connection.leases == 0:
+                    connection.close()
+                    self.connections[key].remove(connection)
+
+    def close_all(self):
+        """Closes every idle connection and retires the borrowed ones."""
+        with self.cond:
+            for pooled in self.connections.values():
+                for connection in list(pooled):
+                    connection.retired = True
+                    if connection.leases == 0:
+                        connection.close()
+                        pooled.remove(connection)
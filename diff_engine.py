@@ -0,0 +1,188 @@
+import bisect
+import difflib
+import os
+from collections import Counter
+
+import task_metrics
+
+MYERS_MAX_EDITS = 1000 # Regions without unique lines needing more edits than this are shown as replaced whole
+INTRALINE_MAX_LENGTH = 4000 # Longer line pairs only get their differing middle highlighted
+CANCEL_CHECK_EVERY = 256 # Regions (or Myers steps) between checks of the cancel event
+
+class DiffCancelled(Exception):
+    """Raised inside a diff when its cancel event was set, e.g. because the Diff window closed."""
+
+def _check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise DiffCancelled("Diff cancelled.")
+
+def _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi):
+    """
+    Returns the (i, j) pairs of lines that occur exactly once in a[a_lo:a_hi] and in b[b_lo:b_hi],
+    keeping the longest run of them that is in the same order on both sides (patience diff).
+    """
+    a_counts, b_counts = Counter(a[a_lo:a_hi]), Counter(b[b_lo:b_hi])
+    a_index = {a[i]: i for i in range(a_lo, a_hi) if a_counts[a[i]] == 1}
+    pairs = [(a_index[b[j]], j) for j in range(b_lo, b_hi) if b_counts[b[j]] == 1 and b[j] in a_index]
+    if not pairs:
+        return []
+    # Longest increasing subsequence of the a positions, in b order, by patience sorting
+    tails, tail_pairs, previous = [], [], [None] * len(pairs)
+    for n, (i, _) in enumerate(pairs):
+        pile = bisect.bisect_left(tails, i)
+        if pile:
+            previous[n] = tail_pairs[pile - 1]
+        if pile == len(tails):
+            tails.append(i)
+            tail_pairs.append(n)
+        else:
+            tails[pile] = i
+            tail_pairs[pile] = n
+    anchors, n = [], tail_pairs[-1]
+    while n is not None:
+        anchors.append(pairs[n])
+        n = previous[n]
+    anchors.reverse()
+    return anchors
+
+def _myers(a, a_lo, a_hi, b, b_lo, b_hi, cancel_event, max_edits=MYERS_MAX_EDITS):
+    """
+    Returns the matching (i, j) line pairs of a shortest edit script between the two ranges
+    (Myers' O(ND) algorithm), or [] if it needs more than max_edits edits.
+    """
+    n, m = a_hi - a_lo, b_hi - b_lo
+    v, trace = {1: 0}, []
+    for d in range(min(n + m, max_edits) + 1):
+        if d % CANCEL_CHECK_EVERY == 0:
+            _check_cancelled(cancel_event)
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            x = v[k + 1] if k == -d or (k != d and v[k - 1] < v[k + 1]) else v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x, y = x + 1, y + 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _myers_matches(trace, n, m, a_lo, b_lo)
+    return []
+
+def _myers_matches(trace, x, y, a_lo, b_lo):
+    """Walks the Myers trace back from (x, y) and returns the diagonal moves as (i, j) pairs."""
+    matches = []
+    for d in range(len(trace) - 1, -1, -1):
+        v, k = trace[d], x - y
+        prev_k = k + 1 if k == -d or (k != d and v[k - 1] < v[k + 1]) else k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x, y = x - 1, y - 1
+            matches.append((a_lo + x, b_lo + y))
+        x, y = prev_x, prev_y
+    return matches
+
+def opcodes(a, b, cancel_event=None):
+    """
+    Diffs two lists of lines and returns difflib.SequenceMatcher-style opcodes, (tag, i1, i2, j1, j2)
+    with tag 'equal', 'replace', 'delete' or 'insert'.
+    Lines are compared by integer ids, common prefixes and suffixes are matched first, and the rest
+    is split at lines that are unique on both sides (patience diff); regions without such lines are
+    diffed with Myers' algorithm. This stays close to linear for typical files, unlike ndiff.
+    Raises DiffCancelled once cancel_event is set.
+    """
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in a]
+    b = [ids.setdefault(line, len(ids)) for line in b]
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    steps = 0
+    while regions:
+        steps += 1
+        if steps % CANCEL_CHECK_EVERY == 0:
+            _check_cancelled(cancel_event)
+        a_lo, a_hi, b_lo, b_hi = regions.pop()
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            matches.append((a_lo, b_lo))
+            a_lo, b_lo = a_lo + 1, b_lo + 1
+        while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi, b_hi = a_hi - 1, b_hi - 1
+            matches.append((a_hi, b_hi))
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+        anchors = _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi)
+        if not anchors:
+            matches.extend(_myers(a, a_lo, a_hi, b, b_lo, b_hi, cancel_event))
+            continue
+        matches.extend(anchors)
+        for (i, j), (next_i, next_j) in zip([(a_lo - 1, b_lo - 1)] + anchors, anchors + [(a_hi, b_hi)]):
+            if i + 1 < next_i and j + 1 < next_j:
+                regions.append((i + 1, next_i, j + 1, next_j))
+    _check_cancelled(cancel_event)
+
+    ops, i, j = [], 0, 0
+    for match_i, match_j in sorted(matches) + [(len(a), len(b))]:
+        if i < match_i or j < match_j:
+            tag = 'replace' if i < match_i and j < match_j else 'delete' if i < match_i else 'insert'
+            ops.append((tag, i, match_i, j, match_j))
+        if match_i < len(a):
+            if ops and ops[-1][0] == 'equal':
+                ops[-1] = ('equal', ops[-1][1], match_i + 1, ops[-1][3], match_j + 1)
+            else:
+                ops.append(('equal', match_i, match_i + 1, match_j, match_j + 1))
+        i, j = match_i + 1, match_j + 1
+    return ops
+
+def diff_lines(a, b, cancel_event=None):
+    """
+    Returns the diff of two lists of lines in the format of difflib.ndiff without its '? ' hint lines:
+    '  ' for common lines, '- ' for lines only in a and '+ ' for lines only in b. Replaced lines
+    come as '- '/'+ ' pairs, followed by the lines left over on the longer side.
+    """
+    out = []
+    for tag, i1, i2, j1, j2 in opcodes(a, b, cancel_event):
+        if tag == 'equal':
+            out.extend('  ' + line for line in a[i1:i2])
+            continue
+        pairs = min(i2 - i1, j2 - j1)
+        for n in range(pairs):
+            out.append('- ' + a[i1 + n])
+            out.append('+ ' + b[j1 + n])
+        out.extend('- ' + line for line in a[i1 + pairs:i2])
+        out.extend('+ ' + line for line in b[j1 + pairs:j2])
+    return out
+
+def intraline(a, b):
+    """
+    Returns character opcodes (as from difflib.SequenceMatcher) for a replaced line pair. Pairs longer
+    than INTRALINE_MAX_LENGTH only get their common prefix and suffix matched.
+    """
+    if len(a) + len(b) <= INTRALINE_MAX_LENGTH:
+        return difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+    prefix = len(os.path.commonprefix([a, b]))
+    suffix = len(os.path.commonprefix([a[prefix:][::-1], b[prefix:][::-1]]))
+    middle = ('replace' if len(a) - suffix > prefix and len(b) - suffix > prefix else 'delete' if len(a) - suffix > prefix else 'insert',
+              prefix, len(a) - suffix, prefix, len(b) - suffix)
+    ops = [('equal', 0, prefix, 0, prefix)] if prefix else []
+    if middle[1] < middle[2] or middle[3] < middle[4]:
+        ops.append(middle)
+    if suffix:
+        ops.append(('equal', len(a) - suffix, len(a), len(b) - suffix, len(b)))
+    return ops
+
+@task_metrics.measured('diff')
+def diff_task(text1, text2, q_out, cancel_event=None):
+    """
+    Background task diffing two file contents for the Diff window. Puts
+    {'status': 'diff_complete', 'diff': [...]} (see diff_lines) on q_out; puts nothing if cancel_event is set first.
+    """
+    try:
+        lines1, lines2 = text1.splitlines(), text2.splitlines()
+        q_out.put(f"Calculating diff of {len(lines1)} and {len(lines2)} lines...")
+        with task_metrics.phase('diff'):
+            diff = diff_lines(lines1, lines2, cancel_event)
+        task_metrics.add('lines_compared', len(lines1) + len(lines2))
+        task_metrics.add('lines_changed', sum(1 for line in diff if line[0] != ' '))
+        q_out.put({'status': 'diff_complete', 'diff': diff})
+    except DiffCancelled:
+        pass
+    except Exception as e:
+        q_out.put(e)
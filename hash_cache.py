@@ -0,0 +1,225 @@
+import json
+import sqlite3
+import threading
+import time
+import os
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".mino", "hash_cache.sqlite3")
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024 # Evict least recently used hashes above this size
+EVICT_FRACTION = 0.2 # Share of the rows removed per eviction round
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache():
+    """Returns the process-wide cache stored in the user's home directory."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = HashCache(DEFAULT_CACHE_PATH)
+        return _default_cache
+
+class HashCache:
+    """
+    On-disk cache of file hashes keyed by host, port, absolute path, size, mtime and inode.
+    A cached hash is only returned while the file's size, mtime and inode are unchanged.
+    SFTP v3 does not report inode numbers, so listings that lack them store 0.
+    Block manifests (per-block hashes used by delta syncs) are cached the same way.
+    Directory records hold the listing of a directory (file metadata with hashes and subdirectory
+    names) together with the digests that let a later scan skip it while it is unchanged.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path, self.max_bytes = path, max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS hashes ("
+                " host TEXT NOT NULL, port INTEGER NOT NULL, path TEXT NOT NULL, algo TEXT NOT NULL,"
+                " size INTEGER NOT NULL, mtime INTEGER NOT NULL, inode INTEGER NOT NULL,"
+                " hash TEXT NOT NULL, last_used REAL NOT NULL,"
+                " PRIMARY KEY (host, port, path, algo))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS manifests ("
+                " host TEXT NOT NULL, port INTEGER NOT NULL, path TEXT NOT NULL,"
+                " size INTEGER NOT NULL, mtime INTEGER NOT NULL, block_size INTEGER NOT NULL,"
+                " blocks TEXT NOT NULL, last_used REAL NOT NULL,"
+                " PRIMARY KEY (host, port, path))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS directories ("
+                " host TEXT NOT NULL, port INTEGER NOT NULL, path TEXT NOT NULL, algo TEXT NOT NULL,"
+                " stat_digest TEXT NOT NULL, digest TEXT, entries TEXT NOT NULL, last_used REAL NOT NULL,"
+                " PRIMARY KEY (host, port, path, algo))"
+            )
+
+    def server(self, host, port, hash_algo):
+        """Returns a view of the cache for one server and hash algorithm."""
+        return ServerHashCache(self, host, int(port), hash_algo)
+
+    def lookup(self, host, port, hash_algo, entries):
+        """
+        Looks up (path, size, mtime, inode) entries.
+        Returns a {path: hash} dictionary for the entries whose stored key still matches.
+        """
+        found = {}
+        with self.lock, self.conn:
+            for path, size, mtime, inode in entries:
+                row = self.conn.execute(
+                    "SELECT hash FROM hashes WHERE host=? AND port=? AND path=? AND algo=? AND size=? AND mtime=? AND inode=?",
+                    (host, port, path, hash_algo, size, int(mtime or 0), inode or 0)
+                ).fetchone()
+                if row:
+                    found[path] = row[0]
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE hashes SET last_used=? WHERE host=? AND port=? AND path=? AND algo=?",
+                [(now, host, port, path, hash_algo) for path in found]
+            )
+        return found
+
+    def store(self, host, port, hash_algo, entries):
+        """Stores (path, size, mtime, inode, hash) entries, then evicts old rows if the cache is too big."""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hashes (host, port, path, algo, size, mtime, inode, hash, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(host, port, path, hash_algo, size, int(mtime or 0), inode or 0, file_hash, now) for path, size, mtime, inode, file_hash in entries]
+            )
+        self.evict()
+
+    def lookup_manifest(self, host, port, path, size, mtime, block_size):
+        """Returns the cached list of block hashes of a file, or None if its size or mtime changed."""
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT blocks FROM manifests WHERE host=? AND port=? AND path=? AND size=? AND mtime=? AND block_size=?",
+                (host, int(port), path, size, int(mtime or 0), block_size)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE manifests SET last_used=? WHERE host=? AND port=? AND path=?", (time.time(), host, int(port), path))
+        return row[0].split(',') if row[0] else []
+
+    def store_manifest(self, host, port, path, size, mtime, block_size, blocks):
+        """Stores the block hashes of a file, then evicts old rows if the cache is too big."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO manifests (host, port, path, size, mtime, block_size, blocks, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (host, int(port), path, size, int(mtime or 0), block_size, ','.join(blocks), time.time())
+            )
+        self.evict()
+
+    def lookup_directories(self, host, port, hash_algo, base_path):
+        """
+        Returns the directory records of a server at and below the absolute base_path,
+        as {path: (stat digest, content digest, entries)}.
+        """
+        prefix = base_path.rstrip('/')
+        with self.lock, self.conn:
+            where = "host=? AND port=? AND algo=? AND (path=? OR substr(path, 1, ?)=?)"
+            args = (host, int(port), hash_algo, prefix or '/', len(prefix) + 1, prefix + '/')
+            rows = self.conn.execute(f"SELECT path, stat_digest, digest, entries FROM directories WHERE {where}", args).fetchall()
+            self.conn.execute(f"UPDATE directories SET last_used=? WHERE {where}", (time.time(),) + args)
+        return {path: (stat_digest, digest, json.loads(entries)) for path, stat_digest, digest, entries in rows}
+
+    def store_directories(self, host, port, hash_algo, rows):
+        """Stores (path, stat digest, content digest, entries) directory records, then evicts old rows if the cache is too big."""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO directories (host, port, path, algo, stat_digest, digest, entries, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(host, int(port), path, hash_algo, stat_digest, digest, json.dumps(entries), now) for path, stat_digest, digest, entries in rows]
+            )
+        self.evict()
+
+    def invalidate(self, host, port, path_prefix=None):
+        """
+        Removes the cached hashes, manifests and directory records of a server below path_prefix.
+        A missing or relative prefix removes everything of that server. Returns the number of hashes removed.
+        """
+        with self.lock, self.conn:
+            removed = 0
+            for table in ("directories", "manifests", "hashes"):
+                if path_prefix and path_prefix.startswith('/') and path_prefix.rstrip('/'):
+                    prefix = path_prefix.rstrip('/')
+                    cursor = self.conn.execute(
+                        f"DELETE FROM {table} WHERE host=? AND port=? AND (path=? OR substr(path, 1, ?)=?)",
+                        (host, int(port), prefix, len(prefix) + 1, prefix + '/')
+                    )
+                else:
+                    cursor = self.conn.execute(f"DELETE FROM {table} WHERE host=? AND port=?", (host, int(port)))
+                removed = cursor.rowcount
+            return removed
+
+    def forget(self, host, port, paths):
+        """
+        Removes the cached hashes of the given absolute paths of a server, and the records of
+        the directories containing them, so the next scan lists those directories again.
+        Manifests are kept: delta syncs verify the result, so a stale manifest only costs a full copy.
+        """
+        directories = set()
+        for path in paths:
+            while '/' in path.rstrip('/'):
+                path = path.rstrip('/').rpartition('/')[0] or '/'
+                directories.add(path)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM hashes WHERE host=? AND port=? AND path=?",
+                [(host, int(port), path) for path in paths]
+            )
+            self.conn.executemany(
+                "DELETE FROM directories WHERE host=? AND port=? AND path=?",
+                [(host, int(port), path) for path in directories]
+            )
+
+    def used_bytes(self):
+        """Returns the number of bytes used by live pages in the database file."""
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free_count = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - free_count) * page_size
+
+    def evict(self):
+        """Removes the least recently used hashes, manifests and directory records until the cache fits in max_bytes."""
+        with self.lock, self.conn:
+            while self.used_bytes() > self.max_bytes:
+                removed = 0
+                for table in ("directories", "manifests", "hashes"):
+                    rows = self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                    if rows:
+                        self.conn.execute(
+                            f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)",
+                            (max(1, int(rows * EVICT_FRACTION)),)
+                        )
+                        removed += rows
+                if removed == 0:
+                    break
+
+    def close(self):
+        """Closes the database connection."""
+        with self.lock:
+            self.conn.close()
+
+class ServerHashCache:
+    """
+    A HashCache bound to one server and hash algorithm, as used by the scanner.
+    """
+    def __init__(self, cache, host, port, hash_algo):
+        self.cache, self.host, self.port, self.hash_algo = cache, host, port, hash_algo
+
+    def lookup(self, entries):
+        return self.cache.lookup(self.host, self.port, self.hash_algo, entries)
+
+    def store(self, entries):
+        self.cache.store(self.host, self.port, self.hash_algo, entries)
+
+    def lookup_directories(self, base_path):
+        return self.cache.lookup_directories(self.host, self.port, self.hash_algo, base_path)
+
+    def store_directories(self, rows):
+        self.cache.store_directories(self.host, self.port, self.hash_algo, rows)
@@ -1,11 +1,53 @@
-import customtkinter as ctk
-from app import App
+import sys
+import threading
+import time
+
+# Should not be loaded before the window is shown (PIL is, as customtkinter imports it itself)
+HEAVY_MODULES = ("paramiko", "cryptography")
+
+class StartupReport:
+    """
+    Prints how long each startup phase took to stderr, for 'python main.py --startup-report'.
+    Use 'python -X importtime main.py' to break the import phases down by module.
+    """
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def mark(self, phase):
+        """Records a phase that ended now and started when the previous marked phase ended."""
+        with self.lock:
+            now = time.perf_counter()
+            self._print(phase, now - self.last)
+            self.last = now
+            if phase == "first paint":
+                loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+                print(f"Window shown after {(now - self.start) * 1000:.0f} ms; loaded before: {', '.join(loaded) or 'none of ' + ', '.join(HEAVY_MODULES)}", file=sys.stderr)
+
+    def add(self, phase, seconds):
+        """Records a phase that ran apart from the others, e.g. after the first paint."""
+        with self.lock:
+            self._print(phase, seconds)
+
+    def _print(self, phase, seconds):
+        print(f"{seconds * 1000:8.1f} ms  {phase}", file=sys.stderr, flush=True)
 
 if __name__ == "__main__":
+    report = StartupReport() if "--startup-report" in sys.argv[1:] else None
+
+    import customtkinter as ctk
+    if report:
+        report.mark("import customtkinter")
+    from app import App
+    if report:
+        report.mark("import app")
+
     # Set global appearance and theme
     ctk.set_appearance_mode("System")  # Options: "System", "Dark", "Light"
     ctk.set_default_color_theme("blue") # Options: "blue", "green", "dark-blue"
 
     # Create and run the app
-    app = App()
-    app.mainloop()
\ No newline at end of file
+    app = App(startup_report=report)
+    if report:
+        report.mark("build window")
+    app.mainloop()
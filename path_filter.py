@@ -0,0 +1,159 @@
+import re
+
+def _glob_regex(segment):
+    """Translates one path segment of a glob ('*', '?', '[...]', '\\' escapes) into a regex."""
+    out, i = [], 0
+    while i < len(segment):
+        c = segment[i]
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '\\' and i + 1 < len(segment):
+            i += 1
+            out.append(re.escape(segment[i]))
+        elif c == '[':
+            # A ']' right after '[' or '[!' belongs to the set; a '[' without a valid set is literal, as in git
+            start = i + 2 if segment[i + 1:i + 2] in ('!', '^') else i + 1
+            end = segment.find(']', start + 1 if segment[start:start + 1] == ']' else start)
+            bracket = _bracket_regex(segment[i + 1:end]) if end != -1 else None
+            if bracket is None:
+                out.append(re.escape(c))
+            else:
+                out.append(bracket)
+                i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+def _bracket_regex(body):
+    """Translates the inside of a '[...]' set into a regex set, or returns None if it is not a valid set (e.g. '[z-a]')."""
+    negate = body[:1] in ('!', '^')
+    chars = body[1:] if negate else body
+    if not chars:
+        return None
+    bracket = '[' + ('^' if negate else '') + ''.join(ch if ch == '-' else re.escape(ch) for ch in chars) + ']'
+    try:
+        re.compile(bracket)
+    except re.error:
+        return None
+    return bracket
+
+def _segments_regex(segments):
+    """Joins glob segments into a regex; '**' segments match any number of directories."""
+    out = ''
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == '**':
+            out += '.*' if last else '(?:.*/)?'
+        else:
+            out += _glob_regex(segment) + ('' if last else '/')
+    return out
+
+def _parse(line):
+    """
+    Parses one gitignore-style line into (regex, negate, dir_only, anchored, segments),
+    or returns None for blank lines and comments.
+    """
+    line = line.rstrip()
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate or line.startswith('\\'):
+        line = line[1:]
+    dir_only = line.endswith('/')
+    pattern = line.rstrip('/')
+    if not pattern:
+        return None
+    anchored = '/' in pattern
+    segments = pattern.lstrip('/').split('/')
+    regex = _segments_regex(segments)
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return '(?s:' + regex + r')\Z', negate, dir_only, anchored, segments
+
+def _parse_lines(text, label):
+    """Parses pattern lines, raising ValueError for a line whose regex does not compile."""
+    rules = []
+    for number, line in enumerate(text.splitlines(), 1):
+        try:
+            rule = _parse(line)
+            if rule:
+                re.compile(rule[0])
+        except (re.error, IndexError) as e:
+            raise ValueError(f"{label} pattern on line {number} is not valid: {line.strip()} ({e})")
+        if rule:
+            rules.append(rule)
+    return rules
+
+class PathFilter:
+    """
+    Decides which paths, relative to the compared folder, a comparison, sync or backup covers.
+    Exclude patterns use .gitignore syntax: '*', '?' and '[...]' match within a name, '**' across
+    directories, a trailing '/' matches directories only, a pattern containing '/' is anchored to the
+    folder and one without matches at any depth, and a leading '!' re-includes what an earlier
+    pattern excluded (the last matching pattern wins). Nothing inside an excluded directory is visited.
+    Include patterns, if any, limit everything to the paths they match and to what lies inside the
+    directories they match; '!' is not supported there.
+    """
+    def __init__(self, exclude='', include=''):
+        """Raises ValueError naming the line of a pattern that cannot be used."""
+        excludes, includes = _parse_lines(exclude, "Exclude"), _parse_lines(include, "Include")
+        self.exclude_rules = [rule[:3] for rule in excludes]
+        includes = [rule for rule in includes if not rule[1]]
+        self.include_rules = [(regex, dir_only) for regex, _, dir_only, _, _ in includes]
+        # Directories that may contain included paths, so they are visited although they do not match themselves
+        self.descend_rules = []
+        for _, _, _, anchored, segments in includes:
+            if not anchored or segments[0] == '**':
+                self.descend_rules = [r'(?s:.*)\Z']
+                break
+            for depth in range(1, len(segments)):
+                if segments[depth] == '**':
+                    self.descend_rules.append('(?s:' + _segments_regex(segments[:depth]) + r'(?:/.*)?)\Z')
+                    break
+                self.descend_rules.append('(?s:' + _segments_regex(segments[:depth]) + r')\Z')
+
+    @classmethod
+    def from_options(cls, options):
+        """Builds the filter from the 'exclude' and 'include' pattern texts of a task's options."""
+        return cls(options.get('exclude') or '', options.get('include') or '')
+
+    def __bool__(self):
+        return bool(self.exclude_rules or self.include_rules)
+
+    def spec(self):
+        """Returns the rules as JSON-serializable lists, for DIRECTORY_MANIFEST_SCRIPT."""
+        return {'exclude': self.exclude_rules, 'include': self.include_rules, 'descend': self.descend_rules}
+
+    def keep(self, relative_path, is_dir):
+        """
+        Returns True if a path found while walking the folder is covered. Its parent directories
+        are assumed to be covered; use keep_path for a path that was not found by walking.
+        """
+        excluded = False
+        for regex, negate, dir_only in self.exclude_rules:
+            if (is_dir or not dir_only) and re.match(regex, relative_path):
+                excluded = not negate
+        if excluded:
+            return False
+        if not self.include_rules:
+            return True
+        parts = relative_path.split('/')
+        for depth in range(len(parts), 0, -1):
+            path, path_is_dir = '/'.join(parts[:depth]), is_dir or depth < len(parts)
+            if any((path_is_dir or not dir_only) and re.match(regex, path) for regex, dir_only in self.include_rules):
+                return True
+        return is_dir and any(re.match(regex, relative_path) for regex in self.descend_rules)
+
+    def keep_path(self, relative_path, is_dir=False):
+        """Returns True if a path and all of its parent directories are covered."""
+        parts = relative_path.strip('/').split('/')
+        return all(self.keep('/'.join(parts[:depth]), True) for depth in range(1, len(parts))) and self.keep('/'.join(parts), is_dir)
+
+    def filter_paths(self, relative_paths, is_dir=False):
+        """Returns the covered paths of a list, in order."""
+        if not self:
+            return list(relative_paths)
+        return [p for p in relative_paths if self.keep_path(p, is_dir)]
@@ -0,0 +1,78 @@
+import queue
+import time
+
+POLL_INTERVAL = 50 # Milliseconds between polls of an idle queue
+TICK_BUDGET = 0.04 # Seconds of message handling per tick before the UI gets control back
+
+class QueueDispatcher:
+    """
+    Delivers the messages worker threads put on a queue to handlers on the Tk thread.
+    Every tick drains all pending messages, within TICK_BUDGET seconds; if more are left, the next
+    tick follows right after Tk has processed its own events. Status strings are coalesced, so only
+    the newest one of a tick reaches on_status. Other messages go to on_message in order; when it
+    returns True the task is finished and polling stops.
+    Dict messages whose 'status' is in coalesce are coalesced as well, for frequent progress events.
+    """
+    def __init__(self, widget, q, on_message, on_status=None, on_error=None, coalesce=(), interval=POLL_INTERVAL, budget=TICK_BUDGET):
+        self.widget, self.queue = widget, q
+        self.on_message, self.on_status, self.on_error = on_message, on_status, on_error
+        self.coalesce = set(coalesce)
+        self.interval, self.budget = interval, budget
+        self.running = False
+        self.after_id = None
+
+    def start(self):
+        """Starts polling. Returns self so it can be stored in one line."""
+        self.running = True
+        self.after_id = self.widget.after(self.interval, self._tick)
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.after_id is not None:
+            try: self.widget.after_cancel(self.after_id)
+            except Exception: pass
+            self.after_id = None
+
+    def _tick(self):
+        self.after_id = None
+        if not self.running:
+            return
+        deadline = time.perf_counter() + self.budget
+        status, latest = None, {} # Coalesced messages, delivered before the next message that is not
+        more = False
+        try:
+            while True:
+                try:
+                    message = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(message, str) and self.on_status is not None:
+                    status = message
+                elif isinstance(message, dict) and message.get('status') in self.coalesce:
+                    latest[message['status']] = message
+                else:
+                    status, latest = self._flush(status, latest)
+                    if self.on_message(message):
+                        self.running = False
+                        return
+                if time.perf_counter() >= deadline:
+                    more = True
+                    break
+            self._flush(status, latest)
+        except Exception as e:
+            self.running = False
+            if self.on_error is None:
+                raise
+            self.on_error(e)
+            return
+        if self.running:
+            # after_idle lets Tk redraw and handle input before the rest of a backlog is drained
+            self.after_id = self.widget.after_idle(self._tick) if more else self.widget.after(self.interval, self._tick)
+
+    def _flush(self, status, latest):
+        if status is not None:
+            self.on_status(status)
+        for message in latest.values():
+            self.on_message(message)
+        return None, {}
@@ -1,10 +1,226 @@
-import paramiko
 import stat
 import hashlib
-import io
 import difflib
 import time
 import os
+import json
+import shlex
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hash_cache
+import connection_pool
+import sync_journal
+import path_filter
+import task_metrics
+# paramiko is imported inside the functions that need it, see connection_pool.preload()
+
+# Remote commands used to hash files on the server, keyed by hash algorithm.
+# Their output format ("<hash>  <path>") is shared by both tools.
+REMOTE_HASH_TOOLS = {'md5': 'md5sum', 'sha256': 'sha256sum'}
+REMOTE_HASH_BATCH = 500 # Files per remote hashing command
+
+DEFAULT_COMPARE_OPTIONS = {
+    'remote_hash': True, # Hash files on the server instead of downloading them
+    'hash_algo': 'md5',
+    'quick': False, # Decide by size and mtime first, hash only when they disagree
+    'strict': False, # In quick mode, still hash files whose size and mtime match
+    'use_cache': True, # Reuse hashes from the local hash cache while size and mtime are unchanged
+    'scan_workers': 4, # SFTP channels per server used to list and hash in parallel
+    'hash_chunk_kib': 1024, # Chunk size when downloading files to hash them locally
+    'dir_digests': True, # List each server in one round trip with python3 and skip folders unchanged since they were cached
+    'exclude': '', # gitignore-style patterns, one per line, of paths to leave out (see path_filter.PathFilter)
+    'include': '' # If set, only paths matching one of these patterns are compared
+}
+# OpenSSH allows 10 sessions per connection by default (MaxSessions), and every scan
+# worker may hold an SFTP channel and a remote hashing channel at the same time.
+MAX_SCAN_WORKERS = 4
+
+DEFAULT_SYNC_OPTIONS = {
+    'transfer': 'relay', # 'relay' through this computer, 'tar' (one tar stream through this computer), 'pull' (PROD fetches from TEST) or 'push' (TEST sends to PROD)
+    'direct_host': '', # Address of the other server as seen from the one running the transfer; defaults to its configured host
+    'forward_agent': False, # Forward the local SSH agent so the servers can log in to each other with its keys
+    'delta': True, # Send only the changed blocks of large files that already exist on PROD
+    'sync_workers': 4, # Files copied at the same time, each over its own pair of SFTP channels
+    'exclude': '', # Filter patterns as in DEFAULT_COMPARE_OPTIONS; excluded paths are never copied or deleted
+    'include': ''
+}
+MAX_SYNC_WORKERS = connection_pool.MAX_CHANNELS_PER_CONNECTION
+# Direct transfers never send passwords: the servers must trust each other by key, and
+# BatchMode makes ssh fail instead of prompting when they do not.
+DIRECT_SSH_OPTIONS = "-o BatchMode=yes -o StrictHostKeyChecking=accept-new"
+
+DELTA_BLOCK_SIZE = 128 * 1024
+DELTA_MIN_SIZE = 1024 * 1024 # Smaller files are simply copied again
+# Prints the MD5 of every block of a file, then "file <md5 of the whole file>".
+# Run with python3 on the server so block signatures are computed without downloading the file.
+BLOCK_SIGNATURE_SCRIPT = '''import hashlib, sys
+size = int(sys.argv[1])
+whole = hashlib.md5()
+with open(sys.argv[2], 'rb') as f:
+    while True:
+        block = f.read(size)
+        if not block:
+            break
+        whole.update(block)
+        sys.stdout.write(hashlib.md5(block).hexdigest() + '\\n')
+sys.stdout.write('file ' + whole.hexdigest() + '\\n')
+'''
+# Walks a tree and computes a digest of every directory over the names, sizes, mtimes, modes
+# and owners of everything below it. Reads {"known": {relative dir: digest}, "filter": rules} from
+# stdin: the directories the client has cached and the PathFilter.spec() of the paths to walk
+# (or null). Excluded directories are not walked and count for nothing in the digests. Prints one JSON object per line: {"k": dir} for an unchanged directory
+# (nothing below it is sent), {"d": dir, "s": digest} for a listed one (an empty digest if it or
+# a directory below it could not be read), {"f": path, "a": [size, mtime, mode, uid, gid]} for
+# its files, and {"end": directories} last.
+DIRECTORY_MANIFEST_SCRIPT = '''import hashlib, json, os, re, stat, sys
+root = sys.argv[1]
+data = json.load(sys.stdin)
+known, rules = data['known'], data['filter']
+def keep(rel, is_dir):
+    if not rules:
+        return True
+    excluded = False
+    for regex, negate, dir_only in rules['exclude']:
+        if (is_dir or not dir_only) and re.match(regex, rel):
+            excluded = not negate
+    if excluded:
+        return False
+    if not rules['include']:
+        return True
+    parts = rel.split('/')
+    for depth in range(len(parts), 0, -1):
+        path, path_is_dir = '/'.join(parts[:depth]), is_dir or depth < len(parts)
+        if any((path_is_dir or not dir_only) and re.match(regex, path) for regex, dir_only in rules['include']):
+            return True
+    return is_dir and any(re.match(regex, rel) for regex in rules['descend'])
+order, dirs = [''], {}
+for rel in order:
+    files, subdirs, error = [], [], None
+    try:
+        with os.scandir(os.path.join(root, rel) if rel else root) as entries:
+            for entry in entries:
+                st = entry.stat(follow_symlinks=False)
+                path = rel + '/' + entry.name if rel else entry.name
+                if stat.S_ISDIR(st.st_mode) and keep(path, True):
+                    subdirs.append(entry.name)
+                    order.append(path)
+                elif stat.S_ISREG(st.st_mode) and keep(path, False):
+                    files.append((entry.name, [st.st_size, int(st.st_mtime), st.st_mode, st.st_uid, st.st_gid]))
+    except OSError as e:
+        error = str(e)
+    dirs[rel] = (sorted(files), sorted(subdirs), error)
+digests = {}
+for rel in reversed(order):
+    files, subdirs, error = dirs[rel]
+    children = [digests[rel + '/' + name if rel else name] for name in subdirs]
+    if error is not None or not all(children):
+        digests[rel] = ''
+        continue
+    h = hashlib.md5()
+    for name, a in files:
+        h.update(json.dumps(['f', name] + a).encode('utf-8', 'surrogateescape'))
+    for name, child in zip(subdirs, children):
+        h.update(json.dumps(['d', name, child]).encode('utf-8', 'surrogateescape'))
+    digests[rel] = h.hexdigest()
+skipped = set()
+for rel in order:
+    if rel and rel.rpartition('/')[0] in skipped:
+        skipped.add(rel)
+    elif digests[rel] and known.get(rel) == digests[rel]:
+        skipped.add(rel)
+        sys.stdout.write(json.dumps({'k': rel}) + '\\n')
+    else:
+        files, subdirs, error = dirs[rel]
+        sys.stdout.write(json.dumps({'d': rel, 's': digests[rel], 'e': error}) + '\\n')
+        for name, a in files:
+            sys.stdout.write(json.dumps({'f': rel + '/' + name if rel else name, 'a': a}) + '\\n')
+sys.stdout.write(json.dumps({'end': len(order)}) + '\\n')
+'''
+
+class ScanCancelled(Exception):
+    """Raised inside a scan when the comparison was cancelled, e.g. because the other server failed."""
+
+def _check_cancelled(cancel_event):
+    """Raises ScanCancelled if cancel_event is set."""
+    if cancel_event is not None and cancel_event.is_set():
+        raise ScanCancelled("Scan cancelled.")
+
+class _WorkStealingQueue:
+    """
+    Work queue for the parallel scanner. Every worker has its own deque: it takes its newest
+    item (depth-first, like a single path stack) and steals the oldest item of another worker
+    once its own deque is empty.
+    """
+    def __init__(self, workers):
+        self.deques = [deque() for _ in range(workers)]
+        self.pending = 0 # Items queued or being processed
+        self.stopped = False
+        self.cond = threading.Condition()
+
+    def put(self, worker, item):
+        with self.cond:
+            self.pending += 1
+            self.deques[worker].append(item)
+            self.cond.notify()
+
+    def get(self, worker):
+        """Returns the next item for worker, or None once all work is done or the queue was stopped."""
+        with self.cond:
+            while not self.stopped:
+                if self.deques[worker]:
+                    return self.deques[worker].pop()
+                for offset in range(1, len(self.deques)):
+                    victim = self.deques[(worker + offset) % len(self.deques)]
+                    if victim:
+                        return victim.popleft()
+                if self.pending == 0:
+                    return None
+                self.cond.wait()
+            return None
+
+    def task_done(self):
+        with self.cond:
+            self.pending -= 1
+            if self.pending == 0:
+                self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+def _run_parallel(channels, items, handler, cancel_event=None):
+    """
+    Processes items with one worker thread per SFTP channel (or per pair of channels when copying between servers).
+    handler(sftp, item, push) handles one item on the worker's channel and may call push(item) to queue more work.
+    The first exception raised by a handler stops all workers and is raised again here.
+    """
+    work = _WorkStealingQueue(len(channels))
+    for i, item in enumerate(items):
+        work.put(i % len(channels), item)
+    errors = []
+
+    def worker(index, sftp):
+        push = lambda item: work.put(index, item)
+        while True:
+            item = work.get(index)
+            if item is None:
+                return
+            try:
+                _check_cancelled(cancel_event)
+                handler(sftp, item, push)
+            except Exception as e:
+                errors.append(e)
+                work.stop()
+            finally:
+                work.task_done()
+
+    threads = [threading.Thread(target=task_metrics.carry(worker), args=(i, sftp), daemon=True) for i, sftp in enumerate(channels)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    if errors:
+        raise errors[0]
 
 def _parse_passwd(content):
     """Converts the content of /etc/passwd into a {uid: username} dictionary."""
@@ -62,93 +278,626 @@ def _get_name_to_gid_map(sftp):
                 name_map[parts[0]] = int(parts[2])
     return name_map
 
-def scan_sftp_directory(sftp, start_path, q_out, server_name):
+def _has_remote_command(ssh, command):
+    """Returns True if command is on the server's PATH."""
+    try:
+        stdin, stdout, stderr = ssh.exec_command(f"command -v {command}")
+        found = stdout.read().decode('utf-8', errors='ignore').strip()
+        return stdout.channel.recv_exit_status() == 0 and bool(found)
+    except Exception:
+        return False
+
+def _is_remote_root(ssh):
+    """Returns True if commands on the server run as root (uid 0)."""
+    try:
+        stdin, stdout, stderr = ssh.exec_command("id -u")
+        uid = stdout.read().decode('utf-8', errors='ignore').strip()
+        return stdout.channel.recv_exit_status() == 0 and uid == '0'
+    except Exception:
+        return False
+
+def _is_remote_dir(sftp, full_path):
+    """Returns True if full_path is a directory on the server."""
+    try:
+        return stat.S_ISDIR(sftp.stat(full_path).st_mode)
+    except Exception:
+        return False
+
+def _detect_remote_hash_tool(ssh, hash_algo):
+    """Returns the remote hashing command for hash_algo if the server provides it, else None."""
+    tool = REMOTE_HASH_TOOLS.get(hash_algo)
+    if ssh is None or tool is None:
+        return None
+    return tool if _has_remote_command(ssh, tool) else None
+
+def _parse_hash_output(content):
+    """Converts md5sum/sha256sum output into a {path: hash} dictionary."""
+    hashes = {}
+    for line in content.split('\n'):
+        escaped = line.startswith('\\')
+        if escaped: # GNU coreutils escapes names containing '\\' or newlines
+            line = line[1:]
+        file_hash, sep, path = line.partition(' ')
+        if not sep or not path:
+            continue
+        path = path[1:] # Drop the text/binary mode marker (' ' or '*')
+        if escaped:
+            path = path.replace('\\\\', '\0').replace('\\n', '\n').replace('\0', '\\')
+        hashes[path] = file_hash.lower()
+    return hashes
+
+def _remote_hash_batch(ssh, tool, start_path, relative_paths):
     """
-    Recursively scans an SFTP path, returning metadata for files and a list of directories.
+    Hashes a batch of files on the server over the existing SSH session.
+    The paths are piped NUL-separated into `xargs -0 <tool>`, so names with spaces or
+    newlines are safe and xargs splits the batch to fit the command line.
     """
+    command = f"cd {shlex.quote(start_path or '.')} && xargs -0 {tool} --"
+    stdin, stdout, stderr = ssh.exec_command(command)
+    stdin.write(''.join(f"{path}\0" for path in relative_paths))
+    stdin.channel.shutdown_write()
+    content = stdout.read().decode('utf-8', errors='replace')
+    stdout.channel.recv_exit_status() # Non-zero if some files were unreadable; those fall back to download
+    return _parse_hash_output(content)
+
+def _download_hash(sftp, full_path, hash_algo, size=None, chunk_size=1024 * 1024):
+    """
+    Streams a file through a local hash in fixed-size chunks.
+    Reads are pipelined with SFTP prefetch. Data the hash has not consumed yet is held back
+    by the SSH channel window, so memory per file is bounded by the chunk size plus that
+    window, whatever the file size.
+    Returns (hash, bytes read, peak buffer in bytes).
+    """
+    digest = hashlib.new(hash_algo)
+    bytes_read, peak_chunk = 0, 0
+    with sftp.open(full_path, 'rb') as f:
+        f.prefetch(size)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            bytes_read += len(chunk)
+            peak_chunk = max(peak_chunk, len(chunk))
+    window = getattr(sftp.get_channel(), 'in_window_size', 0)
+    return digest.hexdigest(), bytes_read, peak_chunk + min(window, bytes_read)
+
+def _cache_key(file_metadata, relative_path, full_path):
+    """Returns the (path, size, mtime, inode) key of a file in the hash cache."""
+    meta = file_metadata[relative_path]
+    return (full_path, meta['size'], meta['mtime'], meta.get('inode', 0))
+
+def hash_sftp_files(sftp, ssh, start_path, file_metadata, relative_paths, q_out, server_name, remote_hash=True, hash_algo='md5', cache=None, cancel_event=None, channels=None, chunk_size=1024 * 1024, on_hashed=None):
+    """
+    Fills in the 'hash' of the given files in file_metadata.
+    Hashes found in the cache (a ServerHashCache) are reused. The other files are hashed on the
+    server when possible, else downloaded and hashed locally, and then stored in the cache.
+    Files that cannot be hashed either way are dropped from file_metadata.
+    channels are extra SFTP channels of the same connection; one worker runs per channel.
+    on_hashed(relative_paths) is called, possibly from the workers, whenever hashes have been filled in.
+    """
+    on_hashed = on_hashed or (lambda relative_paths: None)
+    workers = [sftp] + list(channels or [])
+    pending = {relative_path: f"{start_path.rstrip('/')}/{relative_path}" for relative_path in relative_paths}
+    cache_paths = {}
+    if cache is not None and pending:
+        try:
+            # Cache entries use absolute paths so relative start paths share them
+            base_path = sftp.normalize(start_path or '.').rstrip('/')
+            cache_paths = {relative_path: f"{base_path}/{relative_path}" for relative_path in pending}
+            cached = cache.lookup([_cache_key(file_metadata, p, cache_paths[p]) for p in pending])
+            for relative_path in list(pending):
+                if cache_paths[relative_path] in cached:
+                    file_metadata[relative_path]['hash'] = cached[cache_paths[relative_path]]
+                    del pending[relative_path]
+            on_hashed([p for p in relative_paths if p not in pending])
+            q_out.put(f"({server_name}) Reused {len(cached)} hashes from cache, {len(pending)} files to hash.")
+            task_metrics.add('hashes_from_cache', len(relative_paths) - len(pending))
+        except Exception as e:
+            q_out.put(f"({server_name}) Warning: Hash cache unavailable: {e}")
+            cache = None
+
+    hashes = {}
+    tool = _detect_remote_hash_tool(ssh, hash_algo) if remote_hash and pending else None
+    if tool:
+        relative_paths = list(pending)
+        batches = [relative_paths[i:i + REMOTE_HASH_BATCH] for i in range(0, len(relative_paths), REMOTE_HASH_BATCH)]
+        progress = {'done': 0}
+        lock = threading.Lock()
+
+        def hash_batch(_sftp, batch, _push):
+            try:
+                batch_hashes = _remote_hash_batch(ssh, tool, start_path, batch)
+            except Exception as e:
+                q_out.put(f"({server_name}) Warning: Remote hashing failed: {e}. Downloading {len(batch)} files instead.")
+                return
+            hashed = [p for p in batch if p in batch_hashes]
+            task_metrics.add('files_hashed_on_server', len(hashed))
+            with lock:
+                hashes.update(batch_hashes)
+                for relative_path in hashed:
+                    file_metadata[relative_path]['hash'] = batch_hashes[relative_path]
+                progress['done'] += len(batch)
+                q_out.put(f"({server_name}) Hashing on server with {tool}: {progress['done']}/{len(relative_paths)}")
+            on_hashed(hashed)
+
+        _run_parallel(workers, batches, hash_batch, cancel_event)
+    elif remote_hash and pending and ssh is not None:
+        q_out.put(f"({server_name}) No remote {REMOTE_HASH_TOOLS.get(hash_algo, hash_algo)} available. Downloading files to hash them.")
+
+
+    download_stats = {'files': 0, 'bytes': 0, 'peak_buffer': 0}
+    stats_lock = threading.Lock()
+
+    def download_and_hash(worker_sftp, relative_path, _push):
+        full_path = pending[relative_path]
+        try:
+            q_out.put(f"({server_name}) Hashing: .../{relative_path[-50:]}")
+            file_hash, bytes_read, peak_buffer = _download_hash(worker_sftp, full_path, hash_algo, file_metadata[relative_path].get('size'), chunk_size)
+            file_metadata[relative_path]['hash'] = file_hash
+            on_hashed([relative_path])
+            with stats_lock:
+                download_stats['files'] += 1
+                download_stats['bytes'] += bytes_read
+                download_stats['peak_buffer'] = max(download_stats['peak_buffer'], peak_buffer)
+        except Exception as e:
+            q_out.put(f"({server_name}) File Error {full_path}: {e}")
+            file_metadata.pop(relative_path, None)
+
+    _run_parallel(workers, [p for p in pending if p not in hashes], download_and_hash, cancel_event)
+    task_metrics.add('files_downloaded_to_hash', download_stats['files'])
+    if download_stats['files']:
+        q_out.put(f"({server_name}) Downloaded and hashed {download_stats['files']} files ({download_stats['bytes'] / 1048576:.1f} MiB). "
+                  f"Peak buffer per file: {download_stats['peak_buffer'] // 1024} KiB.")
+
+    if cache is not None and pending:
+        try:
+            cache.store([_cache_key(file_metadata, p, cache_paths[p]) + (file_metadata[p]['hash'],) for p in pending if p in file_metadata])
+        except Exception as e:
+            q_out.put(f"({server_name}) Warning: Could not update hash cache: {e}")
+
+def _read_id_maps(sftp, q_out, server_name):
+    """Returns the {uid: user name} and {gid: group name} maps of a server, or empty maps if they cannot be read."""
     uid_map, gid_map = {}, {}
     try:
         q_out.put(f"({server_name}) Reading user/group maps...")
-        with sftp.open('/etc/passwd', 'r') as f:
-            uid_map = _parse_passwd(f.read().decode('utf-8', errors='ignore'))
-        with sftp.open('/etc/group', 'r') as f:
-            gid_map = _parse_group(f.read().decode('utf-8', errors='ignore'))
+        with task_metrics.phase('read user/group maps', server_name):
+            with sftp.open('/etc/passwd', 'r') as f:
+                uid_map = _parse_passwd(f.read().decode('utf-8', errors='ignore'))
+            with sftp.open('/etc/group', 'r') as f:
+                gid_map = _parse_group(f.read().decode('utf-8', errors='ignore'))
     except Exception as e:
         q_out.put(f"({server_name}) Warning: Could not read user/group maps: {e}. Using UID/GID numbers.")
+    return uid_map, gid_map
+
+def _file_metadata(attr, uid_map, gid_map):
+    """Returns the metadata dict of a listed or stat'ed file, without its hash."""
+    return {
+        'hash': None, 'owner': uid_map.get(attr.st_uid, str(attr.st_uid)), 'group': gid_map.get(attr.st_gid, str(attr.st_gid)),
+        'mode': stat.filemode(attr.st_mode),
+        'octal_mode': oct(attr.st_mode & 0o777)[2:],
+        'size': attr.st_size, 'mtime': attr.st_mtime
+    }
+
+def list_sftp_directory(sftp, start_path, q_out, server_name, cancel_event=None, channels=None, on_file=None, path_filter=None):
+    """
+    Recursively lists an SFTP path, returning metadata for files (without hashes) and a list of directories.
+    channels are extra SFTP channels of the same connection; directories are listed by one worker
+    per channel, and the results are sorted so they do not depend on the worker timing.
+    on_file(relative_path, metadata) is called from the workers for every file as it is listed.
+    Paths a path_filter (a PathFilter) does not keep are skipped, and excluded directories are not entered.
+    """
+    uid_map, gid_map = _read_id_maps(sftp, q_out, server_name)
 
     file_metadata = {}
     dir_paths = set()
-    path_stack = [start_path]
-    
-    while path_stack:
-        current_path = path_stack.pop()
+
+    def list_directory(worker_sftp, current_path, push):
         if not current_path.startswith(start_path):
             q_out.put(f"({server_name}) Error: Path {current_path} is outside of {start_path}")
-            continue
+            return
             
         rel_path_display = current_path[len(start_path):][:50]
         q_out.put(f"({server_name}) Scanning: .../{rel_path_display}")
         
         try:
-            for item in sftp.listdir_attr(current_path):
+            for item in worker_sftp.listdir_attr(current_path):
                 full_path = f"{current_path.rstrip('/')}/{item.filename.lstrip('/')}"
                 relative_path = full_path[len(start_path):].lstrip('/')
                 
+                if path_filter and (stat.S_ISDIR(item.st_mode) or stat.S_ISREG(item.st_mode)) and not path_filter.keep(relative_path, stat.S_ISDIR(item.st_mode)):
+                    continue
                 if stat.S_ISDIR(item.st_mode):
                     # Ignore '.' and '..' directories
                     if item.filename in ['.', '..']:
                         continue
-                    path_stack.append(full_path)
+                    push(full_path)
                     if relative_path: # Don't add the root path itself
                         dir_paths.add(relative_path)
                 elif stat.S_ISREG(item.st_mode):
-                    try:
-                        mem_file = io.BytesIO()
-                        with sftp.open(full_path, 'rb') as f:
-                            mem_file.write(f.read())
-                        mem_file.seek(0)
-                        
-                        file_hash = hashlib.md5(mem_file.read()).hexdigest()
-                        
-                        owner_name = uid_map.get(item.st_uid, str(item.st_uid))
-                        group_name = gid_map.get(item.st_gid, str(item.st_gid))
-
-                        file_metadata[relative_path] = {
-                            'hash': file_hash, 'owner': owner_name, 'group': group_name,
-                            'mode': stat.filemode(item.st_mode),
-                            'octal_mode': oct(item.st_mode & 0o777)[2:]
-                        }
-                    except Exception as e:
-                        q_out.put(f"({server_name}) File Error {full_path}: {e}")
+                    file_metadata[relative_path] = _file_metadata(item, uid_map, gid_map)
+                    if on_file is not None:
+                        on_file(relative_path, file_metadata[relative_path])
         except Exception as e:
             q_out.put(f"({server_name}) Directory Error {current_path}: {e}")
+
+    _run_parallel([sftp] + list(channels or []), [start_path], list_directory, cancel_event)
             
+    q_out.put(f"({server_name}) Listing complete. Found {len(file_metadata)} files and {len(dir_paths)} directories.")
+    task_metrics.add('files_listed', len(file_metadata))
+    task_metrics.add('dirs_listed', len(dir_paths))
+    return dict(sorted(file_metadata.items())), sorted(dir_paths)
+
+def scan_sftp_directory(sftp, start_path, q_out, server_name, ssh=None, remote_hash=True, hash_algo='md5', cache=None, channels=None, path_filter=None):
+    """
+    Recursively scans an SFTP path, returning metadata for files and a list of directories.
+    If an SSH client is given and remote_hash is set, files are hashed on the server.
+    """
+    file_metadata, dir_paths = list_sftp_directory(sftp, start_path, q_out, server_name, channels=channels, path_filter=path_filter)
+    hash_sftp_files(sftp, ssh, start_path, file_metadata, list(file_metadata), q_out, server_name, remote_hash, hash_algo, cache, channels=channels)
     q_out.put(f"({server_name}) Scan complete. Found {len(file_metadata)} files and {len(dir_paths)} directories.")
-    return file_metadata, list(dir_paths)
+    return file_metadata, dir_paths
+
+def _child_path(directory, name):
+    return f"{directory}/{name}" if directory else name
+
+def _content_digest(files, subdirs):
+    """
+    Returns the digest of a directory as the comparison sees it: the names, sizes and hashes of its
+    files ({name: metadata}) and the digests of its subdirectories ({name: digest}).
+    None if a file has no hash or a subdirectory no digest, so unknown contents never match.
+    """
+    if not all(meta.get('hash') for meta in files.values()) or not all(subdirs.values()):
+        return None
+    digest = hashlib.md5()
+    for name in sorted(files):
+        digest.update(json.dumps(['f', name, files[name]['size'], files[name]['hash']]).encode('utf-8', 'surrogateescape'))
+    for name in sorted(subdirs):
+        digest.update(json.dumps(['d', name, subdirs[name]]).encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+class _DirectoryDigests:
+    """
+    The directory digests of one server from list_sftp_tree.
+    listed holds {relative dir: (stat digest, [file names])} of the directories the server sent,
+    cached the content digests of the directories restored from the cache.
+    """
+    def __init__(self, cache, base_path):
+        self.cache, self.base_path = cache, base_path
+        self.listed, self.cached = {}, {}
+
+    def full_path(self, directory):
+        return f"{self.base_path}/{directory}" if directory else (self.base_path or '/')
+
+    def store(self, file_metadata, dir_paths):
+        """
+        Stores the listed directories with the hashes of their files, so the next scan can skip them
+        while they are unchanged. Directories with a file that could not be hashed are left out.
+        """
+        files, subdirs = {'': {}}, {'': []}
+        for directory in dir_paths:
+            files.setdefault(directory, {})
+            subdirs.setdefault(directory, [])
+            parent, _, name = directory.rpartition('/')
+            subdirs.setdefault(parent, []).append(name)
+        for relative_path, meta in file_metadata.items():
+            parent, _, name = relative_path.rpartition('/')
+            files.setdefault(parent, {})[name] = meta
+
+        digests = {}
+        for directory in sorted(files.keys() | subdirs.keys(), key=lambda d: d.count('/') + bool(d), reverse=True):
+            digests[directory] = _content_digest(files.get(directory, {}), {name: digests.get(_child_path(directory, name)) for name in subdirs.get(directory, [])})
+
+        rows = []
+        for directory, (stat_digest, names) in self.listed.items():
+            if stat_digest and all(name in files.get(directory, {}) for name in names):
+                entries = {'files': files.get(directory, {}), 'dirs': sorted(subdirs.get(directory, []))}
+                rows.append((self.full_path(directory), stat_digest, digests.get(directory), entries))
+        self.cache.store_directories(rows)
+
+def _identical_subtrees(digests1, digests2):
+    """Returns the directories restored from the cache on both servers with equal contents."""
+    return {d for d, digest in digests1.cached.items() if digest and digests2.cached.get(d) == digest}
+
+def _is_below(relative_path, directories):
+    """Returns True if relative_path is inside one of directories ('' being the root)."""
+    parent = relative_path
+    while parent:
+        parent = parent.rpartition('/')[0]
+        if parent in directories:
+            return True
+    return False
+
+def list_sftp_tree(sftp, ssh, start_path, q_out, server_name, cache=None, cancel_event=None, on_file=None, path_filter=None):
+    """
+    Lists an SFTP path like list_sftp_directory, but in one round trip: DIRECTORY_MANIFEST_SCRIPT
+    walks the tree on the server with python3, applying path_filter there. Directories whose digest
+    still matches their record in cache (a ServerHashCache) are not sent; their files, with hashes,
+    come from the cache.
+    Returns (file metadata, directory list, _DirectoryDigests), or None if the server cannot run the script.
+    """
+    import paramiko
+    base_path = sftp.normalize(start_path or '.').rstrip('/')
+    digests = _DirectoryDigests(cache, base_path)
+    records = {}
+    if cache is not None:
+        try:
+            records = cache.lookup_directories(digests.full_path(''))
+        except Exception as e:
+            q_out.put(f"({server_name}) Warning: Hash cache unavailable: {e}")
+            digests.cache = None
+    records = {path[len(base_path) + 1:] if path != digests.full_path('') else '': record for path, record in records.items()}
+
+    # Only directories whose whole subtree is cached may be skipped
+    complete = {}
+    for directory in sorted(records, key=lambda d: d.count('/') + bool(d), reverse=True):
+        complete[directory] = all(complete.get(_child_path(directory, name)) for name in records[directory][2]['dirs'])
+    known = {directory: records[directory][0] for directory, is_complete in complete.items() if is_complete}
+
+    _check_cancelled(cancel_event)
+    q_out.put(f"({server_name}) Listing on the server ({len(known)} folders cached)...")
+    command = f"python3 -c {shlex.quote(DIRECTORY_MANIFEST_SCRIPT)} {shlex.quote(digests.full_path(''))}"
+    try:
+        request = {'known': known, 'filter': path_filter.spec() if path_filter else None}
+        status, output = _exec_with_input(ssh, command, json.dumps(request).encode('ascii'))
+    except Exception as e:
+        q_out.put(f"({server_name}) Warning: Could not list on the server: {e}. Listing over SFTP.")
+        return None
+    entries = []
+    for line in output.split('\n'):
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue # Blank line or a warning on stderr
+    if status != 0 or not entries or 'end' not in entries[-1]:
+        q_out.put(f"({server_name}) No python3 on the server to list it in one go. Listing over SFTP.")
+        return None
+    _check_cancelled(cancel_event)
+
+    uid_map, gid_map = _read_id_maps(sftp, q_out, server_name)
+    file_metadata, dir_paths = {}, set()
+
+    def add_file(relative_path, meta):
+        file_metadata[relative_path] = meta
+        if on_file is not None:
+            on_file(relative_path, meta)
+
+    for entry in entries:
+        if 'f' in entry:
+            attr = paramiko.SFTPAttributes()
+            attr.st_size, attr.st_mtime, attr.st_mode, attr.st_uid, attr.st_gid = entry['a']
+            parent, _, name = entry['f'].rpartition('/')
+            digests.listed[parent][1].append(name)
+            add_file(entry['f'], _file_metadata(attr, uid_map, gid_map))
+        elif 'd' in entry:
+            if entry['d']:
+                dir_paths.add(entry['d'])
+            if entry.get('e'):
+                q_out.put(f"({server_name}) Directory Error {digests.full_path(entry['d'])}: {entry['e']}")
+            digests.listed[entry['d']] = (entry['s'], [])
+        elif 'k' in entry:
+            stack = [entry['k']]
+            while stack:
+                directory = stack.pop()
+                _, content_digest, cached_entries = records[directory]
+                if directory:
+                    dir_paths.add(directory)
+                digests.cached[directory] = content_digest
+                for name, meta in cached_entries['files'].items():
+                    add_file(_child_path(directory, name), meta)
+                stack.extend(_child_path(directory, name) for name in cached_entries['dirs'])
 
-def compare_folders_task(s1_config, s2_config, q_out):
+    q_out.put(f"({server_name}) Listing complete. Found {len(file_metadata)} files and {len(dir_paths)} directories, "
+              f"{len(digests.cached)} of them unchanged since cached.")
+    task_metrics.add('files_listed', len(file_metadata))
+    task_metrics.add('dirs_listed', len(dir_paths))
+    task_metrics.add('dirs_restored_from_cache', len(digests.cached))
+    return dict(sorted(file_metadata.items())), sorted(dir_paths), digests
+
+def _plan_hashing(files_s1, files_s2, quick, strict):
+    """
+    Decides which common files need a content hash.
+    Returns ({relative_path: 'different'|'identical'} decided from metadata alone, set of paths to hash).
+    Without quick mode every common file is hashed.
+    """
+    decided, to_hash = {}, set()
+    for f in set(files_s1).intersection(files_s2):
+        meta1, meta2 = files_s1[f], files_s2[f]
+        if quick and meta1['size'] != meta2['size']:
+            decided[f] = 'different'
+        elif quick and not strict and int(meta1['mtime'] or 0) == int(meta2['mtime'] or 0):
+            decided[f] = 'identical'
+        else:
+            to_hash.add(f)
+    return decided, to_hash
+
+def _open_server_caches(s1_config, s2_config, options, q_out):
+    """Returns the hash cache views for TEST and PROD, or (None, None) if caching is off or unavailable."""
+    if not options['use_cache']:
+        return None, None
+    try:
+        cache = hash_cache.get_default_cache()
+        return (cache.server(s1_config['host'], s1_config['port'], options['hash_algo']),
+                cache.server(s2_config['host'], s2_config['port'], options['hash_algo']))
+    except Exception as e:
+        q_out.put(f"Warning: Could not open hash cache: {e}")
+        return None, None
+
+def _forget_synced_hashes(config, sftp, relative_paths, q_out):
+    """
+    Drops the cached hashes of files a sync rewrote on a server.
+    The sync keeps the TEST size and mtime, so the old hash could otherwise still match.
+    """
+    try:
+        base_path = sftp.normalize(config['path'] or '.').rstrip('/')
+        hash_cache.get_default_cache().forget(config['host'], config['port'], [f"{base_path}/{p}" for p in relative_paths])
+    except Exception as e:
+        q_out.put(f"Warning: Could not update hash cache: {e}")
+
+class _VerdictStream:
+    """
+    Puts the verdicts of a running comparison on q_out as soon as they are known, in batches of
+    {'status': 'compare_verdicts', 'files': [(relative_path, verdict, TEST metadata, PROD metadata)]},
+    where verdict is 'different', 'identical', 'only_on_1' or 'only_on_2'. A file is sent again
+    if its verdict changes; the final results dict is authoritative.
+    """
+    def __init__(self, q_out, batch_size=500, interval=0.25):
+        self.q_out, self.batch_size, self.interval = q_out, batch_size, interval
+        self.lock = threading.Lock()
+        self.sent = {} # {relative_path: verdict}
+        self.pending = []
+        self.last_flush = time.time()
+
+    def add(self, relative_path, verdict, meta1, meta2):
+        with self.lock:
+            if self.sent.get(relative_path) == verdict:
+                return
+            self.sent[relative_path] = verdict
+            self.pending.append((relative_path, verdict, meta1, meta2))
+            if len(self.pending) >= self.batch_size or time.time() - self.last_flush >= self.interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.q_out.put({'status': 'compare_verdicts', 'files': self.pending})
+            self.pending = []
+        self.last_flush = time.time()
+
+def _run_on_both(task1, task2, cancel_event):
+    """
+    Runs two callables concurrently and returns both results.
+    If either fails, cancel_event is set so the other stops early, and the first real error is raised.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(task_metrics.carry(task)) for task in (task1, task2)]
+        for future in futures:
+            future.add_done_callback(lambda f: f.exception() and cancel_event.set())
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if errors:
+        raise next((e for e in errors if not isinstance(e, ScanCancelled)), errors[0])
+    return [f.result() for f in futures]
+
+@task_metrics.measured('compare')
+def compare_folders_task(s1_config, s2_config, q_out, options=None):
     """
     Main background task to compare two SFTP folders.
+    TEST and PROD are scanned concurrently, each over a connection borrowed from the pool.
+    Verdicts are streamed as {'status': 'compare_verdicts', ...} events while the scan runs
+    (see _VerdictStream); the results dict put on q_out at the end has the complete comparison.
+    options overrides DEFAULT_COMPARE_OPTIONS.
     """
-    ssh1, sftp1, ssh2, sftp2 = None, None, None, None
+    options = {**DEFAULT_COMPARE_OPTIONS, **(options or {})}
     try:
-        q_out.put(f"Connecting to TEST Server ({s1_config['host']})...")
-        ssh1 = paramiko.SSHClient()
-        ssh1.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh1.connect(s1_config['host'], port=int(s1_config['port']), username=s1_config['user'], password=s1_config['pass'], timeout=10)
-        sftp1 = ssh1.open_sftp()
-        files_s1, dirs_s1 = scan_sftp_directory(sftp1, s1_config['path'], q_out, "TEST")
-        
-        q_out.put(f"Connecting to PRODUCTION Server ({s2_config['host']})...")
-        ssh2 = paramiko.SSHClient()
-        ssh2.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh2.connect(s2_config['host'], port=int(s2_config['port']), username=s2_config['user'], password=s2_config['pass'], timeout=10)
-        sftp2 = ssh2.open_sftp()
-        files_s2, dirs_s2 = scan_sftp_directory(sftp2, s2_config['path'], q_out, "PROD")
+        q_out.put(_compare_folders(s1_config, s2_config, q_out, options))
+    except Exception as e:
+        q_out.put(e)
+
+def _compare_folders(s1_config, s2_config, q_out, options, previous=None, cancel_event=None):
+    """
+    Compares two SFTP folders and returns the results dict (see compare_folders_task).
+    previous are the results of an earlier comparison of the same folders: their hashes are
+    reused for files whose size and mtime have not changed since.
+    """
+    import paramiko
+    cancel_event = cancel_event or threading.Event()
+    workers = max(1, min(int(options['scan_workers']), MAX_SCAN_WORKERS))
+    filters = path_filter.PathFilter.from_options(options)
+    leases = {} # {server_name: pooled connection lease}, filled by the scan threads
+    stream = _VerdictStream(q_out)
+    listed = {"TEST": {}, "PROD": {}}
+    listed_lock = threading.Lock()
+
+    def on_file_listed(server_name, relative_path, meta):
+        # A file listed on both servers with different sizes is different whatever its hash
+        other_name = "PROD" if server_name == "TEST" else "TEST"
+        with listed_lock:
+            listed[server_name][relative_path] = meta
+            other_meta = listed[other_name].get(relative_path)
+        if other_meta is not None and other_meta['size'] != meta['size']:
+            meta1, meta2 = (meta, other_meta) if server_name == "TEST" else (other_meta, meta)
+            stream.add(relative_path, 'different', meta1, meta2)
+
+    def on_hashed(relative_paths):
+        for relative_path in relative_paths:
+            meta1, meta2 = files_s1.get(relative_path), files_s2.get(relative_path)
+            if meta1 and meta2 and meta1['hash'] and meta2['hash']:
+                stream.add(relative_path, 'identical' if meta1['hash'] == meta2['hash'] else 'different', meta1, meta2)
+
+    def connect_and_list(config, label, server_name, cache):
+        q_out.put(f"({server_name}) Connecting to {label} Server ({config['host']})...")
+        lease = connection_pool.get_default_pool().lease(config, channels=workers)
+        leases[server_name] = lease
+        if len(lease.channels) < workers:
+            q_out.put(f"({server_name}) Warning: Could only open {len(lease.channels)} SFTP channels.")
+        _check_cancelled(cancel_event)
+        on_file = lambda relative_path, meta: on_file_listed(server_name, relative_path, meta)
+        with task_metrics.phase('list', server_name):
+            if options['dir_digests']:
+                listing = list_sftp_tree(lease.sftp, lease.ssh, config['path'], q_out, server_name, cache, cancel_event, on_file, filters)
+                if listing is not None:
+                    return listing
+            return list_sftp_directory(lease.sftp, config['path'], q_out, server_name, cancel_event, lease.extra_channels, on_file, filters) + (None,)
+
+    def hash_side(config, server_name, file_metadata, relative_paths, cache):
+        lease = leases[server_name]
+        with task_metrics.phase('hash', server_name):
+            hash_sftp_files(lease.sftp, lease.ssh, config['path'], file_metadata, relative_paths, q_out, server_name, options['remote_hash'], options['hash_algo'], cache, cancel_event, lease.extra_channels, int(options['hash_chunk_kib']) * 1024, on_hashed)
+
+    error = None
+    try:
+        cache1, cache2 = _open_server_caches(s1_config, s2_config, options, q_out)
+        (files_s1, dirs_s1, digests1), (files_s2, dirs_s2, digests2) = _run_on_both(
+            lambda: connect_and_list(s1_config, "TEST", "TEST", cache1),
+            lambda: connect_and_list(s2_config, "PRODUCTION", "PROD", cache2),
+            cancel_event
+        )
+
+        if previous and previous.get('hash_algo') == options['hash_algo']:
+            for file_metadata, old_metadata in ((files_s1, previous['files_s1']), (files_s2, previous['files_s2'])):
+                for f, meta in file_metadata.items():
+                    old = old_metadata.get(f)
+                    if old and old.get('hash') and old['size'] == meta['size'] and old['mtime'] == meta['mtime']:
+                        meta['hash'] = old['hash']
+
+        decided, to_hash = _plan_hashing(files_s1, files_s2, options['quick'], options['strict'])
+        same_dirs = _identical_subtrees(digests1, digests2) if digests1 and digests2 else set()
+        if same_dirs:
+            unchanged = [f for f in files_s1.keys() & files_s2.keys() if _is_below(f, same_dirs)]
+            for f in unchanged:
+                decided[f] = 'identical'
+            to_hash.difference_update(unchanged)
+            q_out.put(f"Directory digests: {len(unchanged)} files in unchanged folders are identical on both servers.")
+        for f in files_s1.keys() - files_s2.keys():
+            stream.add(f, 'only_on_1', files_s1[f], None)
+        for f in files_s2.keys() - files_s1.keys():
+            stream.add(f, 'only_on_2', None, files_s2[f])
+        for f, verdict in decided.items():
+            stream.add(f, verdict, files_s1[f], files_s2[f])
+        stream.flush()
+        if options['quick']:
+            q_out.put(f"Quick compare: {len(decided)} files decided by size/mtime, {len(to_hash)} to hash.")
+        to_hash = sorted(to_hash)
+        on_hashed(to_hash) # Files whose hashes were reused from previous
+        _run_on_both(
+            lambda: hash_side(s1_config, "TEST", files_s1, [f for f in to_hash if not files_s1[f]['hash']], cache1),
+            lambda: hash_side(s2_config, "PROD", files_s2, [f for f in to_hash if not files_s2[f]['hash']], cache2),
+            cancel_event
+        )
+        for digests, file_metadata, dir_paths, server_name in ((digests1, files_s1, dirs_s1, "TEST"), (digests2, files_s2, dirs_s2, "PROD")):
+            if digests is not None and digests.cache is not None:
+                try:
+                    digests.store(file_metadata, dir_paths)
+                except Exception as e:
+                    q_out.put(f"({server_name}) Warning: Could not store directory digests: {e}")
 
         q_out.put("Comparing file and directory lists...")
         set_files_s1, set_files_s2 = set(files_s1.keys()), set(files_s2.keys())
         common_files = set_files_s1.intersection(set_files_s2)
+        verdicts = {f: decided.get(f) or ('identical' if files_s1[f]['hash'] == files_s2[f]['hash'] else 'different') for f in common_files}
         
         set_dirs_s1, set_dirs_s2 = set(dirs_s1), set(dirs_s2)
 
@@ -156,35 +905,203 @@ def compare_folders_task(s1_config, s2_config, q_out):
             'files_s1': files_s1, 'files_s2': files_s2,
             'only_on_1': sorted(list(set_files_s1 - set_files_s2)),
             'only_on_2': sorted(list(set_files_s2 - set_files_s1)),
-            'different': [f for f in common_files if files_s1[f]['hash'] != files_s2[f]['hash']],
-            'identical': [f for f in common_files if files_s1[f]['hash'] == files_s2[f]['hash']],
+            'different': [f for f in common_files if verdicts[f] == 'different'],
+            'identical': [f for f in common_files if verdicts[f] == 'identical'],
             'only_on_1_dirs': sorted(list(set_dirs_s1 - set_dirs_s2)),
             'only_on_2_dirs': sorted(list(set_dirs_s2 - set_dirs_s1)),
-            'common_dirs': sorted(list(set_dirs_s1.intersection(set_dirs_s2)))
+            'common_dirs': sorted(list(set_dirs_s1.intersection(set_dirs_s2))),
+            'hash_algo': options['hash_algo']
         }
-        q_out.put(results)
+        stream.flush()
+        return results
 
     except Exception as e:
-        q_out.put(e)
+        error = e
+        raise
     finally:
-        for sftp, ssh, name in [(sftp1, ssh1, "TEST"), (sftp2, ssh2, "PROD")]:
+        # Workers have finished by now, so the channels are idle unless the SSH session itself failed
+        for lease in leases.values():
+            lease.release(healthy=not isinstance(error, paramiko.SSHException))
+
+class _DiscardQueue:
+    """Stands in for q_out where status messages are not wanted."""
+    def put(self, item):
+        pass
+
+def _drift(results):
+    """Returns {relative_path: verdict} of the files that are not identical on both servers."""
+    return {f: verdict for verdict in ('different', 'only_on_1', 'only_on_2') for f in results[verdict]}
+
+def watch_folders_task(s1_config, s2_config, q_out, stop_event, interval=60, options=None, previous=None):
+    """
+    Compares the folders again every interval seconds until stop_event is set, to catch changes made on PROD.
+    Each cycle lists both folders but only hashes files whose size or mtime changed since the previous
+    cycle (or since previous, the results the watch starts from), over connections kept in the pool.
+    After every cycle puts {'status': 'watch_cycle', 'cycle', 'seconds', 'results', 'changed', 'added', 'removed'}
+    on q_out. added lists the files that stopped being identical (or whose verdict changed), removed
+    those that are identical again or gone from both servers; changed is True when any verdict differs
+    from the previous cycle.
+    A failed cycle is reported as a status message and retried at the next interval.
+    """
+    options = {**DEFAULT_COMPARE_OPTIONS, **(options or {})}
+    verdict_keys = ('different', 'identical', 'only_on_1', 'only_on_2')
+    drift = _drift(previous) if previous else None
+    current = {'cancel': None}
+
+    def cancel_on_stop():
+        stop_event.wait()
+        if current['cancel']:
+            current['cancel'].set()
+    threading.Thread(target=cancel_on_stop, daemon=True).start()
+
+    cycle = 0
+    while not stop_event.is_set():
+        cycle += 1
+        started = time.time()
+        current['cancel'] = threading.Event()
+        try:
+            with task_metrics.measure('watch cycle'):
+                results = _compare_folders(s1_config, s2_config, _DiscardQueue(), options, previous, current['cancel'])
+        except ScanCancelled:
+            break
+        except Exception as e:
+            q_out.put(f"Watch: Cycle {cycle} failed: {e}. Retrying in {interval} s.")
+        else:
+            new_drift = _drift(results)
+            added = sorted(f for f, verdict in new_drift.items() if drift is not None and drift.get(f) != verdict)
+            removed = sorted(f for f in (drift or {}) if f not in new_drift)
+            changed = previous is None or any(set(results[k]) != set(previous[k]) for k in verdict_keys)
+            q_out.put({'status': 'watch_cycle', 'cycle': cycle, 'seconds': time.time() - started, 'results': results,
+                       'changed': changed, 'added': added, 'removed': removed})
+            drift, previous = new_drift, results
+        stop_event.wait(interval)
+    q_out.put({'status': 'watch_stopped'})
+
+@task_metrics.measured('refresh')
+def refresh_paths_task(s1_config, s2_config, relative_paths, q_out, options=None):
+    """
+    Re-compares only the given paths (files or directories) and their parent directories, e.g. to
+    confirm what a sync changed, instead of scanning both folders again.
+    Puts {'status': 'refresh_complete', 'paths', 'verdicts', 'files_s1', 'files_s2', 'dirs_s1', 'dirs_s2'}
+    on q_out, to be applied with patch_comparison_results. verdicts maps every re-compared file to
+    'different', 'identical', 'only_on_1', 'only_on_2', or None if it exists on neither server.
+    options overrides DEFAULT_COMPARE_OPTIONS.
+    """
+    import paramiko
+    options = {**DEFAULT_COMPARE_OPTIONS, **(options or {})}
+    cancel_event = threading.Event()
+    workers = max(1, min(int(options['scan_workers']), MAX_SCAN_WORKERS))
+    filters = path_filter.PathFilter.from_options(options)
+    leases = {}
+
+    paths = set()
+    for relative_path in relative_paths:
+        parts = relative_path.strip('/').split('/')
+        paths.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    paths.discard('')
+
+    def stat_side(config, label, server_name):
+        q_out.put(f"({server_name}) Connecting to {label} Server ({config['host']})...")
+        lease = connection_pool.get_default_pool().lease(config, channels=workers)
+        leases[server_name] = lease
+        uid_map, gid_map = _read_id_maps(lease.sftp, q_out, server_name)
+        files, dirs = {}, set()
+
+        def stat_path(worker_sftp, relative_path, _push):
             try:
-                if sftp: sftp.close()
-                if ssh: ssh.close()
-                q_out.put(f"{name} Server connection closed.")
-            except: pass
+                attr = worker_sftp.lstat(f"{config['path'].rstrip('/')}/{relative_path}")
+            except FileNotFoundError:
+                return
+            if filters and not filters.keep_path(relative_path, stat.S_ISDIR(attr.st_mode)):
+                return # Excluded paths count as gone, so their rows are removed
+            if stat.S_ISDIR(attr.st_mode):
+                dirs.add(relative_path)
+            elif stat.S_ISREG(attr.st_mode):
+                files[relative_path] = _file_metadata(attr, uid_map, gid_map)
+
+        q_out.put(f"({server_name}) Checking {len(paths)} paths...")
+        _run_parallel(lease.channels, sorted(paths), stat_path, cancel_event)
+        return files, dirs
+
+    def hash_side(config, server_name, file_metadata, relative_paths, cache):
+        lease = leases[server_name]
+        hash_sftp_files(lease.sftp, lease.ssh, config['path'], file_metadata, relative_paths, q_out, server_name, options['remote_hash'], options['hash_algo'], cache, cancel_event, lease.extra_channels, int(options['hash_chunk_kib']) * 1024)
+
+    error = None
+    try:
+        (files_s1, dirs_s1), (files_s2, dirs_s2) = _run_on_both(
+            lambda: stat_side(s1_config, "TEST", "TEST"),
+            lambda: stat_side(s2_config, "PRODUCTION", "PROD"),
+            cancel_event
+        )
+        decided, to_hash = _plan_hashing(files_s1, files_s2, options['quick'], options['strict'])
+        cache1, cache2 = _open_server_caches(s1_config, s2_config, options, q_out)
+        to_hash = sorted(to_hash)
+        _run_on_both(
+            lambda: hash_side(s1_config, "TEST", files_s1, to_hash, cache1),
+            lambda: hash_side(s2_config, "PROD", files_s2, to_hash, cache2),
+            cancel_event
+        )
+
+        verdicts = {}
+        for relative_path in sorted(paths - dirs_s1 - dirs_s2):
+            in_1, in_2 = relative_path in files_s1, relative_path in files_s2
+            if in_1 and in_2:
+                verdicts[relative_path] = decided.get(relative_path) or ('identical' if files_s1[relative_path]['hash'] == files_s2[relative_path]['hash'] else 'different')
+            else:
+                verdicts[relative_path] = 'only_on_1' if in_1 else 'only_on_2' if in_2 else None
+        q_out.put({
+            'status': 'refresh_complete', 'paths': sorted(paths), 'verdicts': verdicts,
+            'files_s1': files_s1, 'files_s2': files_s2, 'dirs_s1': sorted(dirs_s1), 'dirs_s2': sorted(dirs_s2)
+        })
+
+    except Exception as e:
+        error = e
+        q_out.put(e)
+    finally:
+        for lease in leases.values():
+            lease.release(healthy=not isinstance(error, paramiko.SSHException))
+
+def patch_comparison_results(results, refresh):
+    """
+    Applies the 'refresh_complete' event of refresh_paths_task to comparison results, in place.
+    Returns the {relative_path: verdict or None} of the files that were re-compared.
+    """
+    paths = set(refresh['paths'])
+    for side in ('files_s1', 'files_s2'):
+        for relative_path in paths:
+            results[side].pop(relative_path, None)
+        results[side].update(refresh[side])
+    for key in ('different', 'identical', 'only_on_1', 'only_on_2'):
+        results[key] = [p for p in results[key] if p not in paths]
+    for relative_path, verdict in refresh['verdicts'].items():
+        if verdict:
+            results[verdict].append(relative_path)
+
+    dirs_s1, dirs_s2 = set(refresh['dirs_s1']), set(refresh['dirs_s2'])
+    for key in ('only_on_1_dirs', 'only_on_2_dirs', 'common_dirs'):
+        results[key] = [d for d in results[key] if d not in paths]
+    for relative_path in paths:
+        if relative_path in dirs_s1 and relative_path in dirs_s2:
+            results['common_dirs'].append(relative_path)
+        elif relative_path in dirs_s1:
+            results['only_on_1_dirs'].append(relative_path)
+        elif relative_path in dirs_s2:
+            results['only_on_2_dirs'].append(relative_path)
+    for key in ('only_on_1', 'only_on_2', 'only_on_1_dirs', 'only_on_2_dirs', 'common_dirs'):
+        results[key].sort()
+    return refresh['verdicts']
 
+@task_metrics.measured('download')
 def download_file_task(config, relative_path, q_out, server_name):
     """
     Downloads a single file from an SFTP server.
     """
-    ssh, sftp = None, None
+    lease = None
     try:
         q_out.put(f"({server_name}) Connecting to {config['host']}...")
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(config['host'], port=int(config['port']), username=config['user'], password=config['pass'], timeout=10)
-        sftp = ssh.open_sftp()
+        lease = connection_pool.get_default_pool().lease(config)
+        sftp = lease.sftp
         
         full_path = f"{config['path'].rstrip('/')}/{relative_path}"
         q_out.put(f"({server_name}) Downloading: {relative_path}")
@@ -202,57 +1119,51 @@ def download_file_task(config, relative_path, q_out, server_name):
     except Exception as e:
         q_out.put(e)
     finally:
-        if sftp: sftp.close()
-        if ssh: ssh.close()
+        if lease: lease.release()
 
+@task_metrics.measured('list users')
 def get_all_users_task(config, q_out, server_name):
     """
     Connects to a server and fetches a list of all usernames from /etc/passwd.
     """
-    ssh, sftp = None, None
+    lease = None
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(config['host'], port=int(config['port']), username=config['user'], password=config['pass'], timeout=10)
-        sftp = ssh.open_sftp()
+        lease = connection_pool.get_default_pool().lease(config)
+        sftp = lease.sftp
         q_out.put(f"({server_name}) Fetching user list...")
         users = list(_get_name_to_uid_map(sftp).keys())
         q_out.put({'server': server_name, 'users': users})
     except Exception as e:
         q_out.put(e)
     finally:
-        if sftp: sftp.close()
-        if ssh: ssh.close()
+        if lease: lease.release()
 
+@task_metrics.measured('list groups')
 def get_all_groups_task(config, q_out, server_name):
     """
     Connects to a server and fetches a list of all group names from /etc/group.
     """
-    ssh, sftp = None, None
+    lease = None
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(config['host'], port=int(config['port']), username=config['user'], password=config['pass'], timeout=10)
-        sftp = ssh.open_sftp()
+        lease = connection_pool.get_default_pool().lease(config)
+        sftp = lease.sftp
         q_out.put(f"({server_name}) Fetching group list...")
         groups = list(_get_name_to_gid_map(sftp).keys())
         q_out.put({'server': server_name, 'groups': groups})
     except Exception as e:
         q_out.put(e)
     finally:
-        if sftp: sftp.close()
-        if ssh: ssh.close()
+        if lease: lease.release()
 
+@task_metrics.measured('change attributes')
 def change_attributes_task(config, relative_path, owner, group, perms_str, q_out, server_name):
     """
     Changes the owner and/or permissions of a single file on an SFTP server.
     """
-    ssh, sftp = None, None
+    lease = None
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(config['host'], port=int(config['port']), username=config['user'], password=config['pass'], timeout=10)
-        sftp = ssh.open_sftp()
+        lease = connection_pool.get_default_pool().lease(config)
+        sftp = lease.sftp
         
         full_path = f"{config['path'].rstrip('/')}/{relative_path}"
         q_out.put(f"({server_name}) Changing attributes for: {relative_path}")
@@ -287,47 +1198,60 @@ def change_attributes_task(config, relative_path, owner, group, perms_str, q_out
     except Exception as e:
         q_out.put(f"Error:{server_name}:{e}")
     finally:
-        if sftp: sftp.close()
-        if ssh: ssh.close()
+        if lease: lease.release()
 
-def backup_folder_remote_task(config, q_out, server_name):
+@task_metrics.measured('remote backup')
+def backup_folder_remote_task(config, q_out, server_name, options=None):
     """
     Creates a backup of a directory on the remote server itself.
     e.g., copies /path/to/folder to /path/to/folder-backup-TIMESTAMP
+    With 'exclude'/'include' filter patterns in options, only the paths they keep are copied,
+    as a tar stream on the server.
     """
-    ssh = None
+    filters = path_filter.PathFilter.from_options(options or {})
+    lease = None
     try:
         timestamp = time.strftime("%Y%m%d-%H%M%S")
         source_path = config['path'].rstrip('/')
         backup_path = f"{source_path}-backup-{timestamp}"
 
         q_out.put(f"({server_name}) Connecting to {config['host']} for remote backup...")
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(config['host'], port=int(config['port']), username=config['user'], password=config['pass'], timeout=20)
+        lease = connection_pool.get_default_pool().lease(config, channels=1 if filters else 0, timeout=20)
+        ssh = lease.ssh
+
+        if filters:
+            file_metadata, dir_paths = list_sftp_directory(lease.sftp, source_path, q_out, server_name, path_filter=filters)
+            q_out.put(f"({server_name}) Starting remote backup of {len(file_metadata)} filtered files to '{backup_path}'")
+            command = (f"mkdir -p {shlex.quote(backup_path)} && tar -C {shlex.quote(source_path or '/')} -cf - --null --no-recursion -T - "
+                       f"| tar -C {shlex.quote(backup_path)} -xpf -")
+            # Directories first, so tar creates them (with their modes) before the files inside
+            exit_status, error_message = _exec_with_input(ssh, command, ''.join(f"{path}\0" for path in dir_paths + list(file_metadata)).encode('utf-8'))
+        else:
+            q_out.put(f"({server_name}) Starting remote backup: cp -r '{source_path}' '{backup_path}'")
+            stdin, stdout, stderr = ssh.exec_command(f"cp -r '{source_path}' '{backup_path}'")
+
+            exit_status = stdout.channel.recv_exit_status() # Wait for command to complete
+            error_message = stderr.read().decode('utf-8', errors='ignore') if exit_status else ''
 
-        q_out.put(f"({server_name}) Starting remote backup: cp -r '{source_path}' '{backup_path}'")
-        stdin, stdout, stderr = ssh.exec_command(f"cp -r '{source_path}' '{backup_path}'")
-        
-        exit_status = stdout.channel.recv_exit_status() # Wait for command to complete
-        
         if exit_status == 0:
             q_out.put(f"({server_name}) Remote backup completed successfully to {backup_path}")
             q_out.put({'status': 'backup_complete', 'success': True, 'path': backup_path})
         else:
-            error_message = stderr.read().decode('utf-8', errors='ignore').strip()
-            raise Exception(f"Remote backup failed with exit status {exit_status}: {error_message}")
+            raise Exception(f"Remote backup failed with exit status {exit_status}: {error_message.strip()}")
 
     except Exception as e:
         q_out.put(e)
     finally:
-        if ssh: ssh.close()
+        if lease: lease.release()
 
-def backup_folder_local_task(config, local_base_path, q_out, server_name):
+@task_metrics.measured('local backup')
+def backup_folder_local_task(config, local_base_path, q_out, server_name, options=None):
     """
     Recursively downloads a remote directory to a local path.
+    Paths excluded by the 'exclude'/'include' filter patterns in options are skipped.
     """
-    ssh, sftp = None, None
+    filters = path_filter.PathFilter.from_options(options or {})
+    lease = None
     try:
         remote_start_path = config['path'].rstrip('/')
         folder_name = os.path.basename(remote_start_path) if remote_start_path else 'root'
@@ -337,10 +1261,8 @@ def backup_folder_local_task(config, local_base_path, q_out, server_name):
         os.makedirs(local_dest_path, exist_ok=True)
 
         q_out.put(f"({server_name}) Connecting to {config['host']} for local backup...")
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(config['host'], port=int(config['port']), username=config['user'], password=config['pass'], timeout=10)
-        sftp = ssh.open_sftp()
+        lease = connection_pool.get_default_pool().lease(config)
+        sftp = lease.sftp
 
         q_out.put(f"({server_name}) Starting local backup to {local_dest_path}...")
         
@@ -353,6 +1275,8 @@ def backup_folder_local_task(config, local_base_path, q_out, server_name):
                 remote_full_path = f"{current_remote_path.rstrip('/')}/{item.filename}"
                 relative_path = remote_full_path[len(remote_start_path):].lstrip('/')
                 local_full_path = os.path.join(local_dest_path, relative_path)
+                if filters and not filters.keep(relative_path, stat.S_ISDIR(item.st_mode)):
+                    continue
 
                 if stat.S_ISDIR(item.st_mode):
                     path_stack.append(remote_full_path)
@@ -367,111 +1291,542 @@ def backup_folder_local_task(config, local_base_path, q_out, server_name):
     except Exception as e:
         q_out.put(e)
     finally:
-        if sftp: sftp.close()
-        if ssh: ssh.close()
+        if lease: lease.release()
+
+def _exec_with_input(ssh, command, data, forward_agent=False):
+    """
+    Runs command on the server with data on its stdin.
+    Returns the exit status and the combined stdout/stderr output.
+    """
+    import paramiko
+    channel = ssh.get_transport().open_session()
+    try:
+        if forward_agent:
+            paramiko.agent.AgentRequestHandler(channel)
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+
+        def feed():
+            try:
+                channel.sendall(data)
+                channel.shutdown_write()
+            except Exception:
+                pass
+        # Feed stdin from a thread so a chatty command cannot block us while we are still writing
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        output = channel.makefile('rb').read().decode('utf-8', errors='replace')
+        feeder.join()
+        return channel.recv_exit_status(), output
+    finally:
+        channel.close()
+
+def _tar_stream_transfer(lease1, lease2, s1_config, s2_config, relative_paths, q_out):
+    """
+    Copies files from TEST to PROD as a single tar stream relayed through this computer:
+    `tar -c` runs on TEST over one exec channel and `tar -x` on PROD over another, so the
+    transfer costs no round trips per file. tar keeps modes and mtimes, and owners when PROD extracts as root.
+    Returns the files that were not transferred and still have to be copied one by one.
+    """
+    test_path = lease1.sftp.normalize(s1_config['path'] or '.')
+    prod_path = lease2.sftp.normalize(s2_config['path'] or '.')
+    reader = lease1.ssh.get_transport().open_session()
+    writer = lease2.ssh.get_transport().open_session()
+    output = {}
+    try:
+        reader.exec_command(f"tar -C {shlex.quote(test_path)} -cf - --null -T -")
+        writer.set_combine_stderr(True)
+        writer.exec_command(f"tar -C {shlex.quote(prod_path)} -xpvf -")
+
+        def feed():
+            try:
+                reader.sendall(''.join(f"{path}\0" for path in relative_paths).encode('utf-8'))
+                reader.shutdown_write()
+            except Exception:
+                pass
+        def collect(name, stream):
+            output[name] = stream.read().decode('utf-8', errors='replace')
+        helpers = [threading.Thread(target=feed, daemon=True),
+                   threading.Thread(target=collect, args=('test', reader.makefile_stderr('rb')), daemon=True),
+                   threading.Thread(target=collect, args=('prod', writer.makefile('rb')), daemon=True)]
+        for helper in helpers: helper.start()
+
+        q_out.put(f"Streaming {len(relative_paths)} files from TEST to PROD as a tar archive...")
+        sent, reported = 0, 0
+        while True:
+            data = reader.recv(1024 * 1024)
+            if not data:
+                break
+            writer.sendall(data)
+            task_metrics.add('bytes_relayed', len(data))
+            sent += len(data)
+            if sent - reported >= 64 * 1024 * 1024:
+                reported = sent
+                q_out.put(f"Tar stream: {sent / (1024 * 1024):.0f} MiB sent...")
+        writer.shutdown_write()
+        read_status, write_status = reader.recv_exit_status(), writer.recv_exit_status()
+        for helper in helpers: helper.join()
+    finally:
+        reader.close()
+        writer.close()
+
+    # tar -v lists every member it reaches, including those it then fails to write
+    lines = output.get('prod', '').splitlines()
+    errors = [line for line in lines if line.startswith('tar: ')]
+    error_text = '\n'.join(errors)
+    extracted = [line for line in lines if line and not line.endswith('/') and not line.startswith('tar: ')]
+    done = {name for name in extracted if f"tar: {name}: " not in error_text}
+    if read_status != 0 or write_status != 0:
+        errors = [line for line in output.get('test', '').splitlines() if line] + errors
+        q_out.put(f"Warning: Tar stream failed (TEST status {read_status}, PROD status {write_status}): {' '.join(errors[-3:])}")
+        if extracted and read_status != 0:
+            done.discard(extracted[-1]) # The stream broke off, so the last file may be incomplete
+    remaining = [p for p in relative_paths if p not in done]
+    q_out.put(f"Tar stream copied {len(relative_paths) - len(remaining)} files ({sent / (1024 * 1024):.1f} MiB), {len(remaining)} left to copy one by one.")
+    return remaining
+
+def _remote_block_signature(ssh, full_path, block_size=DELTA_BLOCK_SIZE):
+    """
+    Computes the block hashes of a file on the server with python3.
+    Returns (block hashes, hash of the whole file), or (None, None) if that is not possible.
+    """
+    try:
+        command = f"python3 -c {shlex.quote(BLOCK_SIGNATURE_SCRIPT)} {block_size} {shlex.quote(full_path)}"
+        stdin, stdout, stderr = ssh.exec_command(command)
+        lines = stdout.read().decode('ascii', errors='replace').split()
+        if stdout.channel.recv_exit_status() != 0 or len(lines) < 2 or lines[-2] != 'file':
+            return None, None
+        return lines[:-2], lines[-1]
+    except Exception:
+        return None, None
+
+def _delta_copy(ssh1, sftp1, ssh2, sftp2, s2_config, test_full_path, prod_full_path, test_meta, prod_meta, q_out):
+    """
+    Updates an existing PROD file in place so that it matches the TEST file, writing only the blocks that differ.
+    PROD block hashes come from the cached manifest or are computed on PROD; TEST block hashes are computed
+    on TEST, or while streaming the file when TEST has no python3. Blocks are compared at the same offsets,
+    because SFTP can only overwrite a file at offsets, not move data inside it.
+    Returns False, leaving the caller to copy the whole file, if the delta sync was not possible or did not verify.
+    """
+    test_size, prod_size = test_meta['size'], prod_meta['size']
+    if min(test_size, prod_size) < DELTA_MIN_SIZE:
+        return False
+    cache, prod_path = None, sftp2.normalize(prod_full_path)
+    try:
+        cache = hash_cache.get_default_cache()
+        prod_blocks = cache.lookup_manifest(s2_config['host'], s2_config['port'], prod_path, prod_size, prod_meta.get('mtime'), DELTA_BLOCK_SIZE)
+    except Exception:
+        prod_blocks = None
+    if prod_blocks is None:
+        prod_blocks, _ = _remote_block_signature(ssh2, prod_path)
+    if prod_blocks is None:
+        return False
+
+    # TEST may have changed since the comparison, so the blocks are taken from the file as it is now
+    test_blocks, test_hash = _remote_block_signature(ssh1, test_full_path)
+    test_size = sftp1.stat(test_full_path).st_size
+    block_count = (test_size + DELTA_BLOCK_SIZE - 1) // DELTA_BLOCK_SIZE
+    if test_blocks is not None and len(test_blocks) != block_count:
+        return False # TEST changed between hashing and stat
+    sent = 0
+    with sftp1.open(test_full_path, 'rb') as f_test, sftp2.open(prod_full_path, 'r+b') as f_prod:
+        f_prod.set_pipelined(True)
+        if test_blocks is not None:
+            changed = [i for i in range(block_count) if i >= len(prod_blocks) or test_blocks[i] != prod_blocks[i]]
+            ranges = [(i * DELTA_BLOCK_SIZE, min(DELTA_BLOCK_SIZE, test_size - i * DELTA_BLOCK_SIZE)) for i in changed]
+            for (offset, length), data in zip(ranges, f_test.readv(ranges)):
+                f_prod.seek(offset)
+                f_prod.write(data)
+                sent += len(data)
+        else:
+            # No python3 on TEST: read the file once and send the blocks whose hash differs
+            f_test.prefetch(test_size)
+            whole, test_blocks = hashlib.md5(), []
+            for i in range(block_count):
+                data = f_test.read(DELTA_BLOCK_SIZE)
+                whole.update(data)
+                test_blocks.append(hashlib.md5(data).hexdigest())
+                if i >= len(prod_blocks) or test_blocks[i] != prod_blocks[i]:
+                    f_prod.seek(i * DELTA_BLOCK_SIZE)
+                    f_prod.write(data)
+                    sent += len(data)
+            test_hash = whole.hexdigest()
+        if prod_size > test_size:
+            f_prod.truncate(test_size)
 
-def sync_folders_task(s1_config, s2_config, comparison_results, delete_on_prod, q_out):
+    # Verify the result on PROD before trusting it
+    new_blocks, new_hash = _remote_block_signature(ssh2, prod_path)
+    if new_hash is None:
+        tool = _detect_remote_hash_tool(ssh2, 'md5')
+        new_hash = _remote_hash_batch(ssh2, tool, '/', [prod_path.lstrip('/')]).get(prod_path.lstrip('/')) if tool else None
+    if new_hash != test_hash:
+        q_out.put(f"Warning: Delta sync of {prod_full_path} did not verify, copying the whole file.")
+        return False
+    if cache is not None:
+        try: cache.store_manifest(s2_config['host'], s2_config['port'], prod_path, test_size, test_meta.get('mtime'), DELTA_BLOCK_SIZE, test_blocks)
+        except Exception: pass
+    q_out.put(f"Delta sync sent {sent / (1024 * 1024):.1f} of {test_size / (1024 * 1024):.1f} MiB for {os.path.basename(prod_full_path)}.")
+    return True
+
+def _copy_to_prod(ssh1, sftp1, ssh2, sftp2, s2_config, test_full_path, prod_full_path, test_meta, prod_meta, options, q_out):
+    """Copies a file from TEST to PROD through this computer, as a delta sync when prod_meta says PROD already has it."""
+    if options['delta'] and prod_meta:
+        try:
+            if _delta_copy(ssh1, sftp1, ssh2, sftp2, s2_config, test_full_path, prod_full_path, test_meta, prod_meta, q_out):
+                return
+        except IOError as e:
+            q_out.put(f"Warning: Delta sync of {prod_full_path} failed ({e}), copying the whole file.")
+    with sftp1.open(test_full_path, 'rb') as f_test:
+        sftp2.putfo(f_test, prod_full_path)
+
+def _stat_meta(sftp, full_path):
+    """Returns {'size', 'mtime'} of a remote file, or None if it does not exist."""
+    try:
+        st = sftp.stat(full_path)
+    except FileNotFoundError:
+        return None
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+def _direct_transfer(lease1, lease2, s1_config, s2_config, relative_paths, options, q_out):
+    """
+    Copies files straight from TEST to PROD with rsync, or scp if rsync is missing, run on one of the servers.
+    With options['transfer'] == 'pull' PROD fetches from TEST, with 'push' TEST sends to PROD.
+    Returns the files that were not transferred and still have to go through the relay.
+    """
+    import paramiko
+    pull = options['transfer'] == 'pull'
+    runner, runner_name = (lease2, "PROD") if pull else (lease1, "TEST")
+    peer = s1_config if pull else s2_config
+    peer_path = (lease1 if pull else lease2).sftp.normalize(peer['path'] or '.').rstrip('/')
+    local_path = runner.sftp.normalize((s2_config if pull else s1_config)['path'] or '.')
+    peer_spec = f"{peer['user']}@{options['direct_host'] or peer['host']}"
+
+    if options['forward_agent'] and not paramiko.Agent().get_keys():
+        q_out.put("Warning: No keys in the local SSH agent to forward.")
+
+    if _has_remote_command(runner.ssh, 'rsync'):
+        # --ignore-times: files marked different may still match in size and mtime
+        ssh_command = f"ssh {DIRECT_SSH_OPTIONS} -p {int(peer['port'])}"
+        remote = shlex.quote(f"{peer_spec}:{peer_path}/")
+        source, target = (remote, '.') if pull else ('.', remote)
+        command = (f"cd {shlex.quote(local_path)} && rsync -a --ignore-times --protect-args --from0 --files-from=- "
+                   f"--out-format='SENT:%n' -e {shlex.quote(ssh_command)} {source} {target}")
+        candidates = list(relative_paths)
+    elif _has_remote_command(runner.ssh, 'scp'):
+        # Older scp versions pass remote paths through a shell, so only plain names go direct.
+        # Exit status 255 means ssh itself failed, so the remaining files are left to the relay.
+        remote = f"{shlex.quote(peer_spec)}:{shlex.quote(peer_path)}/\"$f\""
+        source, target = (remote, '"$f"') if pull else ('"$f"', remote)
+        command = (f"cd {shlex.quote(local_path)} && while IFS= read -r -d '' f; do "
+                   f"scp -p {DIRECT_SSH_OPTIONS} -P {int(peer['port'])} {source} {target} && printf 'SENT:%s\\n' \"$f\" "
+                   f"|| {{ status=$?; [ $status -eq 255 ] && exit 255; }}; done")
+        candidates = [p for p in relative_paths if shlex.quote(p) == p]
+    else:
+        q_out.put(f"Warning: Neither rsync nor scp is available on {runner_name}. Relaying all files.")
+        return list(relative_paths)
+
+    direction = "PROD pulls from TEST" if pull else "TEST pushes to PROD"
+    q_out.put(f"Direct transfer ({direction}) of {len(candidates)} files...")
+    data = ''.join(f"{path}\0" for path in candidates).encode('utf-8')
+    exit_status, output = _exec_with_input(runner.ssh, command, data, options['forward_agent'])
+
+    lines = output.splitlines()
+    sent = {line[len('SENT:'):] for line in lines if line.startswith('SENT:')}
+    if exit_status != 0:
+        errors = [line for line in lines if not line.startswith('SENT:')]
+        q_out.put(f"Warning: Direct transfer exited with status {exit_status}: {' '.join(errors[-3:])}")
+    remaining = [p for p in relative_paths if p not in sent]
+    q_out.put(f"Direct transfer copied {len(relative_paths) - len(remaining)} files, {len(remaining)} left for the relay.")
+    return remaining
+
+def _remote_prefix_hash(ssh, full_path, size):
+    """Returns the md5 of the first size bytes of a remote file, hashed on the server, or None if that failed."""
+    if not _detect_remote_hash_tool(ssh, 'md5'):
+        return None
+    try:
+        stdin, stdout, stderr = ssh.exec_command(f"head -c {int(size)} -- {shlex.quote(full_path)} | md5sum")
+        stdin.channel.shutdown_write()
+        output = stdout.read().decode('utf-8', errors='replace').split()
+        if stdout.channel.recv_exit_status() != 0 or not output:
+            return None
+    except Exception:
+        return None
+    return output[0].lower()
+
+def _resume_copy(ssh1, sftp1, ssh2, sftp2, test_full_path, prod_full_path, test_meta, q_out, chunk_size=1024 * 1024):
+    """
+    Continues a whole-file copy that an interrupted sync left half written, sending only the part
+    of the TEST file beyond the current end of the PROD file.
+    The PROD file may still be the old version (the sync stopped before truncating it), so the part
+    already there is only kept if it hashes the same as the start of the TEST file.
+    Returns False, leaving the caller to copy the whole file, if TEST changed since the sync was planned
+    or the PROD prefix could not be verified.
+    """
+    test_now, prod_now = _stat_meta(sftp1, test_full_path), _stat_meta(sftp2, prod_full_path)
+    if test_now is None or prod_now is None:
+        return False
+    if test_now['size'] != test_meta['size'] or int(test_now['mtime'] or 0) != int(test_meta.get('mtime') or 0):
+        return False
+    offset = prod_now['size']
+    if offset > test_now['size']:
+        return False
+    if offset:
+        prod_hash = _remote_prefix_hash(ssh2, prod_full_path, offset)
+        if prod_hash is None or prod_hash != _remote_prefix_hash(ssh1, test_full_path, offset):
+            return False
+    with sftp1.open(test_full_path, 'rb') as f_test, sftp2.open(prod_full_path, 'r+b') as f_prod:
+        f_test.seek(offset)
+        f_prod.seek(offset)
+        f_test.prefetch(test_now['size'])
+        f_prod.set_pipelined(True)
+        while True:
+            data = f_test.read(chunk_size)
+            if not data:
+                break
+            f_prod.write(data)
+    if sftp2.stat(prod_full_path).st_size != test_now['size']:
+        return False
+    q_out.put(f"Resumed {os.path.basename(prod_full_path)} at {offset / (1024 * 1024):.1f} MiB.")
+    return True
+
+def plan_sync(comparison_results, delete_on_prod, filters=None):
+    """
+    Turns comparison results into the operations of a sync, as stored in its journal.
+    Paths filters (a PathFilter) does not keep are left alone, in case the filters changed since the comparison.
+    """
+    filters = filters or path_filter.PathFilter()
+    files_to_copy = filters.filter_paths(comparison_results.get('only_on_1', []) + comparison_results.get('different', []))
+    files_s2 = comparison_results.get('files_s2', {})
+    return {
+        'deletes': sorted(filters.filter_paths(comparison_results.get('only_on_2', [])), key=len, reverse=True) if delete_on_prod else [],
+        'rmdirs': sorted(filters.filter_paths(comparison_results.get('only_on_2_dirs', []), is_dir=True), key=len, reverse=True) if delete_on_prod else [],
+        'mkdirs': sorted(filters.filter_paths(comparison_results.get('only_on_1_dirs', []), is_dir=True), key=len),
+        'copies': files_to_copy,
+        'files_s1': {p: comparison_results['files_s1'][p] for p in files_to_copy},
+        'files_s2': {p: files_s2[p] for p in files_to_copy if p in files_s2}
+    }
+
+@task_metrics.measured('sync')
+def sync_folders_task(s1_config, s2_config, comparison_results, delete_on_prod, q_out, options=None):
     """
     Synchronizes files from TEST (s1) to PROD (s2).
-    - Copies files from 'only_on_1' and 'different'.
+    - Copies files from 'only_on_1' and 'different', relayed through this computer or directly between the servers.
     - Deletes files from 'only_on_2' if delete_on_prod is True.
     - Sets permissions and ownership.
+    Files are copied by up to options['sync_workers'] workers at once. Each file reports a
+    {'status': 'file_synced', ...} event; errors are repeated in list order at the end.
+    Every operation is recorded in a sync journal, so an interrupted sync can be continued with resume_sync_task.
+    options overrides DEFAULT_SYNC_OPTIONS.
+    """
+    options = {**DEFAULT_SYNC_OPTIONS, **(options or {})}
+    try:
+        plan = plan_sync(comparison_results, delete_on_prod, path_filter.PathFilter.from_options(options))
+        try:
+            journal = sync_journal.SyncJournal.create(s1_config, s2_config, plan, options)
+        except OSError as e:
+            q_out.put(f"Warning: Could not write the sync journal, this sync cannot be resumed: {e}")
+            journal = sync_journal.SyncJournal.in_memory(plan)
+    except Exception as e:
+        q_out.put(e)
+        return
+    _execute_sync(s1_config, s2_config, journal, options, q_out)
+
+@task_metrics.measured('resume sync')
+def resume_sync_task(s1_config, s2_config, journal_path, q_out, options=None):
+    """
+    Continues an interrupted sync from its journal. Finished operations are skipped, and files
+    whose copy was cut off are continued from where the PROD file ends.
+    options overrides the options the sync was started with.
     """
-    ssh1, sftp1, ssh2, sftp2 = None, None, None, None
+    try:
+        journal = sync_journal.SyncJournal.load(journal_path)
+        if not journal.matches(s1_config, s2_config):
+            raise ValueError("The sync journal belongs to different servers or folders.")
+    except Exception as e:
+        q_out.put(e)
+        return
+    options = {**DEFAULT_SYNC_OPTIONS, **journal.header.get('options', {}), **(options or {})}
+    q_out.put(f"Resuming sync: {journal.remaining_operations()} of {journal.total_operations()} operations left...")
+    _execute_sync(s1_config, s2_config, journal, options, q_out)
+
+def _execute_sync(s1_config, s2_config, journal, options, q_out):
+    """Runs the operations of a sync journal that are not done yet, marking each one done as it finishes."""
+    plan = journal.plan
+    workers = max(1, min(int(options['sync_workers']), MAX_SYNC_WORKERS))
+    lease1, lease2 = None, None
     try:
         q_out.put("Connecting to servers for synchronization...")
         # Connect to TEST
-        ssh1 = paramiko.SSHClient()
-        ssh1.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh1.connect(s1_config['host'], port=int(s1_config['port']), username=s1_config['user'], password=s1_config['pass'], timeout=10)
-        sftp1 = ssh1.open_sftp()
+        lease1 = connection_pool.get_default_pool().lease(s1_config, channels=workers)
         
         # Connect to PROD
-        ssh2 = paramiko.SSHClient()
-        ssh2.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh2.connect(s2_config['host'], port=int(s2_config['port']), username=s2_config['user'], password=s2_config['pass'], timeout=10)
-        sftp2 = ssh2.open_sftp()
+        lease2 = connection_pool.get_default_pool().lease(s2_config, channels=workers)
+        sftp2 = lease2.sftp
         
         # --- 1. Handle Deletions on PROD ---
-        if delete_on_prod:
-            files_to_delete = sorted(comparison_results.get('only_on_2', []), key=len, reverse=True)
-            dirs_to_delete = sorted([d for d in comparison_results.get('only_on_2_dirs', [])], key=len, reverse=True)
-
-            q_out.put(f"Deleting {len(files_to_delete)} files from PROD server...")
+        with task_metrics.phase('delete', 'PROD'):
+            files_to_delete = [p for p in plan['deletes'] if not journal.is_done('delete', p)]
+            dirs_to_delete = [p for p in plan['rmdirs'] if not journal.is_done('rmdir', p)]
+            if files_to_delete:
+                q_out.put(f"Deleting {len(files_to_delete)} files from PROD server...")
             for i, relative_path in enumerate(files_to_delete):
                 prod_full_path = f"{s2_config['path'].rstrip('/')}/{relative_path}"
                 try:
                     q_out.put(f"({i+1}/{len(files_to_delete)}) Deleting file: {relative_path}")
                     sftp2.remove(prod_full_path)
+                except FileNotFoundError:
+                    pass
                 except Exception as e:
                     q_out.put(f"Warning: Could not delete file {relative_path} from PROD: {e}")
-            
-            q_out.put(f"Deleting {len(dirs_to_delete)} directories from PROD server...")
+                    continue
+                journal.mark_done('delete', relative_path)
+                task_metrics.add('files_deleted')
+        
+            if dirs_to_delete:
+                q_out.put(f"Deleting {len(dirs_to_delete)} directories from PROD server...")
             for i, relative_path in enumerate(dirs_to_delete):
                 prod_full_path = f"{s2_config['path'].rstrip('/')}/{relative_path}"
                 try:
                     q_out.put(f"({i+1}/{len(dirs_to_delete)}) Deleting dir: {relative_path}")
                     sftp2.rmdir(prod_full_path)
+                except FileNotFoundError:
+                    pass
                 except Exception as e:
                     q_out.put(f"Warning: Could not delete dir {relative_path} from PROD: {e}")
+                    continue
+                journal.mark_done('rmdir', relative_path)
+                task_metrics.add('dirs_deleted')
 
         # --- 2. Handle Copy/Overwrite ---
-        dirs_to_create = comparison_results.get('only_on_1_dirs', [])
-        files_to_copy = comparison_results.get('only_on_1', []) + comparison_results.get('different', [])
+        dirs_to_create = [p for p in plan['mkdirs'] if not journal.is_done('mkdir', p)]
+        files_to_copy = [p for p in plan['copies'] if not journal.is_done('attrs', p)]
         
         q_out.put(f"Creating {len(dirs_to_create)} directories on PROD server...")
-        for i, relative_path in enumerate(sorted(dirs_to_create, key=len)):
-            prod_full_path = f"{s2_config['path'].rstrip('/')}/{relative_path}"
-            try:
-                q_out.put(f"({i+1}/{len(dirs_to_create)}) Creating dir: {relative_path}")
-                sftp2.mkdir(prod_full_path)
-            except Exception as e:
-                q_out.put(f"Warning: Could not create dir {prod_full_path}: {e}")
+        with task_metrics.phase('mkdir', 'PROD'):
+            for i, relative_path in enumerate(dirs_to_create):
+                prod_full_path = f"{s2_config['path'].rstrip('/')}/{relative_path}"
+                try:
+                    q_out.put(f"({i+1}/{len(dirs_to_create)}) Creating dir: {relative_path}")
+                    sftp2.mkdir(prod_full_path)
+                    task_metrics.add('dirs_created')
+                except Exception as e:
+                    if not _is_remote_dir(sftp2, prod_full_path):
+                        q_out.put(f"Warning: Could not create dir {prod_full_path}: {e}")
+                        continue
+                journal.mark_done('mkdir', relative_path)
 
         q_out.put(f"Copying/overwriting {len(files_to_copy)} files from TEST to PROD...")
         prod_uid_map, prod_gid_map = _get_name_to_uid_map(sftp2), _get_name_to_gid_map(sftp2)
+        _forget_synced_hashes(s2_config, sftp2, files_to_copy, q_out)
 
-        for i, relative_path in enumerate(files_to_copy):
+        pending = [p for p in files_to_copy if not journal.is_done('copy', p)]
+        to_relay = set(pending)
+        if options['transfer'] in ('pull', 'push') and pending:
+            try:
+                with task_metrics.phase(f"{options['transfer']} transfer"):
+                    to_relay = set(_direct_transfer(lease1, lease2, s1_config, s2_config, pending, options, q_out))
+            except Exception as e:
+                q_out.put(f"Warning: Direct transfer failed, relaying all files: {e}")
+        elif options['transfer'] == 'tar' and pending:
+            try:
+                with task_metrics.phase('tar stream'):
+                    to_relay = set(_tar_stream_transfer(lease1, lease2, s1_config, s2_config, pending, q_out))
+            except Exception as e:
+                q_out.put(f"Warning: Tar stream failed, copying files one by one: {e}")
+            # tar restored modes and mtimes, but owners only when it extracted as root,
+            # otherwise the files still go through chown/chmod/utime so failures are reported
+            owners_kept = _is_remote_root(lease2.ssh)
+            for relative_path in pending:
+                if relative_path not in to_relay:
+                    journal.mark_done('copy', relative_path)
+                    if owners_kept:
+                        journal.mark_done('attrs', relative_path)
+            files_to_copy = [p for p in files_to_copy if not journal.is_done('attrs', p)]
+        for relative_path in pending:
+            if relative_path not in to_relay and not journal.is_done('copy', relative_path):
+                journal.mark_done('copy', relative_path)
+
+        errors = {} # {index in files_to_copy: error message}
+        progress = {'done': 0}
+        progress_lock = threading.Lock()
+
+        def sync_file(channel_pair, index, _push):
+            worker_sftp1, worker_sftp2 = channel_pair
+            relative_path = files_to_copy[index]
             test_full_path = f"{s1_config['path'].rstrip('/')}/{relative_path}"
             prod_full_path = f"{s2_config['path'].rstrip('/')}/{relative_path}"
-            
+            error = None
             try:
-                q_out.put(f"({i+1}/{len(files_to_copy)}) Syncing: {relative_path[:60]}")
-                
-                with sftp1.open(test_full_path, 'rb') as f_test:
-                    sftp2.putfo(f_test, prod_full_path)
+                test_meta = plan['files_s1'][relative_path]
+                if not journal.is_done('copy', relative_path):
+                    started = journal.started_mode('copy', relative_path)
+                    prod_meta = plan['files_s2'].get(relative_path)
+                    if started is not None:
+                        # An earlier run stopped during this copy, so the planned PROD metadata is stale
+                        prod_meta = _stat_meta(worker_sftp2, prod_full_path)
+                    if not (started == 'full' and _resume_copy(lease1.ssh, worker_sftp1, lease2.ssh, worker_sftp2, test_full_path, prod_full_path, test_meta, q_out)):
+                        mode = 'delta' if options['delta'] and prod_meta else 'full'
+                        journal.mark_started('copy', relative_path, mode)
+                        _copy_to_prod(lease1.ssh, worker_sftp1, lease2.ssh, worker_sftp2, s2_config, test_full_path, prod_full_path, test_meta, prod_meta, options, q_out)
+                    journal.mark_done('copy', relative_path)
 
-                test_meta = comparison_results['files_s1'][relative_path]
                 owner, group = test_meta.get('owner'), test_meta.get('group')
                 uid, gid = prod_uid_map.get(owner), prod_gid_map.get(group)
-                if uid is not None and gid is not None: sftp2.chown(prod_full_path, uid, gid)
+                if uid is not None and gid is not None: worker_sftp2.chown(prod_full_path, uid, gid)
                 
                 mode_str = test_meta.get('octal_mode')
-                if mode_str: sftp2.chmod(prod_full_path, int(mode_str, 8))
+                if mode_str: worker_sftp2.chmod(prod_full_path, int(mode_str, 8))
+
+                # Keep the TEST mtime so a quick compare can match the files by metadata
+                mtime = test_meta.get('mtime')
+                if mtime is not None: worker_sftp2.utime(prod_full_path, (mtime, mtime))
+                journal.mark_done('attrs', relative_path)
 
             except Exception as e:
-                q_out.put(f"Warning: Could not sync {relative_path}: {e}")
+                # A lost connection fails every remaining file, so stop and keep them in the journal
+                if not (lease1.connection.is_active() and lease2.connection.is_active()):
+                    raise
+                error = str(e)
+                errors[index] = error
+            task_metrics.add('files_synced' if error is None else 'files_failed')
+            with progress_lock:
+                progress['done'] += 1
+                done = progress['done']
+            q_out.put({'status': 'file_synced', 'file': relative_path, 'success': error is None, 'error': error, 'done': done, 'total': len(files_to_copy)})
+
+        channel_pairs = list(zip(lease1.channels, lease2.channels))
+        if len(channel_pairs) > 1:
+            q_out.put(f"Copying with {len(channel_pairs)} parallel transfers...")
+        with task_metrics.phase('copy'):
+            _run_parallel(channel_pairs, range(len(files_to_copy)), sync_file)
 
-        q_out.put({'status': 'sync_complete', 'success': True})
+        for index in sorted(errors):
+            q_out.put(f"Warning: Could not sync {files_to_copy[index]}: {errors[index]}")
+        if errors:
+            q_out.put(f"{len(errors)} of {len(files_to_copy)} files could not be synced.")
+        if journal.remaining_operations() == 0:
+            journal.discard()
+        else:
+            q_out.put(f"{journal.remaining_operations()} operations did not finish and can be retried with Resume.")
+        q_out.put({'status': 'sync_complete', 'success': True, 'failed': len(errors), 'remaining': journal.remaining_operations()})
 
     except Exception as e:
         q_out.put(e)
     finally:
-        for sftp, ssh in [(sftp1, ssh1), (sftp2, ssh2)]:
-            if sftp: sftp.close()
-            if ssh: ssh.close()
+        journal.close()
+        for lease in (lease1, lease2):
+            if lease: lease.release()
 
+@task_metrics.measured('upload')
 def upload_file_task(config, relative_path, content, q_out, server_name):
     """
     Uploads content to a file on an SFTP server.
     """
-    ssh, sftp = None, None
+    lease = None
     try:
         q_out.put(f"({server_name}) Connecting to {config['host']}...")
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(config['host'], port=int(config['port']), username=config['user'], password=config['pass'], timeout=10)
-        sftp = ssh.open_sftp()
+        lease = connection_pool.get_default_pool().lease(config)
+        sftp = lease.sftp
         
         full_path = f"{config['path'].rstrip('/')}/{relative_path}"
         q_out.put(f"({server_name}) Uploading to: {relative_path}")
@@ -485,28 +1840,28 @@ def upload_file_task(config, relative_path, content, q_out, server_name):
     except Exception as e:
         q_out.put(e)
     finally:
-        if sftp: sftp.close()
-        if ssh: ssh.close()
+        if lease: lease.release()
 
-def sync_single_file_task(s1_config, s2_config, relative_path, q_out):
+@task_metrics.measured('sync file')
+def sync_single_file_task(s1_config, s2_config, relative_path, q_out, options=None):
     """
     Synchronizes a single file from TEST (s1) to PROD (s2).
+    options overrides DEFAULT_SYNC_OPTIONS.
     """
-    ssh1, sftp1, ssh2, sftp2 = None, None, None, None
+    options = {**DEFAULT_SYNC_OPTIONS, **(options or {})}
+    lease1, lease2 = None, None
     try:
+        if not path_filter.PathFilter.from_options(options).keep_path(relative_path):
+            raise ValueError(f"{relative_path} is excluded by the workspace filters.")
         q_out.put(f"Connecting to servers to sync {relative_path}...")
         
         # Connect to TEST
-        ssh1 = paramiko.SSHClient()
-        ssh1.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh1.connect(s1_config['host'], port=int(s1_config['port']), username=s1_config['user'], password=s1_config['pass'], timeout=10)
-        sftp1 = ssh1.open_sftp()
+        lease1 = connection_pool.get_default_pool().lease(s1_config)
+        sftp1 = lease1.sftp
         
         # Connect to PROD
-        ssh2 = paramiko.SSHClient()
-        ssh2.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh2.connect(s2_config['host'], port=int(s2_config['port']), username=s2_config['user'], password=s2_config['pass'], timeout=10)
-        sftp2 = ssh2.open_sftp()
+        lease2 = connection_pool.get_default_pool().lease(s2_config)
+        sftp2 = lease2.sftp
         
         test_full_path = f"{s1_config['path'].rstrip('/')}/{relative_path}"
         prod_full_path = f"{s2_config['path'].rstrip('/')}/{relative_path}"
@@ -525,13 +1880,17 @@ def sync_single_file_task(s1_config, s2_config, relative_path, q_out):
             except Exception:
                 pass 
 
-        with sftp1.open(test_full_path, 'rb') as f_test:
-            sftp2.putfo(f_test, prod_full_path)
+        _forget_synced_hashes(s2_config, sftp2, [relative_path], q_out)
+        test_meta, prod_meta = _stat_meta(sftp1, test_full_path), _stat_meta(sftp2, prod_full_path)
+        if test_meta is None:
+            raise FileNotFoundError(f"{test_full_path} does not exist on TEST.")
+        _copy_to_prod(lease1.ssh, sftp1, lease2.ssh, sftp2, s2_config, test_full_path, prod_full_path, test_meta, prod_meta, options, q_out)
             
         # Try to sync permissions if possible
         try:
             test_stat = sftp1.stat(test_full_path)
             sftp2.chmod(prod_full_path, test_stat.st_mode)
+            sftp2.utime(prod_full_path, (test_stat.st_atime, test_stat.st_mtime))
         except Exception as e:
             q_out.put(f"Warning: Could not sync attributes: {e}")
 
@@ -541,30 +1900,33 @@ def sync_single_file_task(s1_config, s2_config, relative_path, q_out):
     except Exception as e:
         q_out.put(e)
     finally:
-        for sftp, ssh in [(sftp1, ssh1), (sftp2, ssh2)]:
-            if sftp: sftp.close()
-            if ssh: ssh.close()
+        for lease in (lease1, lease2):
+            if lease: lease.release()
 
-def sync_multiple_files_task(s1_config, s2_config, relative_paths_list, q_out):
+@task_metrics.measured('sync files')
+def sync_multiple_files_task(s1_config, s2_config, relative_paths_list, q_out, options=None):
     """
     Synchronizes multiple files from TEST (s1) to PROD (s2) using a single connection.
+    options overrides DEFAULT_SYNC_OPTIONS.
     """
-    ssh1, sftp1, ssh2, sftp2 = None, None, None, None
+    options = {**DEFAULT_SYNC_OPTIONS, **(options or {})}
+    lease1, lease2 = None, None
     try:
+        kept = path_filter.PathFilter.from_options(options).filter_paths(relative_paths_list)
+        if len(kept) < len(relative_paths_list):
+            q_out.put(f"Skipping {len(relative_paths_list) - len(kept)} files excluded by the workspace filters.")
+            relative_paths_list = kept
         q_out.put(f"Connecting to servers to sync {len(relative_paths_list)} files...")
         
         # Connect to TEST
-        ssh1 = paramiko.SSHClient()
-        ssh1.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh1.connect(s1_config['host'], port=int(s1_config['port']), username=s1_config['user'], password=s1_config['pass'], timeout=10)
-        sftp1 = ssh1.open_sftp()
+        lease1 = connection_pool.get_default_pool().lease(s1_config)
+        sftp1 = lease1.sftp
         
         # Connect to PROD
-        ssh2 = paramiko.SSHClient()
-        ssh2.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh2.connect(s2_config['host'], port=int(s2_config['port']), username=s2_config['user'], password=s2_config['pass'], timeout=10)
-        sftp2 = ssh2.open_sftp()
+        lease2 = connection_pool.get_default_pool().lease(s2_config)
+        sftp2 = lease2.sftp
         
+        _forget_synced_hashes(s2_config, sftp2, relative_paths_list, q_out)
         total = len(relative_paths_list)
         for i, relative_path in enumerate(relative_paths_list):
             try:
@@ -583,13 +1945,16 @@ def sync_multiple_files_task(s1_config, s2_config, relative_paths_list, q_out):
                     except Exception:
                         pass 
 
-                with sftp1.open(test_full_path, 'rb') as f_test:
-                    sftp2.putfo(f_test, prod_full_path)
+                test_meta, prod_meta = _stat_meta(sftp1, test_full_path), _stat_meta(sftp2, prod_full_path)
+                if test_meta is None:
+                    raise FileNotFoundError(f"{test_full_path} does not exist on TEST.")
+                _copy_to_prod(lease1.ssh, sftp1, lease2.ssh, sftp2, s2_config, test_full_path, prod_full_path, test_meta, prod_meta, options, q_out)
                     
                 # Try to sync permissions if possible
                 try:
                     test_stat = sftp1.stat(test_full_path)
                     sftp2.chmod(prod_full_path, test_stat.st_mode)
+                    sftp2.utime(prod_full_path, (test_stat.st_atime, test_stat.st_mtime))
                 except Exception as e:
                     q_out.put(f"Warning: Could not sync attributes for {relative_path}: {e}")
                 
@@ -604,6 +1969,5 @@ def sync_multiple_files_task(s1_config, s2_config, relative_paths_list, q_out):
     except Exception as e:
         q_out.put(e)
     finally:
-        for sftp, ssh in [(sftp1, ssh1), (sftp2, ssh2)]:
-            if sftp: sftp.close()
-            if ssh: ssh.close()
+        for lease in (lease1, lease2):
+            if lease: lease.release()
@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".mino", "journals")
+
+def _endpoint(config):
+    """The part of a server config that identifies a sync target. Passwords are never written."""
+    return {'host': config['host'], 'port': int(config['port']), 'user': config['user'], 'path': config['path']}
+
+class SyncJournal:
+    """
+    On-disk record of a sync, one JSON object per line.
+    The first line holds the plan: the servers, the sync options and the operations
+    (deletes, rmdirs, mkdirs and copies, with the TEST metadata used for chown/chmod).
+    Every later line marks an operation ("delete", "rmdir", "mkdir", "copy" or "attrs" on a path)
+    as started or done, so an interrupted sync can be resumed where it stopped.
+    """
+    def __init__(self, path, header, done=None, started=None):
+        self.path, self.header = path, header
+        self.plan = header['plan']
+        self.done = done or set() # {(op, path)}
+        self.started = started or {} # {(op, path): mode} for copies begun but not finished
+        self.lock = threading.Lock()
+        self.file = None
+
+    @classmethod
+    def create(cls, s1_config, s2_config, plan, options, directory=JOURNAL_DIR):
+        """Writes a new journal for plan and removes older unfinished journals of the same servers."""
+        os.makedirs(directory, exist_ok=True)
+        for old in list_unfinished(s1_config, s2_config, directory):
+            old.discard()
+        header = {
+            'id': uuid.uuid4().hex, 'created': time.time(),
+            's1': _endpoint(s1_config), 's2': _endpoint(s2_config),
+            'options': options, 'plan': plan
+        }
+        path = os.path.join(directory, f"sync-{time.strftime('%Y%m%d-%H%M%S')}-{header['id'][:8]}.jsonl")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header) + '\n')
+        return cls(path, header)
+
+    @classmethod
+    def in_memory(cls, plan):
+        """A journal that is not written anywhere, for when the journal directory is not writable."""
+        return cls(None, {'id': None, 'created': time.time(), 'plan': plan})
+
+    @classmethod
+    def load(cls, path):
+        """Reads a journal back. A torn last line (the app stopped mid-write) is ignored."""
+        done, started = set(), {}
+        with open(path, 'r', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                key = (entry['op'], entry['path'])
+                if entry['state'] == 'done':
+                    done.add(key)
+                    started.pop(key, None)
+                elif entry['state'] == 'started':
+                    started[key] = entry.get('mode')
+        return cls(path, header, done, started)
+
+    def matches(self, s1_config, s2_config):
+        return self.header['s1'] == _endpoint(s1_config) and self.header['s2'] == _endpoint(s2_config)
+
+    def _append(self, entry):
+        if self.path is None:
+            return
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def is_done(self, op, path):
+        return (op, path) in self.done
+
+    def started_mode(self, op, path):
+        """Returns the mode recorded when an unfinished operation started, or None."""
+        return self.started.get((op, path))
+
+    def mark_started(self, op, path, mode=None):
+        self.started[(op, path)] = mode
+        self._append({'op': op, 'path': path, 'state': 'started', 'mode': mode})
+
+    def mark_done(self, op, path):
+        self.done.add((op, path))
+        self.started.pop((op, path), None)
+        self._append({'op': op, 'path': path, 'state': 'done'})
+
+    def total_operations(self):
+        plan = self.plan
+        return len(plan['deletes']) + len(plan['rmdirs']) + len(plan['mkdirs']) + 2 * len(plan['copies'])
+
+    def remaining_operations(self):
+        return self.total_operations() - len(self.done)
+
+    def discard(self):
+        """Removes the journal file, e.g. once its sync has finished."""
+        self.close()
+        if self.path is None:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+def list_unfinished(s1_config, s2_config, directory=JOURNAL_DIR):
+    """Returns the journals left behind by interrupted syncs between these servers, newest first."""
+    journals = []
+    if not os.path.isdir(directory):
+        return journals
+    for name in os.listdir(directory):
+        if not name.endswith('.jsonl'):
+            continue
+        try:
+            journal = SyncJournal.load(os.path.join(directory, name))
+        except (OSError, ValueError, KeyError):
+            continue
+        if journal.matches(s1_config, s2_config):
+            journals.append(journal)
+    return sorted(journals, key=lambda j: j.header['created'], reverse=True)
+
+def find_unfinished(s1_config, s2_config, directory=JOURNAL_DIR):
+    """Returns the newest unfinished journal between these servers, or None."""
+    journals = list_unfinished(s1_config, s2_config, directory)
+    return journals[0] if journals else None
@@ -0,0 +1,269 @@
+import contextvars
+import functools
+import inspect
+import json
+import threading
+import time
+from collections import Counter
+
+MAX_RUNS = 20 # Finished runs kept for the stats window and exports
+
+_current = contextvars.ContextVar('task_metrics', default=None)
+_listeners = []
+_listeners_lock = threading.Lock()
+
+def add_listener(callback):
+    """Calls callback(metrics) from the task's thread whenever a measured task finishes."""
+    with _listeners_lock:
+        _listeners.append(callback)
+
+def remove_listener(callback):
+    with _listeners_lock:
+        if callback in _listeners:
+            _listeners.remove(callback)
+
+def current():
+    """Returns the TaskMetrics of the task running in this context, or None."""
+    return _current.get()
+
+class TaskMetrics:
+    """
+    Timings and counters of one run of a background task: the phases it went through (on which
+    server and thread), counters such as files listed or bytes read, and the SFTP requests made
+    on the channels it leased with their mean round-trip time.
+    """
+    def __init__(self, task):
+        self.task = task
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.error = None
+        self.spans = [] # (phase, server, thread name, start offset, seconds)
+        self.counters = Counter()
+        self.round_trip_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def round_trip(self, seconds):
+        """Records a request whose reply was waited for."""
+        with self.lock:
+            self.counters['sftp_round_trips'] += 1
+            self.round_trip_seconds += seconds
+
+    def record(self, phase, server, start, seconds):
+        with self.lock:
+            self.spans.append((phase, server, threading.current_thread().name, start - self.start, seconds))
+
+    def summary(self):
+        """Returns the totals of the run as a JSON-serializable dict."""
+        with self.lock:
+            phases = {}
+            for phase, server, _, _, seconds in self.spans:
+                entry = phases.setdefault(f"{phase} ({server})" if server else phase, {'seconds': 0.0, 'count': 0})
+                entry['seconds'] += seconds
+                entry['count'] += 1
+            counters = dict(self.counters)
+            round_trips = counters.get('sftp_round_trips', 0)
+            return {
+                'task': self.task,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'seconds': self.seconds,
+                'error': self.error,
+                'phases': {k: {'seconds': round(v['seconds'], 4), 'count': v['count']} for k, v in phases.items()},
+                'counters': counters,
+                'mean_rtt_ms': round(self.round_trip_seconds / round_trips * 1000, 2) if round_trips else None
+            }
+
+    def to_dict(self):
+        """Returns the summary together with every recorded phase, for JSON export."""
+        with self.lock:
+            spans = [{'phase': p, 'server': s, 'thread': t, 'start': round(o, 6), 'seconds': round(d, 6)} for p, s, t, o, d in self.spans]
+        return {**self.summary(), 'spans': spans}
+
+    def describe(self):
+        """Returns the summary as lines of text for the stats window."""
+        summary = self.summary()
+        lines = [f"{summary['task']} started {summary['started']}, took {summary['seconds'] or 0:.2f} s"
+                 + (f", failed: {summary['error']}" if summary['error'] else "")]
+        lines.append("")
+        lines.append("Phases (time adds up over servers and parallel workers):")
+        for phase, entry in sorted(summary['phases'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f"  {phase:<40} {entry['seconds']:9.3f} s" + (f"  x{entry['count']}" if entry['count'] > 1 else ""))
+        lines.append("")
+        lines.append("Counters:")
+        for counter, value in sorted(summary['counters'].items()):
+            shown = f"{value / 1048576:.2f} MiB" if counter.startswith('bytes_') else str(value)
+            lines.append(f"  {counter:<40} {shown:>12}")
+        if summary['mean_rtt_ms'] is not None:
+            lines.append(f"  {'mean SFTP round trip':<40} {summary['mean_rtt_ms']:>9.2f} ms")
+        return lines
+
+class _Phase:
+    """Context manager timing one phase of the current task; does nothing outside measured tasks."""
+    def __init__(self, name, server):
+        self.name, self.server = name, server
+
+    def __enter__(self):
+        self.metrics = current()
+        self.start = time.perf_counter()
+        return self.metrics
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.metrics is not None:
+            self.metrics.record(self.name, self.server, self.start, time.perf_counter() - self.start)
+        return False
+
+def phase(name, server=None):
+    """Times the enclosed block as a phase of the running task, e.g. with phase('list', 'TEST'):"""
+    return _Phase(name, server)
+
+def add(counter, n=1):
+    """Adds n to a counter of the running task, if any."""
+    metrics = current()
+    if metrics is not None:
+        metrics.add(counter, n)
+
+class _Measure:
+    """Context manager measuring a task run; inside a task that is already measured it is one of its phases."""
+    def __init__(self, task):
+        self.task = task
+
+    def __enter__(self):
+        self.parent = current()
+        if self.parent is not None:
+            self.phase = phase(self.task)
+            self.phase.__enter__()
+            return self.parent
+        self.metrics = TaskMetrics(self.task)
+        self.token = _current.set(self.metrics)
+        return self.metrics
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.parent is not None:
+            return self.phase.__exit__(exc_type, exc, tb)
+        _current.reset(self.token)
+        metrics = self.metrics
+        metrics.seconds = round(time.perf_counter() - metrics.start, 4)
+        if exc is not None and metrics.error is None:
+            metrics.error = str(exc)
+        with _listeners_lock:
+            listeners = list(_listeners)
+        for listener in listeners:
+            listener(metrics)
+        return False
+
+def measure(task):
+    """Measures the enclosed block as a run of task, e.g. with measure('compare') as metrics:"""
+    return _Measure(task)
+
+class _ErrorWatch:
+    """Passes messages on to a task's q_out, noting the first exception the task reports in its metrics."""
+    def __init__(self, q_out, metrics):
+        self.q_out, self.metrics = q_out, metrics
+
+    def put(self, item, *args, **kwargs):
+        if isinstance(item, Exception) and self.metrics.error is None:
+            self.metrics.error = str(item)
+        self.q_out.put(item, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.q_out, name)
+
+def measured(task):
+    """Decorates a background task function with a q_out parameter so every call is measured as a run of task."""
+    def decorate(function):
+        q_index = list(inspect.signature(function).parameters).index('q_out')
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(task) as metrics:
+                if len(args) > q_index:
+                    args = args[:q_index] + (_ErrorWatch(args[q_index], metrics),) + args[q_index + 1:]
+                elif 'q_out' in kwargs:
+                    kwargs['q_out'] = _ErrorWatch(kwargs['q_out'], metrics)
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def carry(function):
+    """Returns function bound to the running task, for a worker thread to run it with the same metrics."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
+
+def bind_channels(channels, metrics):
+    """Makes SFTP channels report to metrics (or to nobody, for None) while a lease holds them."""
+    for sftp in channels:
+        sftp.mino_metrics = metrics
+
+def instrument_sftp(sftp):
+    """
+    Makes an SFTP channel count its requests, the time spent waiting for the replies of blocking
+    ones and the file data it reads and writes, for the metrics it is bound to (see bind_channels).
+    """
+    from paramiko.sftp import CMD_DATA, CMD_WRITE
+    request, async_request, read_packet = sftp._request, sftp._async_request, sftp._read_packet
+    sftp.mino_metrics = None
+
+    def timed_request(t, *args):
+        start = time.perf_counter()
+        try:
+            return request(t, *args)
+        finally:
+            if sftp.mino_metrics is not None:
+                sftp.mino_metrics.round_trip(time.perf_counter() - start)
+
+    def counted_async_request(fileobj, t, *args):
+        metrics = sftp.mino_metrics
+        if metrics is not None:
+            metrics.add('sftp_requests')
+            if t == CMD_WRITE:
+                metrics.add('bytes_written', len(args[2]))
+        return async_request(fileobj, t, *args)
+
+    def counted_read_packet():
+        t, data = read_packet()
+        if t == CMD_DATA and sftp.mino_metrics is not None:
+            sftp.mino_metrics.add('bytes_read', max(0, len(data) - 8)) # Request id and data length
+        return t, data
+
+    sftp._request, sftp._async_request, sftp._read_packet = timed_request, counted_async_request, counted_read_packet
+    return sftp
+
+def save_json(runs, path):
+    """Writes runs (TaskMetrics) with their phases to a JSON file."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([metrics.to_dict() for metrics in runs], f, indent=2)
+
+def chrome_trace(runs):
+    """
+    Returns runs (TaskMetrics) in the Chrome trace event format, to open in chrome://tracing or
+    Perfetto: one row per thread, a bar per task run and phase, and the counters as arguments.
+    """
+    events, thread_ids = [], {}
+    origin = min((metrics.started for metrics in runs), default=0)
+
+    def tid(thread):
+        if thread not in thread_ids:
+            thread_ids[thread] = len(thread_ids) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': thread_ids[thread], 'args': {'name': thread}})
+        return thread_ids[thread]
+
+    for metrics in runs:
+        offset = (metrics.started - origin) * 1e6
+        summary = metrics.summary()
+        with metrics.lock:
+            spans = list(metrics.spans)
+        first_thread = min(spans, key=lambda span: span[3])[2] if spans else "task"
+        events.append({'name': metrics.task, 'cat': 'task', 'ph': 'X', 'pid': 1, 'tid': tid(first_thread), 'ts': offset,
+                       'dur': (metrics.seconds or 0) * 1e6, 'args': {'counters': summary['counters'], 'mean_rtt_ms': summary['mean_rtt_ms'], 'error': summary['error']}})
+        for name, server, thread, start, seconds in spans:
+            events.append({'name': f"{name} ({server})" if server else name, 'cat': 'phase', 'ph': 'X', 'pid': 1, 'tid': tid(thread),
+                           'ts': offset + start * 1e6, 'dur': seconds * 1e6, 'args': {'server': server} if server else {}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def save_chrome_trace(runs, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(chrome_trace(runs), f)
@@ -0,0 +1,69 @@
+import time
+import unittest
+from unittest import mock
+
+import connection_pool
+
+CONFIG = {'host': 'example.test', 'port': '22', 'user': 'deploy', 'pass': 'secret', 'path': '/srv'}
+KEY = ('example.test', 22, 'deploy')
+
+def fake_ssh():
+    ssh = mock.MagicMock()
+    ssh.get_transport.return_value.is_active.return_value = True
+    ssh.open_sftp.side_effect = lambda: mock.MagicMock(**{'get_channel.return_value.closed': False})
+    return ssh
+
+class LeaseRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = connection_pool.ConnectionPool()
+        self.pool._start_reaper = lambda: None
+        self.pool._connect = mock.Mock(side_effect=self.connect)
+
+    def connect(self, key, config, channels, timeout):
+        connection = connection_pool._Connection(fake_ssh(), config['pass'])
+        connection.open_channels, connection.leases = channels, 1
+        with self.pool.cond:
+            self.pool.connecting[key] -= 1
+            self.pool.connections.setdefault(key, []).append(connection)
+        return connection
+
+    def idle_connection(self):
+        """Leases and releases a connection, then makes it look idle for long enough to be probed."""
+        lease = self.pool.lease(CONFIG)
+        lease.release()
+        lease.connection.last_used = time.time() - connection_pool.HEALTH_CHECK_AFTER - 1
+        return lease.connection
+
+    def test_failed_probe_retries_on_a_fresh_connection(self):
+        stale = self.idle_connection()
+        self.pool._probe = mock.Mock(side_effect=EOFError("Connection reset"))
+
+        lease = self.pool.lease(CONFIG)
+
+        self.pool._probe.assert_called_once()
+        self.assertIsNot(lease.connection, stale)
+        self.assertEqual(self.pool._connect.call_count, 2)
+        self.assertTrue(stale.retired)
+        self.assertEqual(stale.leases, 0)
+        self.assertNotIn(stale, self.pool.connections[KEY])
+        stale.ssh.close.assert_called()
+        lease.release()
+        self.assertEqual(lease.connection.leases, 0)
+
+    def test_inactive_connection_retries_on_a_fresh_connection(self):
+        stale = self.idle_connection()
+        self.pool._reserve = mock.Mock(side_effect=[(stale, list(stale.idle_channels)), (None, [])])
+        stale.leases += 1
+        stale.idle_channels = []
+        stale.ssh.get_transport.return_value.is_active.return_value = False
+        self.pool.connecting[KEY] = 1 # As _reserve does before returning (None, [])
+
+        lease = self.pool.lease(CONFIG)
+
+        self.assertIsNot(lease.connection, stale)
+        self.assertEqual(stale.leases, 0)
+        self.assertTrue(stale.retired)
+        lease.release()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import hashlib
+import io
+import queue
+import random
+import shlex
+import stat
+import types
+import unittest
+from unittest import mock
+
+import sftp_logic
+
+BLOCK = sftp_logic.DELTA_BLOCK_SIZE
+S2_CONFIG = {'host': 'prod.test', 'port': 22, 'path': '/srv'}
+OPTIONS = {'delta': True}
+
+class FakeFile:
+    """An SFTP file handle on a FakeSftp, counting the bytes written through it."""
+    def __init__(self, sftp, path):
+        self.sftp, self.path, self.position = sftp, path, 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def prefetch(self, file_size=None):
+        pass
+
+    def read(self, size):
+        data = bytes(self.sftp.files[self.path][self.position:self.position + size])
+        self.position += len(data)
+        return data
+
+    def readv(self, chunks):
+        data = self.sftp.files[self.path]
+        return [bytes(data[offset:offset + length]) for offset, length in chunks]
+
+    def seek(self, offset):
+        self.position = offset
+
+    def write(self, data):
+        self.sftp.written += len(data)
+        if not self.sftp.drop_writes:
+            self.sftp.files[self.path][self.position:self.position + len(data)] = data
+        self.position += len(data)
+
+    def truncate(self, size):
+        del self.sftp.files[self.path][size:]
+
+class FakeSftp:
+    """An in-memory SFTP server holding {path: bytearray}. With drop_writes, in-place writes are lost."""
+    def __init__(self, files, drop_writes=False):
+        self.files = {path: bytearray(data) for path, data in files.items()}
+        self.drop_writes, self.written = drop_writes, 0
+
+    def normalize(self, path):
+        return path
+
+    def stat(self, path):
+        return types.SimpleNamespace(st_size=len(self.files[path]), st_mode=stat.S_IFREG | 0o644)
+
+    def open(self, path, mode='r'):
+        if 'w' in mode:
+            self.files[path] = bytearray()
+        return FakeFile(self, path)
+
+    def putfo(self, f, path):
+        self.files[path] = bytearray(f.read(len(f.sftp.files[f.path])))
+
+class FakeSsh:
+    """Runs the block signature script against a FakeSftp's files, or fails as if python3 were missing."""
+    def __init__(self, sftp, python=True):
+        self.sftp, self.python = sftp, python
+
+    def exec_command(self, command):
+        args = shlex.split(command)
+        output, status = b'', 127
+        if self.python and args[0] == 'python3':
+            block_size, data = int(args[-2]), bytes(self.sftp.files[args[-1]])
+            blocks = [hashlib.md5(data[i:i + block_size]).hexdigest() for i in range(0, len(data), block_size)]
+            output, status = '\n'.join(blocks + ['file', hashlib.md5(data).hexdigest()]).encode('ascii'), 0
+        stdout = io.BytesIO(output)
+        stdout.channel = mock.Mock(**{'recv_exit_status.return_value': status})
+        return io.BytesIO(), stdout, io.BytesIO()
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+@mock.patch('hash_cache.get_default_cache', side_effect=OSError("no cache in tests"))
+class DeltaCopyTest(unittest.TestCase):
+    def copy(self, test_data, prod_data, test_python=True, drop_writes=False):
+        """Copies test_data over prod_data with _copy_to_prod and returns (PROD sftp, messages)."""
+        sftp1 = FakeSftp({'/test/f': test_data})
+        sftp2 = FakeSftp({'/srv/f': prod_data}, drop_writes)
+        q_out = queue.Queue()
+        sftp_logic._copy_to_prod(FakeSsh(sftp1, test_python), sftp1, FakeSsh(sftp2), sftp2, S2_CONFIG, '/test/f', '/srv/f',
+                                 {'size': len(test_data)}, {'size': len(prod_data)}, OPTIONS, q_out)
+        messages = []
+        while not q_out.empty():
+            messages.append(q_out.get())
+        return sftp2, messages
+
+    def test_appended_data_sends_only_the_new_blocks(self, _cache):
+        prod_data = random_bytes(12 * BLOCK)
+        test_data = prod_data + random_bytes(BLOCK + 1000, seed=1)
+        sftp2, messages = self.copy(test_data, prod_data)
+        self.assertEqual(bytes(sftp2.files['/srv/f']), test_data)
+        self.assertEqual(sftp2.written, BLOCK + 1000)
+        self.assertTrue(messages[-1].startswith("Delta sync sent"))
+
+    def test_appended_data_without_python3_on_test(self, _cache):
+        prod_data = random_bytes(12 * BLOCK)
+        test_data = prod_data + random_bytes(1000, seed=1)
+        sftp2, _ = self.copy(test_data, prod_data, test_python=False)
+        self.assertEqual(bytes(sftp2.files['/srv/f']), test_data)
+        self.assertEqual(sftp2.written, 1000)
+
+    def test_edit_in_the_middle_sends_one_block(self, _cache):
+        prod_data = random_bytes(12 * BLOCK + 500)
+        test_data = bytearray(prod_data)
+        test_data[5 * BLOCK + 10:5 * BLOCK + 20] = b'x' * 10
+        test_data = bytes(test_data)
+        sftp2, _ = self.copy(test_data, prod_data)
+        self.assertEqual(bytes(sftp2.files['/srv/f']), test_data)
+        self.assertEqual(sftp2.written, BLOCK)
+
+    def test_shrunk_file_is_truncated(self, _cache):
+        prod_data = random_bytes(12 * BLOCK)
+        test_data = prod_data[:9 * BLOCK + 300]
+        sftp2, _ = self.copy(test_data, prod_data)
+        self.assertEqual(bytes(sftp2.files['/srv/f']), test_data)
+        self.assertEqual(sftp2.written, 300)
+
+    def test_failed_verification_falls_back_to_a_full_copy(self, _cache):
+        prod_data = random_bytes(12 * BLOCK)
+        test_data = prod_data[:BLOCK] + random_bytes(BLOCK, seed=1) + prod_data[2 * BLOCK:]
+        sftp2, messages = self.copy(test_data, prod_data, drop_writes=True)
+        self.assertEqual(bytes(sftp2.files['/srv/f']), test_data)
+        self.assertIn("Warning: Delta sync of /srv/f did not verify, copying the whole file.", messages)
+
+    def test_test_file_changed_after_hashing_is_not_delta_synced(self, _cache):
+        prod_data = random_bytes(12 * BLOCK)
+        sftp1, sftp2 = FakeSftp({'/test/f': prod_data + b'new'}), FakeSftp({'/srv/f': prod_data})
+        with mock.patch.object(sftp_logic, '_remote_block_signature', side_effect=[(['a'] * 12, 'p'), (['b'] * 12, 't')]):
+            self.assertFalse(sftp_logic._delta_copy(None, sftp1, None, sftp2, S2_CONFIG, '/test/f', '/srv/f',
+                                                    {'size': 12 * BLOCK}, {'size': 12 * BLOCK}, queue.Queue()))
+        self.assertEqual(sftp2.written, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from sftp_logic import patch_comparison_results
+
+def meta(hash_value):
+    return {'size': 10, 'mtime': 1700000000, 'hash': hash_value}
+
+def comparison_results():
+    return {
+        'different': ['app/main.py'],
+        'identical': ['README'],
+        'only_on_1': ['app/new/x.py'],
+        'only_on_2': ['old.txt'],
+        'only_on_1_dirs': ['app/new'],
+        'only_on_2_dirs': [],
+        'common_dirs': ['app'],
+        'files_s1': {'app/main.py': meta('a1'), 'README': meta('r'), 'app/new/x.py': meta('x')},
+        'files_s2': {'app/main.py': meta('a2'), 'README': meta('r'), 'old.txt': meta('o')}
+    }
+
+def refresh(paths, verdicts, files_s1=None, files_s2=None, dirs_s1=(), dirs_s2=()):
+    return {'status': 'refresh_complete', 'paths': sorted(paths), 'verdicts': verdicts,
+            'files_s1': files_s1 or {}, 'files_s2': files_s2 or {}, 'dirs_s1': sorted(dirs_s1), 'dirs_s2': sorted(dirs_s2)}
+
+class PatchComparisonResultsTest(unittest.TestCase):
+    def test_file_that_became_identical(self):
+        results = comparison_results()
+        verdicts = patch_comparison_results(results, refresh(
+            ['app', 'app/main.py'], {'app/main.py': 'identical'},
+            {'app/main.py': meta('a1')}, {'app/main.py': meta('a1')}, ['app'], ['app']))
+        self.assertEqual(verdicts, {'app/main.py': 'identical'})
+        self.assertEqual(results['different'], [])
+        self.assertEqual(sorted(results['identical']), ['README', 'app/main.py'])
+        self.assertEqual(results['files_s2']['app/main.py'], meta('a1'))
+        self.assertEqual(results['common_dirs'], ['app'])
+        self.assertEqual(results['only_on_1'], ['app/new/x.py'])
+        self.assertEqual(results['only_on_1_dirs'], ['app/new'])
+
+    def test_file_deleted_on_prod(self):
+        results = comparison_results()
+        patch_comparison_results(results, refresh(['old.txt'], {'old.txt': None}))
+        self.assertEqual(results['only_on_2'], [])
+        self.assertNotIn('old.txt', results['files_s2'])
+        for key in ('different', 'identical', 'only_on_1'):
+            self.assertNotIn('old.txt', results[key])
+        self.assertIn('README', results['files_s2'])
+
+    def test_new_directory_created_on_prod(self):
+        results = comparison_results()
+        patch_comparison_results(results, refresh(
+            ['app', 'app/new', 'app/new/x.py'], {'app/new/x.py': 'identical'},
+            {'app/new/x.py': meta('x')}, {'app/new/x.py': meta('x')}, ['app', 'app/new'], ['app', 'app/new']))
+        self.assertEqual(results['only_on_1'], [])
+        self.assertEqual(results['only_on_1_dirs'], [])
+        self.assertEqual(results['common_dirs'], ['app', 'app/new'])
+        self.assertIn('app/new/x.py', results['identical'])
+        self.assertEqual(results['files_s2']['app/new/x.py'], meta('x'))
+        self.assertEqual(results['different'], ['app/main.py'])
+
+    def test_directory_removed_from_both_servers(self):
+        results = comparison_results()
+        patch_comparison_results(results, refresh(['app', 'app/new', 'app/new/x.py'], {'app/new/x.py': None},
+                                                  dirs_s1=['app'], dirs_s2=['app']))
+        self.assertEqual(results['only_on_1'], [])
+        self.assertEqual(results['only_on_1_dirs'], [])
+        self.assertEqual(results['common_dirs'], ['app'])
+        self.assertNotIn('app/new/x.py', results['files_s1'])
+
+if __name__ == "__main__":
+    unittest.main()
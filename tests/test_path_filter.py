@@ -0,0 +1,27 @@
+import unittest
+
+from path_filter import PathFilter
+
+class BracketPatternTest(unittest.TestCase):
+    def test_bracket_without_a_valid_set_is_literal(self):
+        f = PathFilter('[]\n[!]\n[z-a]', '')
+        for name in ('[]', '[!]', '[z-a]'):
+            self.assertFalse(f.keep(name, False), name)
+        self.assertTrue(f.keep('a', False))
+
+    def test_closing_bracket_first_in_the_set(self):
+        f = PathFilter('x[]]y\n[!]]z', '')
+        self.assertFalse(f.keep('x]y', False))
+        self.assertFalse(f.keep('az', False))
+        self.assertTrue(f.keep(']z', False))
+
+    def test_ranges_and_negation(self):
+        f = PathFilter('*.[ch]\nlog[0-9]\n[!a]*.tmp', '')
+        self.assertFalse(f.keep('src/main.c', False))
+        self.assertFalse(f.keep('log7', False))
+        self.assertFalse(f.keep('b.tmp', False))
+        self.assertTrue(f.keep('a.tmp', False))
+        self.assertTrue(f.keep('main.py', False))
+
+if __name__ == "__main__":
+    unittest.main()
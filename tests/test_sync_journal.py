@@ -0,0 +1,180 @@
+import os
+import queue
+import shutil
+import stat
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import sftp_logic
+import sync_journal
+from path_filter import PathFilter
+
+S1_CONFIG = {'host': 'test.example', 'port': '22', 'user': 'deploy', 'pass': 'secret', 'path': '/srv/test'}
+S2_CONFIG = {'host': 'prod.example', 'port': '22', 'user': 'deploy', 'pass': 'secret', 'path': '/srv/prod'}
+OPTIONS = {**sftp_logic.DEFAULT_SYNC_OPTIONS, 'sync_workers': 1}
+
+def comparison_results():
+    meta = lambda size: {'size': size, 'mtime': 1700000000, 'owner': 'deploy', 'group': 'deploy', 'octal_mode': '644'}
+    return {
+        'only_on_1': ['new.txt', 'dir/a.txt', 'dir/sub/b.txt', 'cache/x.tmp'],
+        'different': ['changed.txt'],
+        'only_on_2': ['old.txt', 'olddir/c.txt'],
+        'only_on_1_dirs': ['dir/sub', 'dir'],
+        'only_on_2_dirs': ['olddir'],
+        'files_s1': {p: meta(10) for p in ['new.txt', 'dir/a.txt', 'dir/sub/b.txt', 'cache/x.tmp', 'changed.txt']},
+        'files_s2': {'changed.txt': meta(20), 'old.txt': meta(5), 'olddir/c.txt': meta(5)}
+    }
+
+def interrupted_journal(plan, directory):
+    """Writes a journal for plan as a sync would have left it when stopped part way, and returns its path."""
+    journal = sync_journal.SyncJournal.create(S1_CONFIG, S2_CONFIG, plan, OPTIONS, directory)
+    journal.mark_done('delete', 'olddir/c.txt')
+    journal.mark_done('delete', 'old.txt')
+    journal.mark_done('mkdir', 'dir')
+    journal.mark_started('copy', 'new.txt', 'full')
+    journal.mark_done('copy', 'new.txt')
+    journal.mark_done('attrs', 'new.txt')
+    journal.mark_done('copy', 'dir/a.txt')
+    journal.mark_started('copy', 'changed.txt', 'full')
+    journal.mark_started('copy', 'cache/x.tmp', 'delta')
+    journal.close()
+    return journal.path
+
+class PlanSyncTest(unittest.TestCase):
+    def test_plan_orders_operations(self):
+        plan = sftp_logic.plan_sync(comparison_results(), True)
+        self.assertEqual(plan['deletes'], ['olddir/c.txt', 'old.txt'])
+        self.assertEqual(plan['rmdirs'], ['olddir'])
+        self.assertEqual(plan['mkdirs'], ['dir', 'dir/sub'])
+        self.assertEqual(plan['copies'], ['new.txt', 'dir/a.txt', 'dir/sub/b.txt', 'cache/x.tmp', 'changed.txt'])
+        self.assertEqual(set(plan['files_s1']), set(plan['copies']))
+        self.assertEqual(list(plan['files_s2']), ['changed.txt'])
+
+    def test_plan_without_deletes_and_with_filters(self):
+        plan = sftp_logic.plan_sync(comparison_results(), False, PathFilter('*.tmp\nsub/', ''))
+        self.assertEqual(plan['deletes'], [])
+        self.assertEqual(plan['rmdirs'], [])
+        self.assertEqual(plan['mkdirs'], ['dir'])
+        self.assertEqual(plan['copies'], ['new.txt', 'dir/a.txt', 'changed.txt'])
+
+class SyncJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.plan = sftp_logic.plan_sync(comparison_results(), True)
+
+    def test_reload_replays_the_entries(self):
+        journal = sync_journal.SyncJournal.load(interrupted_journal(self.plan, self.directory))
+        self.assertEqual(journal.plan, self.plan)
+        self.assertTrue(journal.matches(S1_CONFIG, {**S2_CONFIG, 'pass': 'other'}))
+        self.assertFalse(journal.matches(S1_CONFIG, {**S2_CONFIG, 'path': '/srv/other'}))
+        self.assertTrue(journal.is_done('mkdir', 'dir'))
+        self.assertFalse(journal.is_done('mkdir', 'dir/sub'))
+        self.assertTrue(journal.is_done('copy', 'dir/a.txt'))
+        self.assertFalse(journal.is_done('attrs', 'dir/a.txt'))
+        self.assertIsNone(journal.started_mode('copy', 'new.txt'))
+        self.assertEqual(journal.started_mode('copy', 'changed.txt'), 'full')
+        self.assertEqual(journal.started_mode('copy', 'cache/x.tmp'), 'delta')
+        self.assertEqual(journal.total_operations(), 2 + 1 + 2 + 2 * 5)
+        self.assertEqual(journal.remaining_operations(), 15 - 6)
+
+    def test_passwords_are_not_written(self):
+        with open(interrupted_journal(self.plan, self.directory), encoding='utf-8') as f:
+            self.assertNotIn('secret', f.read())
+
+    def test_torn_last_line_is_ignored(self):
+        path = interrupted_journal(self.plan, self.directory)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('{"op": "attrs", "path": "dir/a.t')
+        journal = sync_journal.SyncJournal.load(path)
+        self.assertFalse(journal.is_done('attrs', 'dir/a.txt'))
+        self.assertEqual(journal.remaining_operations(), 9)
+
+    def test_new_journal_replaces_unfinished_ones(self):
+        old_path = interrupted_journal(self.plan, self.directory)
+        self.assertEqual(sync_journal.find_unfinished(S1_CONFIG, S2_CONFIG, self.directory).path, old_path)
+        new = sync_journal.SyncJournal.create(S1_CONFIG, S2_CONFIG, self.plan, OPTIONS, self.directory)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual(sync_journal.find_unfinished(S1_CONFIG, S2_CONFIG, self.directory).path, new.path)
+        self.assertIsNone(sync_journal.find_unfinished(S1_CONFIG, {**S2_CONFIG, 'host': 'other'}, self.directory))
+
+def fake_lease():
+    sftp = mock.MagicMock()
+    sftp.normalize.side_effect = lambda path: path
+    return types.SimpleNamespace(ssh=mock.MagicMock(), sftp=sftp, channels=[sftp],
+                                 connection=mock.Mock(**{'is_active.return_value': True}), release=mock.Mock())
+
+@mock.patch('hash_cache.get_default_cache', side_effect=OSError("no cache in tests"))
+@mock.patch.object(sftp_logic, '_get_name_to_gid_map', return_value={'deploy': 1000})
+@mock.patch.object(sftp_logic, '_get_name_to_uid_map', return_value={'deploy': 1000})
+class ExecuteSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.lease1, self.lease2 = fake_lease(), fake_lease()
+        pool = mock.Mock(**{'lease.side_effect': [self.lease1, self.lease2]})
+        patcher = mock.patch('connection_pool.get_default_pool', return_value=pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.plan = sftp_logic.plan_sync(comparison_results(), True)
+
+    def run_sync(self, path):
+        q_out = queue.Queue()
+        with mock.patch.object(sftp_logic, '_copy_to_prod') as copy, \
+             mock.patch.object(sftp_logic, '_resume_copy', return_value=True) as resume:
+            sftp_logic.resume_sync_task(S1_CONFIG, S2_CONFIG, path, q_out)
+        messages = []
+        while not q_out.empty():
+            messages.append(q_out.get())
+        for message in messages:
+            if isinstance(message, Exception):
+                raise message
+        return copy, resume, messages
+
+    def prod_paths(self, relative_paths):
+        return [mock.call(f"{S2_CONFIG['path']}/{p}") for p in relative_paths]
+
+    def test_resume_skips_finished_operations(self, *_):
+        path = interrupted_journal(self.plan, self.directory)
+        copy, resume, messages = self.run_sync(path)
+        sftp2 = self.lease2.sftp
+        self.assertEqual(sftp2.remove.call_args_list, [])
+        self.assertEqual(sftp2.rmdir.call_args_list, self.prod_paths(['olddir']))
+        self.assertEqual(sftp2.mkdir.call_args_list, self.prod_paths(['dir/sub']))
+        # The full copy of changed.txt is continued; the delta copy of cache/x.tmp is started again
+        self.assertEqual([c.args[4] for c in resume.call_args_list], ['/srv/test/changed.txt'])
+        self.assertEqual(sorted(c.args[5] for c in copy.call_args_list), ['/srv/test/cache/x.tmp', '/srv/test/dir/sub/b.txt'])
+        # Attributes are set for every file whose attrs were not done yet, including dir/a.txt
+        self.assertEqual(sorted(c.args[0] for c in sftp2.utime.call_args_list),
+                         [f"/srv/prod/{p}" for p in ['cache/x.tmp', 'changed.txt', 'dir/a.txt', 'dir/sub/b.txt']])
+        self.assertEqual(messages[-1], {'status': 'sync_complete', 'success': True, 'failed': 0, 'remaining': 0})
+        self.assertFalse(os.path.exists(path))
+
+    def test_failed_mkdir_stays_in_the_journal(self, *_):
+        journal = sync_journal.SyncJournal.create(S1_CONFIG, S2_CONFIG, {**self.plan, 'copies': []}, OPTIONS, self.directory)
+        journal.close()
+        sftp2 = self.lease2.sftp
+        def stat_dir(path):
+            if path != '/srv/prod/dir':
+                raise FileNotFoundError(path)
+            return types.SimpleNamespace(st_mode=stat.S_IFDIR | 0o755)
+        sftp2.mkdir.side_effect = IOError("Permission denied")
+        sftp2.stat.side_effect = stat_dir
+        _, _, messages = self.run_sync(journal.path)
+        journal = sync_journal.SyncJournal.load(journal.path)
+        self.assertTrue(journal.is_done('mkdir', 'dir')) # Already there
+        self.assertFalse(journal.is_done('mkdir', 'dir/sub'))
+        self.assertIn("Warning: Could not create dir /srv/prod/dir/sub: Permission denied", messages)
+        self.assertEqual(messages[-1]['remaining'], 1)
+
+    def test_journal_of_other_servers_is_refused(self, *_):
+        path = interrupted_journal(self.plan, self.directory)
+        q_out = queue.Queue()
+        sftp_logic.resume_sync_task(S1_CONFIG, {**S2_CONFIG, 'host': 'other.example'}, path, q_out)
+        self.assertIsInstance(q_out.get_nowait(), ValueError)
+        self.assertTrue(q_out.empty())
+
+if __name__ == "__main__":
+    unittest.main()
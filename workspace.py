@@ -0,0 +1,49 @@
+import json
+import os
+
+import path_filter
+
+SERVER_KEYS = ("host", "port", "user", "pass", "path")
+SERVER_LABELS = {"server1": "TEST", "server2": "PROD"}
+# Environment variables that supply the passwords of workspaces saved without them
+PASSWORD_ENV = {"server1": "MINO_TEST_PASS", "server2": "MINO_PROD_PASS"}
+
+def load_workspace(path):
+    """
+    Reads a workspace JSON file as saved by the app's File menu.
+    Returns a dict with the 'server1' and 'server2' configs and the 'compare_options',
+    'sync_options', 'filter_options' and 'watch_options' sections, empty where the file has none.
+    Raises ValueError if the file is not a workspace or has a path filter pattern that cannot be used.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path} is not a workspace file.")
+    workspace = {}
+    for key in SERVER_LABELS:
+        server = data.get(key, {})
+        workspace[key] = {k: str(server.get(k, "22" if k == "port" else "")) for k in SERVER_KEYS}
+    for section in ("compare_options", "sync_options", "filter_options", "watch_options"):
+        workspace[section] = dict(data.get(section, {}))
+    try:
+        path_filter.PathFilter.from_options(workspace["filter_options"])
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}")
+    return workspace
+
+def missing_fields(workspace, key):
+    """Returns the connection fields other than the password that a server config leaves empty."""
+    return [k for k in ("host", "user", "path") if not workspace[key][k]]
+
+def resolve_password(workspace, key, prompt=None):
+    """
+    Fills in the password of a server config: from its environment variable (see PASSWORD_ENV),
+    else the one saved in the workspace, else prompt(label) if given. Returns the config.
+    """
+    config = workspace[key]
+    password = os.environ.get(PASSWORD_ENV[key])
+    if password is None and not config["pass"] and prompt is not None:
+        password = prompt(SERVER_LABELS[key])
+    if password is not None:
+        config["pass"] = password
+    return config